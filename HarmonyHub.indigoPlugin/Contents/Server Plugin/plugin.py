@@ -2,12 +2,35 @@
 # -*- coding: utf-8 -*-
 ####################
 
+import gzip
+import hashlib
+import heapq
+import ipaddress
+import itertools
 import json
 import logging
+import os
+import queue
+import socket
+import stat
+import statistics
 import threading
 import asyncio
+import concurrent.futures
+import contextvars
+import csv
+import math
+import mmap
+import random
+import re
+import struct
+import time
+from collections import deque
+from functools import partial
 
 try:
+    import aiohttp
+    from aiohttp import web
     import aioharmony.exceptions
     from aioharmony.harmonyapi import HarmonyAPI, SendCommandDevice
     from aioharmony.responsehandler import Handler
@@ -15,13 +38,86 @@ try:
 except ImportError:
     raise ImportError("'Required Python libraries missing.  Run 'pip3 install aioharmony' in Terminal window, then reload plugin. Xcode required!")
 
+DISPATCH_TIMEOUT = 10.0     # default seconds an Indigo thread waits for a dispatched coroutine
+
+RECONNECT_MIN_DELAY = 2.0   # first retry delay after a failed connect, doubled on each failure
+RECONNECT_MAX_DELAY = 300.0
+PING_INTERVAL = 60.0        # seconds between health checks on a connected hub
+PING_TIMEOUT = 10.0
+PING_FAILURES = 2           # consecutive failed health checks before the connection is considered stale
+
+CONFIG_CACHE_VERSION = 1    # bump when the HubIndex cache layout changes
+
+REPEAT_COMMAND_PREFIXES = ("Volume", "Channel")   # commands queued below navigation, they usually come in ramps
+
+HUB_PORT = 8088             # aioharmony always uses the hub's default port
+DISCOVERY_CONCURRENCY = 64  # addresses probed at once
+DISCOVERY_TIMEOUT = 1.0     # seconds per address
+DISCOVERY_MAX_HOSTS = 1024
+REDISCOVER_ATTEMPTS = 3     # failed connects in a row before looking for the hub at another address
+REDISCOVER_INTERVAL = 600.0     # minimum seconds between subnet scans for one hub
+
+AUTO_PROTOCOL = "auto"      # protocol setting that picks the faster transport for each hub
+PROTOCOL_PROBE_ROUNDS = 5   # state digest round trips per transport when comparing them
+PROTOCOL_PROBE_TIMEOUT = 5.0    # seconds to connect a probe client, aioharmony keeps retrying a refused XMPP connect
+PROTOCOL_RECHECK_INTERVAL = 6 * 3600.0  # seconds before an automatic choice is evaluated again
+PROTOCOL_ERROR_RATE = 0.2   # share of failed commands since the last evaluation that brings the next one forward
+PROTOCOL_MIN_COMMANDS = 10  # commands needed before the error rate counts
+PROTOCOL_SWITCH_MARGIN = 0.8    # the other transport's median must be this fraction of the current one's to switch
+
+SEARCH_LIMIT = 200          # most lines a config search writes to the log
+
+PIPELINE_STOP_TIMEOUT = 5.0     # seconds to wait for each event worker at shutdown
+PIPELINE_WARN_INTERVAL = 60.0   # minimum seconds between overflow warnings for one worker
+
+TRACE_PLUGIN = 0            # trace buffer key for events that don't belong to one hub
+
+EVENT_LOG_KINDS = ("automation", "stateDigest", "activityFinished", "activityFailed", "configChanged", "connection")
+EVENT_LOG_RECORD = struct.Struct("<dBBHHh")     # time, kind, flag, id string, detail string, value: 16 bytes
+EVENT_LOG_HEADER = struct.Struct("<4sHHI4x")    # magic, format version, record size, records written: 16 bytes
+EVENT_LOG_MAGIC = b"HHEV"
+EVENT_LOG_VERSION = 2       # 2: each segment has its own string table
+EVENT_LOG_STRINGS = 0x10000     # most strings in one segment's table, a record holds 16 bit string ids
+EVENT_LOG_SEGMENT_RECORDS = 65536   # records per segment file, 1 MB
+EVENT_LOG_FLUSH = 2.0       # seconds between batched writes
+EVENT_LOG_PENDING = 10000   # most events waiting for a write, the oldest are dropped beyond that
+EVENT_LOG_HANDOFF = 10.0    # most seconds a hub's new event log waits for its previous one to close
+
+STATE_SERVER_HOST = "127.0.0.1"     # the state server is only reachable from this Mac
+STATE_LONG_POLL_MAX = 60.0  # longest ?wait a state request may ask for
+STATE_KEEPALIVE = 15.0      # seconds between comments on an idle event stream
+STATE_HISTORY = 1000        # state changes kept for event streams that reconnect with Last-Event-ID
+
+# numeric plugin prefs: key -> (type, default, minimum, maximum), checked by validatePrefsConfigUi
+NUMERIC_PREFS = {
+    "maxConcurrentConnects": (int, 4, 1, 64),
+    "commandSpacing": (int, 100, 0, 10000),
+    "optimisticTimeout": (float, 30, 1, 600),
+    "offlineBufferSize": (int, 20, 1, 1000),
+    "offlineBufferAge": (float, 60, 1, 3600),
+    "eventWorkers": (int, 2, 1, 32),
+    "eventQueueSize": (int, 1000, 1, 1000000),
+    "automationWindow": (int, 250, 0, 10000),
+    "traceSize": (int, 500, 0, 100000),
+    "stateServerPort": (int, 8177, 1024, 65535),
+    "eventLogSize": (int, 10, 1, 10000),
+}
+
+HARMONY_INTERNAL_MISSING = object()     # returned by Plugin._async_harmony_internal when aioharmony has changed
+
+# when the Indigo action behind the running coroutine was invoked, set by Plugin._timed_call
+invoked_at = contextvars.ContextVar("invoked_at", default=None)
+
 class Listener(object):
 
     def __init__(self, device, client, callback):
         self.device_id = device.id
         self.client_ip = client.ip_address
         self.callback = callback
-        client.register_handler(handler=Handler(handler_obj=self.output_response, handler_name='output_response', once=False)) # noqa
+        self.handler_uuid = client.register_handler(handler=Handler(handler_obj=self.output_response, handler_name='output_response', once=False)) # noqa
+
+    def unregister(self, client):
+        client.unregister_handler(self.handler_uuid)
 
     def output_response(self, message):
         message['device_id'] = self.device_id
@@ -29,6 +125,1141 @@ class Listener(object):
         self.callback(message)
 
 
+class HubIndex(object):
+    """
+    Lookup tables and ConfigUI menus derived from a hub's config.  Built once when the config is received; when
+    the hub reports a new config, updated() makes a new index that only re-parses the activities and devices that
+    changed.  Command resolution is a single dict access and the menu generators just return prebuilt lists.
+    """
+
+    def __init__(self, config):
+        self.config_hash = None             # set by the plugin, see hash_config()
+        self.activities = dict()            # activityId -> activity
+        self.activity_commands = dict()     # (activityId, commandName) -> (deviceId, command)
+        self.device_commands = dict()       # (deviceId, commandName) -> command
+
+        self.activity_menu = []             # [(activityId, label)], sorted by label, PowerOff excluded
+        self.activity_group_menu = []       # [(groupName, groupName)] across all activities, deduped
+        self.activity_group_commands = {}   # groupName -> [(commandName, commandName)] across all activities, deduped
+        self.device_menu = []               # [(deviceId, label)], sorted by label
+        self.device_group_menu = {}         # deviceId -> [(groupName, groupName)]
+        self.device_group_commands = {}     # (deviceId, groupName) -> [(commandName, label)]
+
+        for activity in config.get("activity", []):
+            self.activities[activity["id"]] = activity
+            self._index_activity(activity)
+        for device in config.get("device", []):
+            self._index_device(device)
+        self._build_menus(config)
+
+    def _index_activity(self, activity):
+        for group in activity.get("controlGroup", []):
+            for function in group.get("function", []):
+                key = (activity["id"], function["name"])
+                if key in self.activity_commands:   # first match wins, same as the old linear scan
+                    continue
+                action = self._parse_action(function)
+                if action:
+                    self.activity_commands[key] = (action["deviceId"], action["command"])
+
+    def _index_device(self, device):
+        device_groups = []
+        for group in device.get("controlGroup", []):
+            device_groups.append((group["name"], group["name"]))
+            group_commands = []
+            for function in group.get("function", []):
+                group_commands.append((function["name"], function["label"]))
+                key = (device["id"], function["name"])
+                if key in self.device_commands:
+                    continue
+                action = self._parse_action(function)
+                if action:
+                    self.device_commands[key] = action["command"]
+            self.device_group_commands[(device["id"], group["name"])] = self._sorted_menu(group_commands)
+        self.device_group_menu[device["id"]] = self._sorted_menu(device_groups)
+
+    def _build_menus(self, config):
+        # the menus that span all activities or devices, cheap since no actions are parsed
+        activity_group_commands = dict()
+        for activity in config.get("activity", []):
+            for group in activity.get("controlGroup", []):
+                group_commands = activity_group_commands.setdefault(group["name"], set())
+                group_commands.update(function["name"] for function in group.get("function", []))
+        self.activity_menu = self._sorted_menu((activity["id"], activity["label"]) for activity in config.get("activity", []) if activity["id"] != "-1")
+        self.device_menu = self._sorted_menu((device["id"], device["label"]) for device in config.get("device", []))
+        self.activity_group_menu = self._sorted_menu((name, name) for name in activity_group_commands)
+        self.activity_group_commands = {group_name: self._sorted_menu((name, name) for name in commands)
+                                        for group_name, commands in activity_group_commands.items()}
+
+    def updated(self, config, changes):
+        """
+        A new index for config, reusing this one's tables for the activities and devices that changes (from
+        diff_configs) doesn't list.  This index is left as it was, so readers on other threads never see a mix.
+        """
+        stale_activities = set(changes["activity"]["changed"]) | set(changes["activity"]["removed"])
+        stale_devices = set(changes["device"]["changed"]) | set(changes["device"]["removed"])
+
+        hub_index = self.__class__.__new__(self.__class__)
+        hub_index.config_hash = None
+        hub_index.activities = {activity["id"]: activity for activity in config.get("activity", [])}
+        hub_index.activity_commands = {key: value for key, value in self.activity_commands.items() if key[0] not in stale_activities}
+        hub_index.device_commands = {key: value for key, value in self.device_commands.items() if key[0] not in stale_devices}
+        hub_index.device_group_menu = {key: value for key, value in self.device_group_menu.items() if key not in stale_devices}
+        hub_index.device_group_commands = {key: value for key, value in self.device_group_commands.items() if key[0] not in stale_devices}
+
+        for activity_id in changes["activity"]["changed"] + changes["activity"]["added"]:
+            hub_index._index_activity(hub_index.activities[activity_id])
+        devices = {device["id"]: device for device in config.get("device", [])}
+        for device_id in changes["device"]["changed"] + changes["device"]["added"]:
+            hub_index._index_device(devices[device_id])
+        hub_index._build_menus(config)
+        return hub_index
+
+    @staticmethod
+    def diff_configs(old, new):
+        """
+        What changed between two configs: for "activity" and "device", the ids added, removed and changed, and for
+        "function", the "<activity or device label>/<function name>" entries added and removed.
+        """
+        def functions(item):
+            return {function["name"] for group in item.get("controlGroup", []) for function in group.get("function", [])}
+
+        def labelled(item, names):
+            return [f"{item['label']}/{name}" for name in sorted(names)]
+
+        changes = {"function": {"added": [], "removed": []}}
+        for kind in ("activity", "device"):
+            old_items = {item["id"]: item for item in old.get(kind, [])}
+            new_items = {item["id"]: item for item in new.get(kind, [])}
+            changed = [item_id for item_id in new_items.keys() & old_items.keys() if new_items[item_id] != old_items[item_id]]
+            changes[kind] = {"added": sorted(new_items.keys() - old_items.keys()),
+                             "removed": sorted(old_items.keys() - new_items.keys()),
+                             "changed": sorted(changed)}
+            for item_id in changes[kind]["changed"]:
+                old_functions, new_functions = functions(old_items[item_id]), functions(new_items[item_id])
+                changes["function"]["added"].extend(labelled(new_items[item_id], new_functions - old_functions))
+                changes["function"]["removed"].extend(labelled(old_items[item_id], old_functions - new_functions))
+            for item_id in changes[kind]["added"]:
+                changes["function"]["added"].extend(labelled(new_items[item_id], functions(new_items[item_id])))
+            for item_id in changes[kind]["removed"]:
+                changes["function"]["removed"].extend(labelled(old_items[item_id], functions(old_items[item_id])))
+        return changes
+
+    @staticmethod
+    def describe_changes(changes):
+        parts = []
+        for kind, name in (("activity", "activities"), ("device", "devices"), ("function", "functions")):
+            counts = [f"{len(ids)} {what}" for what, ids in changes[kind].items() if ids]
+            if counts:
+                parts.append(f"{name} {', '.join(counts)}")
+        return "; ".join(parts) or "no changes"
+
+    def describe_activity(self, activity_id):
+        activity = self.activities.get(activity_id)
+        if not activity:
+            return []
+        lines = [f"Activity {activity['label']} ({activity_id})"]
+        for group in activity.get("controlGroup", []):
+            lines.append(f"\t{group['name']}: {', '.join(function['name'] for function in group.get('function', []))}")
+        return lines
+
+    def describe_device(self, device_id):
+        label = dict(self.device_menu).get(device_id)
+        if label is None:
+            return []
+        lines = [f"Device {label} ({device_id})"]
+        for group_name, _ in self.device_group_menu.get(device_id, []):
+            commands = self.device_group_commands.get((device_id, group_name), [])
+            lines.append(f"\t{group_name}: {', '.join(name for name, _ in commands)}")
+        return lines
+
+    def describe_group(self, group_name):
+        lines = []
+        for activity_id, label in self.activity_menu:
+            for group in self.activities[activity_id].get("controlGroup", []):
+                if group["name"].lower() == group_name.lower():
+                    lines.append(f"Activity {label}: {', '.join(function['name'] for function in group.get('function', []))}")
+        for device_id, label in self.device_menu:
+            for name, _ in self.device_group_menu.get(device_id, []):
+                if name.lower() == group_name.lower():
+                    commands = self.device_group_commands.get((device_id, name), [])
+                    lines.append(f"Device {label} ({device_id}): {', '.join(command for command, _ in commands)}")
+        return lines
+
+    def find_functions(self, text):
+        # case-insensitive substring match on function names and labels; the search list is built on first use
+        if getattr(self, "_search_entries", None) is None:
+            entries = []
+            for activity_id, label in self.activity_menu:
+                for group in self.activities[activity_id].get("controlGroup", []):
+                    for function in group.get("function", []):
+                        entries.append((f"{function['name']} {function.get('label', '')}".lower(),
+                                        f"Activity {label} / {group['name']} / {function['name']}"))
+            for device_id, label in self.device_menu:
+                for group_name, _ in self.device_group_menu.get(device_id, []):
+                    for name, function_label in self.device_group_commands.get((device_id, group_name), []):
+                        entries.append((f"{name} {function_label}".lower(), f"Device {label} ({device_id}) / {group_name} / {name}"))
+            self._search_entries = entries
+        text = text.lower()
+        return [line for key, line in self._search_entries if text in key]
+
+    def activity_named(self, name):
+        # activity id for a label, ignoring case; the name table is built on first use
+        if getattr(self, "_activity_names", None) is None:
+            self._activity_names = {label.lower(): activity_id for activity_id, label in self.activity_menu}
+            self._activity_names.setdefault("poweroff", "-1")
+        return self._activity_names.get(str(name).strip().lower())
+
+    def device_named(self, name):
+        # device id for a label, ignoring case
+        if getattr(self, "_device_names", None) is None:
+            self._device_names = {label.lower(): device_id for device_id, label in self.device_menu}
+        return self._device_names.get(str(name).strip().lower())
+
+    def catalog(self):
+        # activities and devices with their command groups, for the state server; built on first use
+        if getattr(self, "_catalog", None) is None:
+            self._catalog = {
+                "activities": [{"id": activity_id, "label": label,
+                                "groups": {group["name"]: [function["name"] for function in group.get("function", [])]
+                                           for group in self.activities[activity_id].get("controlGroup", [])}}
+                               for activity_id, label in self.activity_menu],
+                "devices": [{"id": device_id, "label": label,
+                             "groups": {group_name: [{"name": name, "label": function_label} for name, function_label
+                                                     in self.device_group_commands.get((device_id, group_name), [])]
+                                        for group_name, _ in self.device_group_menu.get(device_id, [])}}
+                            for device_id, label in self.device_menu],
+            }
+        return self._catalog
+
+    @staticmethod
+    def _sorted_menu(items):
+        return sorted(items, key=lambda tup: tup[1])
+
+    @staticmethod
+    def hash_config(config):
+        return hashlib.sha1(json.dumps(config, sort_keys=True, separators=(',', ':')).encode("utf-8")).hexdigest()
+
+    def to_cache(self):
+        # JSON-friendly form of the derived tables; activities is rebuilt from the config by from_cache()
+        return {
+            "activity_commands": [[a, c, d, cmd] for (a, c), (d, cmd) in self.activity_commands.items()],
+            "device_commands": [[d, c, cmd] for (d, c), cmd in self.device_commands.items()],
+            "activity_menu": self.activity_menu,
+            "activity_group_menu": self.activity_group_menu,
+            "activity_group_commands": self.activity_group_commands,
+            "device_menu": self.device_menu,
+            "device_group_menu": self.device_group_menu,
+            "device_group_commands": [[d, g, menu] for (d, g), menu in self.device_group_commands.items()],
+        }
+
+    @classmethod
+    def from_cache(cls, config, data, config_hash):
+        def menu(items):
+            return [tuple(item) for item in items]
+
+        hub_index = cls.__new__(cls)
+        hub_index.config_hash = config_hash
+        hub_index.activities = {activity["id"]: activity for activity in config.get("activity", [])}
+        hub_index.activity_commands = {(a, c): (d, cmd) for a, c, d, cmd in data["activity_commands"]}
+        hub_index.device_commands = {(d, c): cmd for d, c, cmd in data["device_commands"]}
+        hub_index.activity_menu = menu(data["activity_menu"])
+        hub_index.activity_group_menu = menu(data["activity_group_menu"])
+        hub_index.activity_group_commands = {g: menu(items) for g, items in data["activity_group_commands"].items()}
+        hub_index.device_menu = menu(data["device_menu"])
+        hub_index.device_group_menu = {d: menu(items) for d, items in data["device_group_menu"].items()}
+        hub_index.device_group_commands = {(d, g): menu(items) for d, g, items in data["device_group_commands"]}
+        return hub_index
+
+    @staticmethod
+    def _parse_action(function):
+        try:
+            action = json.loads(function["action"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if "command" not in action:
+            return None
+        return action
+
+
+class DispatchStats(object):
+    """
+    Queue and execution times for one kind of coroutine dispatched from Indigo threads onto the event loop.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.queue_total = 0.0
+        self.queue_max = 0.0
+        self.exec_total = 0.0
+        self.exec_max = 0.0
+
+    def record(self, queue_time, exec_time, failed):
+        self.count += 1
+        if failed:
+            self.failures += 1
+        self.queue_total += queue_time
+        self.queue_max = max(self.queue_max, queue_time)
+        self.exec_total += exec_time
+        self.exec_max = max(self.exec_max, exec_time)
+
+    def __str__(self):
+        if not self.count:
+            return "no calls"
+        return (f"{self.count} calls, {self.failures} failed, queue avg {self.queue_total / self.count * 1000:.1f} ms "
+                f"max {self.queue_max * 1000:.1f} ms, exec avg {self.exec_total / self.count * 1000:.1f} ms max {self.exec_max * 1000:.1f} ms")
+
+
+class LatencyHistogram(object):
+    """
+    Fixed-memory latency histogram: log-spaced buckets from 1 ms to 100 s, ten per decade, plus an overflow bucket.
+    Percentiles are reported as the upper edge of the bucket they fall in, so within ~25%.
+    """
+    MINIMUM = 0.001
+    PER_DECADE = 10
+    BUCKETS = 5 * PER_DECADE
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.total = 0
+
+    def record(self, seconds):
+        if seconds <= self.MINIMUM:
+            bucket = 0
+        else:
+            bucket = min(self.BUCKETS, int(math.log10(seconds / self.MINIMUM) * self.PER_DECADE))
+        self.counts[bucket] += 1
+        self.total += 1
+
+    def percentile(self, pct):
+        if not self.total:
+            return None
+        rank = math.ceil(self.total * pct / 100.0)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.MINIMUM * 10 ** ((bucket + 1) / self.PER_DECADE)
+        return None
+
+    def summary(self):
+        if not self.total:
+            return "no samples"
+        return ", ".join(f"p{pct} {self.percentile(pct) * 1000:.0f} ms" for pct in (50, 95, 99)) + f" ({self.total} samples)"
+
+
+class HubMetrics(object):
+    """
+    Command counts, failures by hub error code and round-trip latency histograms for one hub.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.failures = dict()                      # error code -> count
+        self.command_latency = LatencyHistogram()   # send_command, invocation to hub ack
+        self.activity_latency = LatencyHistogram()  # start_activity / power off, invocation to hub ack
+        self.activity_switch = LatencyHistogram()   # start_activity to startActivityFinished
+        self.last_activity_switch = None
+        self.switch_started = None                  # (activity id, time) of the pending start_activity
+        self.changed = False
+
+    def record(self, histogram, latency, codes=()):
+        self.commands += 1
+        histogram.record(latency)
+        for code in codes:
+            self.failures[str(code)] = self.failures.get(str(code), 0) + 1
+        self.changed = True
+
+    def record_sequence(self, commands, codes=()):
+        # a command sequence counts each command it sends, its round trip isn't comparable to a single command's
+        self.commands += commands
+        for code in codes:
+            self.failures[str(code)] = self.failures.get(str(code), 0) + 1
+        self.changed = True
+
+    def activity_started(self, activity_id, started):
+        self.switch_started = (str(activity_id), started)
+
+    def activity_finished(self, activity_id, finished):
+        if not self.switch_started or self.switch_started[0] != str(activity_id):
+            return False
+        self.last_activity_switch = finished - self.switch_started[1]
+        self.activity_switch.record(self.last_activity_switch)
+        self.switch_started = None
+        self.changed = True
+        return True
+
+    def states(self):
+        def ms(pct):
+            value = self.command_latency.percentile(pct)
+            return round(value * 1000) if value is not None else 0
+
+        return [{'key': 'commandCount', 'value': self.commands},
+                {'key': 'commandFailures', 'value': sum(self.failures.values())},
+                {'key': 'commandLatencyP50', 'value': ms(50)},
+                {'key': 'commandLatencyP95', 'value': ms(95)},
+                {'key': 'commandLatencyP99', 'value': ms(99)},
+                {'key': 'activitySwitchTime', 'value': round(self.last_activity_switch or 0, 2)}
+                ]
+
+    def report(self):
+        failures = ", ".join(f"{code}: {count}" for code, count in sorted(self.failures.items())) or "none"
+        return (f"\tCommands sent: {self.commands}, failures by code: {failures}\n"
+                f"\tCommand latency: {self.command_latency.summary()}\n"
+                f"\tActivity command latency: {self.activity_latency.summary()}\n"
+                f"\tActivity switch time: {self.activity_switch.summary()}")
+
+
+class TraceBuffer(object):
+    """
+    The most recent events for one hub as (time, kind, details) tuples in a fixed size ring.  Recording is one
+    deque append with no formatting, so the hot paths can trace every message and command; the text is only built
+    when the buffer is dumped.
+    """
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+
+    def add(self, kind, *details):
+        self.events.append((time.time(), kind, details))
+
+    def format(self, kinds=None, limit=None):
+        events = [event for event in list(self.events) if not kinds or event[1] in kinds]
+        lines = []
+        for timestamp, kind, details in events[-limit:] if limit else events:
+            stamp = time.strftime("%H:%M:%S", time.localtime(timestamp)) + f".{int(timestamp % 1 * 1000):03d}"
+            lines.append(f"{stamp} {kind:16s} {' '.join(str(detail) for detail in details)}")
+        return lines
+
+
+class HubEventLog(object):
+    """
+    Append-only history of one hub's events in its own folder.  Events are fixed size EVENT_LOG_RECORD records in
+    memory-mapped segment files of EVENT_LOG_SEGMENT_RECORDS each, oldest segments deleted to stay under max_bytes.
+    Activity and device ids, statuses and other text are interned: a record holds their index in its segment's
+    strings file, which is deleted along with the segment.  A segment whose string table is full is finished early.
+
+    record() just queues the event and may be called from any thread; flush() does the file work in batches and
+    runs in an executor.  query() reads the segments in place, skipping the ones outside the time range and
+    binary searching the first one in it.  A log opened for a hub whose previous log is still closing (a restarted
+    device) waits for that close before touching the files.
+    """
+    _closing = dict()           # folder -> threading.Event set when the latest log opened for it is closed
+    _closing_lock = threading.Lock()
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._pending = deque(maxlen=EVENT_LOG_PENDING)
+        self._flush_lock = threading.Lock()
+        self._strings = []              # the writable segment's interned text by index
+        self._string_ids = dict()
+        self._segment = None            # (sequence number, file, mmap, records written) of the segment being written
+        self._closed = False
+        self._closed_event = threading.Event()
+        with HubEventLog._closing_lock:
+            self._previous = HubEventLog._closing.get(folder)
+            HubEventLog._closing[folder] = self._closed_event
+
+    def record(self, kind, key="", detail="", value=0, flag=0):
+        if len(self._pending) == EVENT_LOG_PENDING:
+            self.dropped += 1
+        self._pending.append((time.time(), kind, flag, key, detail, value))
+
+    def flush(self):
+        with self._flush_lock:
+            if self._closed or not self._pending:
+                return 0
+            self._wait_for_previous()
+            new_strings = []
+            written = 0
+            for _ in range(len(self._pending)):     # popleft rather than swapping the deque, record() may be appending
+                timestamp, kind, flag, key, detail, value = self._pending.popleft()
+                key, detail = self._clean(key), self._clean(detail)
+                number, file, segment, count = self._writable_segment(new_strings, len({key, detail} - self._string_ids.keys()))
+                EVENT_LOG_RECORD.pack_into(segment, EVENT_LOG_HEADER.size + count * EVENT_LOG_RECORD.size, timestamp,
+                                           EVENT_LOG_KINDS.index(kind), flag, self._intern(key, new_strings),
+                                           self._intern(detail, new_strings), self._int16(value))
+                self._segment = (number, file, segment, count + 1)
+                written += 1
+            self._finish_segment(new_strings)
+            return written
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._flush_lock:
+                self._closed = True
+                if self._segment:
+                    self._segment[2].close()
+                    self._segment[1].close()
+                    self._segment = None
+            self._closed_event.set()
+            with HubEventLog._closing_lock:
+                if HubEventLog._closing.get(self.folder) is self._closed_event:
+                    del HubEventLog._closing[self.folder]
+
+    def query(self, start=None, end=None, kinds=None):
+        """
+        Yields (time, kind, id, detail, value, flag) for the events from start up to end (time.time() values, None
+        for no limit) in the order they were recorded, only of the kinds listed if kinds is given.
+        """
+        self.flush()
+        self._wait_for_previous()
+        kind_codes = {EVENT_LOG_KINDS.index(kind) for kind in kinds} if kinds else None
+        for number in self._segment_numbers():
+            try:
+                with open(self._segment_path(number), "rb") as file:
+                    segment = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):   # deleted by a rotation in the meantime, or empty
+                continue
+            with segment:
+                magic, version, record_size, count = EVENT_LOG_HEADER.unpack_from(segment, 0)
+                if magic != EVENT_LOG_MAGIC or version != EVENT_LOG_VERSION or not count or \
+                        (end is not None and self._time_at(segment, 0) > end) or \
+                        (start is not None and self._time_at(segment, count - 1) < start):
+                    continue
+                strings = self._read_strings(number)   # after the count, the strings are always written first
+                index = self._first_at(segment, count, start) if start is not None else 0
+                for offset in range(EVENT_LOG_HEADER.size + index * EVENT_LOG_RECORD.size,
+                                    EVENT_LOG_HEADER.size + count * EVENT_LOG_RECORD.size, EVENT_LOG_RECORD.size):
+                    timestamp, kind, flag, key, detail, value = EVENT_LOG_RECORD.unpack_from(segment, offset)
+                    if end is not None and timestamp > end:
+                        return
+                    if kind_codes is None or kind in kind_codes:
+                        yield timestamp, EVENT_LOG_KINDS[kind], self._text(strings, key), self._text(strings, detail), value, flag
+
+    def _wait_for_previous(self):
+        if self._previous:
+            self._previous.wait(EVENT_LOG_HANDOFF)
+            self._previous = None
+
+    def _strings_path(self, number):
+        return os.path.join(self.folder, f"strings-{number:06d}.txt")
+
+    def _read_strings(self, number):
+        try:
+            with open(self._strings_path(number), encoding="utf-8") as f:
+                return [line.rstrip("\n") for line in f]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _clean(text):
+        return "" if text is None else str(text).replace("\n", " ")
+
+    def _intern(self, text, new_strings):
+        string_id = self._string_ids.get(text)
+        if string_id is None:
+            string_id = self._string_ids[text] = len(self._strings)
+            self._strings.append(text)
+            new_strings.append(text)
+        return string_id
+
+    @staticmethod
+    def _text(strings, string_id):
+        return strings[string_id] if string_id < len(strings) else "?"
+
+    @staticmethod
+    def _int16(value):
+        try:
+            return max(-0x8000, min(0x7FFF, int(value)))
+        except (TypeError, ValueError):
+            return -1
+
+    def _segment_path(self, number):
+        return os.path.join(self.folder, f"events-{number:06d}.bin")
+
+    def _segment_numbers(self):
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[7:13]) for name in names if re.fullmatch(r"events-\d{6}\.bin", name))
+
+    def _writable_segment(self, new_strings, needed_strings):
+        # the segment being written, opening the latest one or starting a new one when its records or its string
+        # table are full
+        if self._segment is None:
+            os.makedirs(self.folder, exist_ok=True)
+            numbers = self._segment_numbers()
+            if numbers:
+                self._segment = self._open_segment(numbers[-1])
+        if self._segment is None or self._segment[3] >= EVENT_LOG_SEGMENT_RECORDS or \
+                len(self._strings) + needed_strings > EVENT_LOG_STRINGS:
+            number = self._segment[0] + 1 if self._segment else 1
+            if self._segment:
+                self._finish_segment(new_strings)
+                self._segment[2].close()
+                self._segment[1].close()
+            with open(self._segment_path(number), "wb") as f:
+                f.truncate(EVENT_LOG_HEADER.size + EVENT_LOG_SEGMENT_RECORDS * EVENT_LOG_RECORD.size)
+            self._segment = self._open_segment(number)
+            self._rotate(number)
+        return self._segment
+
+    def _finish_segment(self, new_strings):
+        # strings first, so a record never points past the end of its table
+        number, file, segment, count = self._segment
+        if new_strings:
+            with open(self._strings_path(number), "a", encoding="utf-8") as f:
+                f.write("".join(f"{text}\n" for text in new_strings))
+            new_strings.clear()
+        EVENT_LOG_HEADER.pack_into(segment, 0, EVENT_LOG_MAGIC, EVENT_LOG_VERSION, EVENT_LOG_RECORD.size, count)
+        segment.flush()
+
+    def _open_segment(self, number):
+        file = open(self._segment_path(number), "r+b")
+        segment = mmap.mmap(file.fileno(), 0)
+        magic, version, record_size, count = EVENT_LOG_HEADER.unpack_from(segment, 0)
+        if magic != EVENT_LOG_MAGIC or version != EVENT_LOG_VERSION:    # new, or not ours: start it over
+            count = 0
+            if os.path.exists(self._strings_path(number)):
+                os.remove(self._strings_path(number))
+        self._strings = self._read_strings(number)
+        self._string_ids = {text: n for n, text in enumerate(self._strings)}
+        return number, file, segment, count
+
+    def _rotate(self, newest):
+        segment_bytes = EVENT_LOG_HEADER.size + EVENT_LOG_SEGMENT_RECORDS * EVENT_LOG_RECORD.size
+        keep = max(2, self.max_bytes // segment_bytes)
+        for number in self._segment_numbers():
+            if number <= newest - keep:
+                os.remove(self._segment_path(number))
+                if os.path.exists(self._strings_path(number)):
+                    os.remove(self._strings_path(number))
+
+    @staticmethod
+    def _time_at(segment, index):
+        return EVENT_LOG_RECORD.unpack_from(segment, EVENT_LOG_HEADER.size + index * EVENT_LOG_RECORD.size)[0]
+
+    def _first_at(self, segment, count, start):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._time_at(segment, middle) < start:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class PipelineStats(object):
+    """
+    Counters for one MessagePipeline worker.  Lag is the time a message waited in the queue before being handled.
+    """
+
+    def __init__(self):
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failures = 0
+        self.max_depth = 0
+        self.busy = 0.0
+        self.lag = LatencyHistogram()
+        self.last_warning = 0.0
+
+    def __str__(self):
+        return (f"{self.enqueued} queued, {self.processed} handled, {self.dropped} dropped, {self.failures} failed, "
+                f"max depth {self.max_depth}, busy {self.busy:.1f} s, lag {self.lag.summary()}")
+
+
+class MessagePipeline(object):
+    """
+    Hands hub messages from the event loop to worker threads that make the blocking Indigo server calls, so a slow
+    server can't stall the hub connections.  Each hub always goes to the same worker, which keeps its messages in
+    order.  The queues are bounded; when one is full the overflow policy drops either the oldest queued message
+    ("dropOldest") or the new one ("dropNewest").
+    """
+
+    def __init__(self, handler, logger, workers=2, queue_size=1000, overflow="dropOldest"):
+        self.handler = handler
+        self.logger = logger
+        self.overflow = overflow
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self.stats = [PipelineStats() for _ in self.queues]
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for n in range(len(self.queues)):
+            thread = threading.Thread(target=self._run_worker, args=(n,), name=f"HarmonyEvents-{n}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # anything still queued is discarded, the workers only finish the message they are handling
+        self.running = False
+        for q in self.queues:
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(timeout=PIPELINE_STOP_TIMEOUT)
+        self.threads = []
+
+    def submit(self, hub_id, message):
+        # called on the event loop, never blocks.  Only the loop thread submits, so after taking one message out of
+        # a full queue there is always room for the new one.
+        n = hub_id % len(self.queues)
+        q, stats = self.queues[n], self.stats[n]
+        item = (time.monotonic(), message)
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            stats.dropped += 1
+            self._warn_overflow(n, stats)
+            if self.overflow == "dropNewest":
+                return False
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+            q.put_nowait(item)
+        stats.enqueued += 1
+        stats.max_depth = max(stats.max_depth, q.qsize())
+        return True
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _warn_overflow(self, n, stats):
+        now = time.monotonic()
+        if now - stats.last_warning >= PIPELINE_WARN_INTERVAL:
+            stats.last_warning = now
+            self.logger.warning(f"Hub event queue {n} is full, Indigo server is not keeping up ({stats.dropped} events dropped so far)")
+
+    def _run_worker(self, n):
+        q, stats = self.queues[n], self.stats[n]
+        while self.running:
+            item = q.get()
+            if item is None or not self.running:
+                break
+            queued, message = item
+            started = time.monotonic()
+            stats.lag.record(started - queued)
+            try:
+                self.handler(message)
+            except Exception as e:
+                stats.failures += 1
+                self.logger.error(f"Error handling hub event {message.get('type')}: {type(e).__name__}: {e}")
+            stats.processed += 1
+            stats.busy += time.monotonic() - started
+
+
+class CommandSuperseded(Exception):
+    """
+    Raised to the caller of a queued command that was dropped before it was sent, by an activity change or because
+    the hub is stopping.  Unlike a CancelledError it doesn't mean the caller itself was cancelled.
+    """
+
+
+class HubCommandQueue(object):
+    """
+    Sends one hub's commands one at a time, highest priority class first and in arrival order within a class.
+    Commands to the same Harmony device are spaced at least its minimum spacing apart, and a new activity change
+    supersedes everything still queued: those callers get CommandSuperseded.  Runs on the event loop.
+    """
+    ACTIVITY = 0        # start activity / power off
+    NAVIGATION = 1      # everything else
+    REPEAT = 2          # volume and channel ramps
+
+    def __init__(self, name, spacing=0.0, device_spacing=None):
+        self.name = name
+        self.spacing = spacing                      # seconds between commands to one Harmony device
+        self.device_spacing = device_spacing or {}  # Harmony device id -> seconds, overrides spacing
+        self.superseded = 0
+        self.max_depth = 0
+        self._heap = []                 # (priority, sequence number, target device, coroutine factory, future)
+        self._sequence = itertools.count()
+        self._last_sent = dict()        # Harmony device id -> loop time its last command was sent
+        self._wakeup = asyncio.Event()
+        self._worker = None
+
+    @property
+    def depth(self):
+        return len(self._heap)
+
+    async def run(self, priority, target, coro_factory, supersede=False):
+        """
+        Queue coro_factory() and return its result once it has run.  target is the Harmony device id used for
+        spacing, or None.  Cancelling the caller removes the command from the queue, or cancels it if it is running.
+        Raises CommandSuperseded if the command is dropped from the queue before it runs.
+        """
+        if supersede:
+            self._supersede()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._heap, (priority, next(self._sequence), target, coro_factory, future))
+        self.max_depth = max(self.max_depth, len(self._heap))
+        self._wakeup.set()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run_worker())
+        return await future
+
+    def stop(self):
+        if self._worker:
+            self._worker.cancel()
+        self._supersede("dropped, the hub is stopping")
+
+    def _supersede(self, reason="superseded by an activity change"):
+        for priority, sequence, target, coro_factory, future in self._heap:
+            if not future.done():
+                future.set_exception(CommandSuperseded(reason))
+                self.superseded += 1
+        self._heap = []
+
+    def _spacing_for(self, target):
+        return self.device_spacing.get(target, self.spacing)
+
+    def _next_ready(self, now):
+        # the first queued command whose target device isn't inside its spacing, else the time one will be
+        self._heap = [item for item in self._heap if not item[4].done()]
+        heapq.heapify(self._heap)
+        ready_at = None
+        for item in sorted(self._heap):
+            target = item[2]
+            due = self._last_sent.get(target, 0.0) + self._spacing_for(target) if target is not None else now
+            if due <= now:
+                self._heap.remove(item)
+                heapq.heapify(self._heap)
+                return item, None
+            ready_at = due if ready_at is None else min(ready_at, due)
+        return None, ready_at
+
+    async def _run_worker(self):
+        loop = asyncio.get_running_loop()
+        while self._heap:
+            item, ready_at = self._next_ready(loop.time())
+            if item is None:
+                if ready_at is None:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), ready_at - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, sequence, target, coro_factory, future = item
+            if target is not None:
+                self._last_sent[target] = loop.time()
+            task = loop.create_task(coro_factory())
+            future.add_done_callback(lambda f, t=task: t.cancel() if f.cancelled() else None)
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                task.cancel()
+                if not future.done():   # stopped mid-command, the caller must not wait forever
+                    future.cancel()
+                raise
+            if future.done():
+                continue
+            if task.cancelled():
+                future.cancel()
+            elif task.exception():
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+
+class HubSession(object):
+    """
+    Everything the plugin keeps for one started hub device, from deviceStartComm to deviceStopComm: the supervisor
+    and any other tasks working for the hub, the current client and its Listener, the command queue, the hub's
+    config and command index, its metrics, trace and event history, and the automatic protocol choice.  Sessions
+    are kept by Indigo device id and close() tears all of it down together, so a changed address or a quick disable
+    and enable can't leave a client, handler or stale state behind.  Callbacks that can outlive the session, like
+    an old client's, check that it is still the device's session before writing anything.
+    """
+
+    def __init__(self, device, command_queue, logger, close_client, trace_size=0):
+        self.device = device
+        self.command_queue = command_queue
+        self.logger = logger
+        self.close_client = close_client    # coroutine function(device, client), see Plugin._async_close_client
+        self.supervisor = None          # Task running Plugin._async_supervise_hub
+        self.client = None              # HarmonyAPI while connected
+        self.listener = None            # Listener registered with client
+        self.sequence = None            # Task sending a command sequence
+        self.cancelled_sequence = None  # sequence Task cancelled on purpose, by a replace or Cancel Command Sequence
+        self.tasks = set()              # other Tasks for the hub, e.g. actions held while it was offline
+        self.wakeup = asyncio.Event()   # makes the health check run at once
+        self.reconnects = 0
+        self.started = time.time()
+        self.connected = None           # time.time() of the current connection
+        self.closed = False
+
+        self.config = None              # last config seen, live or from the on-disk cache
+        self.index = None               # HubIndex built from config (command lookups and ConfigUI menus)
+        self.metrics = HubMetrics()
+        self.trace = TraceBuffer(trace_size) if trace_size > 0 else None
+        self.event_log = None           # HubEventLog while the event history is on
+        self.offline_actions = None     # deque of (queued time, coroutine factory) held for the reconnect
+        self.pending_activity = None    # activity shown optimistically, see Plugin._activity_pending
+        self.pending_automation = None  # automation message being coalesced
+        self.automation_states = None   # {state id prefix: automation device} for custom states
+        self.remote_id = None           # hub id reported by the hub on connect
+        self.protocol = None            # transport in use, or chosen for the next connect
+        self.protocol_checked = None    # time.time() of the last automatic evaluation, None before the first connect
+        self.protocol_error_base = (0, 0)   # (commands, failures) at the last evaluation
+        self.last_rediscovery = -REDISCOVER_INTERVAL    # time.monotonic() of the last scan for it at another address
+
+    def track(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def live_tasks(self):
+        return [task for task in (self.supervisor, self.sequence, *self.tasks) if task and not task.done()]
+
+    def close_event_log(self):
+        event_log, self.event_log = self.event_log, None
+        if event_log:
+            try:
+                event_log.close()
+            except OSError as e:
+                self.logger.warning(f"{self.device.name}: Unable to write event history: {e}")
+
+    async def release_client(self):
+        # the client and its listener go together.  The client is only dropped once closed, so if this is cancelled
+        # part way close() still finds it and closes it again.
+        client = self.client
+        if not client:
+            return
+        self.connected = None
+        if self.listener:
+            self.listener.unregister(client)
+            self.listener = None
+        await self.close_client(self.device, client)
+        if self.client is client:
+            self.client = None
+
+    async def close(self):
+        # On the event loop.  The event history is written and closed in an executor; a session started again for
+        # the device opens a new HubEventLog, which waits for this one to close before writing.
+        self.closed = True
+        event_log_closed = asyncio.get_running_loop().run_in_executor(None, self.close_event_log)
+        self.offline_actions = self.pending_activity = self.pending_automation = None
+        tasks = self.live_tasks()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.supervisor = self.sequence = self.cancelled_sequence = None  # a cancelled task's traceback still holds its frames, and the client
+        self.command_queue.stop()
+        await self.release_client()
+        await event_log_closed
+
+
+class HubStateStore(object):
+    """
+    The hub states the plugin writes to Indigo, kept in memory for the StateServer while it runs.  Written from the
+    event loop and the pipeline workers.  Every change gets the next version number; waiters on the loop are only
+    woken while someone is actually waiting.  States are updated in place under the lock and copied by snapshot(),
+    as the server reads much less often than the hubs write.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop                    # the event loop the StateServer runs on
+        self.version = 0
+        self.watchers = 0
+        self._lock = threading.Lock()
+        self._hubs = dict()                 # hub device id -> [version, state dict]
+        self._changes = deque(maxlen=STATE_HISTORY)     # (version, hub device id, changed states)
+        self._changed = asyncio.Event()     # replaced after each wake, only used on the loop
+
+    def update(self, hub_id, values):
+        with self._lock:
+            hub = self._hubs.get(hub_id) or self._hubs.setdefault(hub_id, [0, {}])
+            state = hub[1]
+            changed = {key: value for key, value in values.items() if key not in state or state[key] != value}
+            if changed:
+                state.update(changed)
+                self._record(hub, hub_id, changed)
+
+    def merge(self, hub_id, key, values):
+        # update the dict held in one state, e.g. the automation devices seen so far.  The dict is replaced rather
+        # than changed, snapshots taken earlier may still be reading it.
+        with self._lock:
+            hub = self._hubs.get(hub_id) or self._hubs.setdefault(hub_id, [0, {}])
+            current = hub[1].get(key) or {}
+            changed = {name: value for name, value in values.items() if name not in current or current[name] != value}
+            if changed:
+                hub[1][key] = dict(current, **changed)
+                self._record(hub, hub_id, {key: changed})
+
+    def _record(self, hub, hub_id, changed):
+        # with the lock held
+        self.version += 1
+        hub[0] = self.version
+        self._changes.append((self.version, hub_id, changed))
+        if self.watchers:
+            self.loop.call_soon_threadsafe(self.wake)
+
+    def clear(self):
+        with self._lock:
+            self._hubs.clear()
+            self._changes.clear()
+
+    def remove(self, hub_id):
+        with self._lock:
+            if self._hubs.pop(hub_id, None) is None:
+                return
+            self._record([0, None], hub_id, None)
+
+    def snapshot(self, hub_id=None):
+        # (version, state) for one hub, or (store version, {hub id: state}) for all of them
+        with self._lock:
+            if hub_id is None:
+                return self.version, {hub: dict(state) for hub, (version, state) in self._hubs.items()}
+            version, state = self._hubs.get(hub_id, (None, None))
+            return version, dict(state) if state is not None else None
+
+    def changes_since(self, version):
+        # the changes after version, oldest first, or None if some have already been dropped from the history
+        with self._lock:
+            if self._changes and self._changes[0][0] > version + 1:
+                return None
+            return [change for change in self._changes if change[0] > version]
+
+    def wake(self):
+        # on the loop: wake everything waiting in wait()
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, changed, timeout):
+        # on the loop: until changed() is true after a change, or timeout.  Returns changed().
+        deadline = self.loop.time() + timeout
+        self.watchers += 1
+        try:
+            while not changed():
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            self.watchers -= 1
+        return changed()
+
+
+class StateServer(object):
+    """
+    Read-only HTTP access to the HubStateStore and the hubs' catalogs, on the plugin's event loop and bound to
+    localhost only.
+
+        GET /hubs                   every hub's state
+        GET /hubs/{id}              one hub's state; with If-None-Match, ?wait=seconds holds the request until it changes
+        GET /hubs/{id}/catalog      the hub's activities and devices with their command groups and commands
+        GET /events                 server-sent events, one for each state change
+
+    Every response carries an ETag, a matching If-None-Match gets 304 Not Modified.
+    """
+
+    def __init__(self, store, catalog, logger):
+        self.store = store
+        self.catalog = catalog              # hub device id -> (etag, catalog dict), or None
+        self.logger = logger
+        self._runner = None
+        self._closing = False
+        self._catalog_bodies = dict()       # hub device id -> (etag, encoded catalog)
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_get("/hubs", self._get_hubs)
+        app.router.add_get("/hubs/{hub_id:\\d+}", self._get_hub)
+        app.router.add_get("/hubs/{hub_id:\\d+}/catalog", self._get_catalog)
+        app.router.add_get("/events", self._get_events)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, STATE_SERVER_HOST, port).start()
+        self._closing = False
+
+    async def stop(self):
+        # open long-polls and event streams are woken up so they finish before the runner waits for them
+        self._closing = True
+        self.store.wake()
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @staticmethod
+    def _respond(request, body, etag):
+        etag = f'"{etag}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    @staticmethod
+    def _encode(data):
+        return json.dumps(data, default=str).encode("utf-8")
+
+    async def _get_hubs(self, request):
+        version, hubs = self.store.snapshot()
+        return self._respond(request, self._encode({"version": version, "hubs": hubs}), version)
+
+    async def _get_hub(self, request):
+        hub_id = int(request.match_info["hub_id"])
+        version, state = self.store.snapshot(hub_id)
+        if state is None:
+            raise web.HTTPNotFound()
+        try:
+            wait = min(float(request.query.get("wait", 0)), STATE_LONG_POLL_MAX)
+        except ValueError:
+            raise web.HTTPBadRequest(text="wait must be a number of seconds")
+        if wait > 0 and request.headers.get("If-None-Match") == f'"{version}"':
+            await self.store.wait(lambda: self._closing or self.store.snapshot(hub_id)[0] != version, wait)
+            version, state = self.store.snapshot(hub_id)
+            if state is None:
+                raise web.HTTPNotFound()
+        return self._respond(request, self._encode({"hub": hub_id, "version": version, "state": state}), version)
+
+    async def _get_catalog(self, request):
+        hub_id = int(request.match_info["hub_id"])
+        catalog = self.catalog(hub_id)
+        if catalog is None:
+            raise web.HTTPNotFound()
+        etag, data = catalog
+        cached = self._catalog_bodies.get(hub_id)
+        if not cached or cached[0] != etag:
+            cached = self._catalog_bodies[hub_id] = (etag, self._encode(data))
+        return self._respond(request, cached[1], etag)
+
+    async def _get_events(self, request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        last_id = request.headers.get("Last-Event-ID", "")
+        version = int(last_id) if last_id.isdigit() else None
+        try:
+            while not self._closing:
+                changes = self.store.changes_since(version) if version is not None else None
+                if changes is None:
+                    # a new stream, or one that missed changes: start with every hub's full state
+                    version, hubs = self.store.snapshot()
+                    for hub_id, state in hubs.items():
+                        await self._send_event(response, version, "state", {"hub": hub_id, "state": state})
+                elif changes:
+                    for change_version, hub_id, changed in changes:
+                        await self._send_event(response, change_version, "change" if changed is not None else "removed",
+                                               {"hub": hub_id, "changes": changed})
+                    version = changes[-1][0]
+                elif not await self.store.wait(lambda: self._closing or self.store.version != version, STATE_KEEPALIVE):
+                    await response.write(b": keepalive\n\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
+
+    async def _send_event(self, response, version, event, data):
+        await response.write(f"id: {version}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode("utf-8"))
+
+
 ################################################################################
 class Plugin(indigo.PluginBase):
 
@@ -44,14 +1275,74 @@ class Plugin(indigo.PluginBase):
         self.indigo_log_handler.setLevel(self.logLevel)
         self.logger.debug(f"logLevel = {self.logLevel}")
         self.protocol = pluginPrefs.get("protocol", WEBSOCKETS)
+        self.offlinePolicy = pluginPrefs.get("offlinePolicy", "reject")
+        self.offlineBufferSize = self._numeric_pref(pluginPrefs, "offlineBufferSize")
+        self.offlineBufferAge = self._numeric_pref(pluginPrefs, "offlineBufferAge")
+        self.maxConcurrentConnects = self._numeric_pref(pluginPrefs, "maxConcurrentConnects")
+        self.eventWorkers = self._numeric_pref(pluginPrefs, "eventWorkers")
+        self.eventQueueSize = self._numeric_pref(pluginPrefs, "eventQueueSize")
+        self.eventOverflowPolicy = pluginPrefs.get("eventOverflowPolicy", "dropOldest")
+        self.automationWindow = self._numeric_pref(pluginPrefs, "automationWindow")
+        self.automationStorage = pluginPrefs.get("automationStorage", "last")
+        self.commandSpacing = self._numeric_pref(pluginPrefs, "commandSpacing")
+        self.discoverySubnet = pluginPrefs.get("discoverySubnet", "")
+        self.optimisticActivity = bool(pluginPrefs.get("optimisticActivity", False))
+        self.optimisticTimeout = self._numeric_pref(pluginPrefs, "optimisticTimeout")
+        self.traceSize = self._numeric_pref(pluginPrefs, "traceSize")
+        self.stateServer = bool(pluginPrefs.get("stateServer", False))
+        self.stateServerPort = self._numeric_pref(pluginPrefs, "stateServerPort")
+        self.eventLog = bool(pluginPrefs.get("eventLog", True))
+        self.eventLogSize = self._numeric_pref(pluginPrefs, "eventLogSize")
 
         self.hub_devices = dict()
-        self.activity_devices = dict()
+        self.activity_devices = dict()          # hub device id -> {activity device id: activity id}
+        self.activity_device_states = dict()    # activity device id -> last onOffState written
         self.triggers = {}
+        self.trigger_index = {}         # (hubID, eventType) -> {filter value or "": {trigger id: trigger}}
 
-        self._async_running_clients = dict()
+        self._sessions = dict()         # hub device id -> HubSession, only added and removed on Indigo's thread
+        self.cache_folder = f"{indigo.server.getInstallFolderPath()}/Preferences/Plugins/{pluginId}"
         self._event_loop = None
         self._async_thread = None
+        self._stop_event = None         # set from Indigo's thread to shut the event loop down
+        self._connect_semaphore = None  # bounds how many hubs handshake at once
+        self.dispatch_stats = dict()    # coroutine name -> DispatchStats
+        self._message_pipeline = None   # hub messages from the event loop to the Indigo-side workers
+        self._automation_variables = dict()     # (hub device id, automation device) -> variable id
+        self._missing_activities = set()    # activity device ids whose activity is no longer in the hub's config
+        self._discovered_hubs = dict()      # address -> (hub id, name) from the last Find Hubs in a hub's ConfigUI
+        self._pending_devices = set()       # activity device ids with their pending state set
+        self._activity_tokens = itertools.count(1)
+        self._plugin_trace = self._new_trace()  # events that don't belong to one hub, see _trace
+        self._state_store = HubStateStore()
+        self._state_server = None           # StateServer while it's running
+        self._missing_internals = set()     # aioharmony internals already warned about, see _async_harmony_internal
+
+    def validatePrefsConfigUi(self, valuesDict):
+        errorDict = indigo.Dict()
+        for key, (kind, default, minimum, maximum) in NUMERIC_PREFS.items():
+            try:
+                value = kind(valuesDict.get(key, default))
+            except (TypeError, ValueError):
+                errorDict[key] = "Must be a whole number" if kind is int else "Must be a number"
+                continue
+            if not minimum <= value <= maximum:
+                errorDict[key] = f"Must be from {minimum} to {maximum}"
+        if len(errorDict) > 0:
+            return False, valuesDict, errorDict
+        return True, valuesDict
+
+    @staticmethod
+    def _numeric_pref(values, key):
+        # prefs saved before validatePrefsConfigUi checked them can still be out of range or not numbers
+        kind, default, minimum, maximum = NUMERIC_PREFS[key]
+        try:
+            value = kind(values.get(key, default))
+        except (TypeError, ValueError):
+            return kind(default)
+        if math.isnan(value):
+            return kind(default)
+        return min(max(value, kind(minimum)), kind(maximum))
 
     def closedPrefsConfigUi(self, valuesDict, userCancelled):
         if not userCancelled:
@@ -59,28 +1350,100 @@ class Plugin(indigo.PluginBase):
             self.indigo_log_handler.setLevel(self.logLevel)
             self.logger.debug(f"logLevel = {self.logLevel}")
             if valuesDict['protocol'] != self.protocol:
-                self.logger.warning("Protocol change requires plugin restart!")
+                # hubs using the plugin's setting reconnect with the new one
+                self.protocol = valuesDict['protocol']
+                self._event_loop.call_soon_threadsafe(self._wake_monitors)
+            self.offlinePolicy = valuesDict.get("offlinePolicy", "reject")
+            self.offlineBufferSize = self._numeric_pref(valuesDict, "offlineBufferSize")
+            self.offlineBufferAge = self._numeric_pref(valuesDict, "offlineBufferAge")
+            self.maxConcurrentConnects = self._numeric_pref(valuesDict, "maxConcurrentConnects")
+            self._connect_semaphore = asyncio.Semaphore(max(1, self.maxConcurrentConnects))
+            if self._numeric_pref(valuesDict, "eventWorkers") != self.eventWorkers or self._numeric_pref(valuesDict, "eventQueueSize") != self.eventQueueSize:
+                self.logger.warning("Event worker and queue size changes require plugin restart!")
+            self.eventOverflowPolicy = valuesDict.get("eventOverflowPolicy", "dropOldest")
+            if self._message_pipeline:
+                self._message_pipeline.overflow = self.eventOverflowPolicy
+            self.automationWindow = self._numeric_pref(valuesDict, "automationWindow")
+            self.automationStorage = valuesDict.get("automationStorage", "last")
+            self.commandSpacing = self._numeric_pref(valuesDict, "commandSpacing")
+            self.discoverySubnet = valuesDict.get("discoverySubnet", "")
+            self.optimisticActivity = bool(valuesDict.get("optimisticActivity", False))
+            self.optimisticTimeout = self._numeric_pref(valuesDict, "optimisticTimeout")
+            if self._numeric_pref(valuesDict, "traceSize") != self.traceSize:
+                self.traceSize = self._numeric_pref(valuesDict, "traceSize")
+                self._plugin_trace = self._new_trace()  # started over at the new size
+                for session in list(self._sessions.values()):
+                    session.trace = self._new_trace()
+            stateServer = bool(valuesDict.get("stateServer", False))
+            stateServerPort = self._numeric_pref(valuesDict, "stateServerPort")
+            if (stateServer, stateServerPort) != (self.stateServer, self.stateServerPort):
+                self.stateServer, self.stateServerPort = stateServer, stateServerPort
+                self.dispatch(self._async_restart_state_server())
+            self.eventLogSize = self._numeric_pref(valuesDict, "eventLogSize")
+            if bool(valuesDict.get("eventLog", True)) != self.eventLog:
+                self.eventLog = bool(valuesDict.get("eventLog", True))
+                for session in list(self._sessions.values()):
+                    if self.eventLog:
+                        self._open_event_log(session)
+                    else:
+                        session.close_event_log()
+            for hub_id, session in list(self._sessions.items()):
+                if session.event_log:
+                    session.event_log.max_bytes = self.eventLogSize * 1024 * 1024
+                hub_device = self.hub_devices.get(hub_id)
+                if hub_device:
+                    session.command_queue.spacing, session.command_queue.device_spacing = self._command_spacing(hub_device)
 
     def startup(self):
         self.logger.info(f"Harmony Hub starting")
 
+        self._message_pipeline = MessagePipeline(self.message_handler, self.logger, workers=self.eventWorkers,
+                                                 queue_size=self.eventQueueSize, overflow=self.eventOverflowPolicy)
+        self._message_pipeline.start()
+
         # async thread is used instead of concurrent thread
         self._event_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self._event_loop)
+        self._stop_event = asyncio.Event()
+        self._state_store.loop = self._event_loop
+        self._connect_semaphore = asyncio.Semaphore(max(1, self.maxConcurrentConnects))
         self._async_thread = threading.Thread(target=self._run_async_thread)
         self._async_thread.start()
 
     def shutdown(self):  # noqa
         self.logger.info(f"Harmony Hub stopping")
+        self._request_async_stop()
+        self._async_thread.join(timeout=15)
+        self._message_pipeline.stop()
+
+    def stopConcurrentThread(self):
+        indigo.PluginBase.stopConcurrentThread(self)
+        self._request_async_stop()
+
+    def _request_async_stop(self):
+        if self._event_loop and not self._event_loop.is_closed():
+            try:
+                self._event_loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:    # loop closed in the meantime
+                pass
 
     def deviceStartComm(self, device):
         self.logger.debug(f"{device.name}: Starting {device.deviceTypeId} device ({device.id})")
 
         if device.deviceTypeId == "harmonyHub":
-            self._event_loop.create_task(self._async_start_device(device))
+            spacing, device_spacing = self._command_spacing(device)
+            session = HubSession(device, HubCommandQueue(device.name, spacing, device_spacing), self.logger,
+                                 self._async_close_client, self.traceSize)
+            self._sessions[device.id] = session
+            self._known_automation_states(device)
+            self._load_hub_cache(session)
+            if self._state_server:
+                self._seed_state_store(device)
+            self.dispatch(self._async_start_device(session))
             self.hub_devices[device.id] = device
         elif device.deviceTypeId == "activityDevice":
-            self.activity_devices[device.id] = device.pluginProps['activity']
+            self.activity_devices.setdefault(int(device.pluginProps['hubID']), {})[device.id] = device.pluginProps['activity']
+            self.activity_device_states[device.id] = device.onState
 
         else:
             self.logger.error(f"{device.name}: deviceStartComm - Unknown device type: {device.deviceTypeId}")
@@ -89,39 +1452,95 @@ class Plugin(indigo.PluginBase):
         self.logger.debug(f"{device.name}: Stopping")
 
         if device.deviceTypeId == "harmonyHub":
-            self._event_loop.create_task(self._async_stop_device(device.address))
+            # taken out here rather than on the event loop, so a device started again straight away gets a new
+            # session that the old one's teardown can't touch
+            session = self._sessions.pop(device.id, None)
+            if session:
+                self.dispatch(self._async_stop_device(session))
             self.hub_devices.pop(device.id, None)
+            self._state_store.remove(device.id)
         elif device.deviceTypeId == "activityDevice":
-            self.activity_devices.pop(device.id, None)
+            for hub_activity_devices in self.activity_devices.values():
+                hub_activity_devices.pop(device.id, None)
+            self.activity_device_states.pop(device.id, None)
+            self._missing_activities.discard(device.id)
         else:
             self.logger.error(f"{device.name}: deviceStopComm - Unknown device type: {device.deviceTypeId}")
 
+    def didDeviceCommPropertyChange(self, origDev, newDev):
+        # the hub id and name, and the automatic protocol choice, are recorded once connected and don't need a reconnect
+        ignored = ("hubId", "hubName", "autoProtocol", "autoProtocolChecked")
+        keys = (set(origDev.pluginProps) | set(newDev.pluginProps)) - set(ignored)
+        return any(origDev.pluginProps.get(key) != newDev.pluginProps.get(key) for key in keys)
+
+    def getDeviceStateList(self, device):
+        # hub devices get an on/brightness/status state for each automation device seen, when enabled
+        state_list = indigo.PluginBase.getDeviceStateList(self, device)
+        if device.deviceTypeId == "harmonyHub":
+            for prefix, key in sorted(list(self._known_automation_states(device).items())):
+                state_list.append(self.getDeviceStateDictForBoolOnOffType(f"{prefix}_on", f"{key} On", f"{key} On"))
+                state_list.append(self.getDeviceStateDictForNumberType(f"{prefix}_brightness", f"{key} Brightness", f"{key} Brightness"))
+                state_list.append(self.getDeviceStateDictForStringType(f"{prefix}_status", f"{key} Status", f"{key} Status"))
+        return state_list
+
     ####################
 
+    # Events.xml filter field checked through the index for each event type.  Triggers with no filter (or "any")
+    # are stored under "" and match every event of that type.
+
+    trigger_filter_fields = {
+        "activityFinishedNotification": "activity",
+        "activityNotification": "activity",
+        "automationNotification": "automationDevice",
+    }
+
+    @staticmethod
+    def _trigger_filter_value(trigger, field):
+        value = trigger.pluginProps.get(field, "").strip()
+        return "" if value == "any" else value
+
+    def _trigger_index_key(self, trigger):
+        filter_value = self._trigger_filter_value(trigger, self.trigger_filter_fields.get(trigger.pluginTypeId, ""))
+        return (trigger.pluginProps["hubID"], trigger.pluginTypeId), filter_value
+
     def triggerStartProcessing(self, trigger):
         self.logger.debug(f"Adding Trigger {trigger.name} ({trigger.id}) - {trigger.pluginTypeId}")
         assert trigger.id not in self.triggers
         self.triggers[trigger.id] = trigger
+        key, filter_value = self._trigger_index_key(trigger)
+        self.trigger_index.setdefault(key, {}).setdefault(filter_value, {})[trigger.id] = trigger
 
     def triggerStopProcessing(self, trigger):
         self.logger.debug(f"Removing Trigger {trigger.name} ({trigger.id})")
         assert trigger.id in self.triggers
-        del self.triggers[trigger.id]
+        trigger = self.triggers.pop(trigger.id)
+        key, filter_value = self._trigger_index_key(trigger)
+        by_filter = self.trigger_index.get(key, {})
+        by_filter.get(filter_value, {}).pop(trigger.id, None)
+        if not by_filter.get(filter_value):
+            by_filter.pop(filter_value, None)
+        if not by_filter:
+            self.trigger_index.pop(key, None)
 
-    def triggerCheck(self, device, eventType):
+    def triggerCheck(self, device, eventType, match=None, status=None):
 
-        # Execute the trigger if it's the right type and for the right hub device
+        # Execute the triggers registered for this hub device and event type whose filters match the event
 
-        for triggerId, trigger in sorted(self.triggers.items()):
-            self.logger.threaddebug(f"\tChecking Trigger {trigger.name} ({trigger.id}), Type: {trigger.pluginTypeId}")
-            if trigger.pluginProps["hubID"] != str(device.id):
-                self.logger.threaddebug(f"\t\tSkipping Trigger {trigger.name} ({trigger.id}), wrong hub: {device.id}")
-            else:
-                if trigger.pluginTypeId != eventType:
-                    self.logger.threaddebug(f"\t\tSkipping Trigger {trigger.name} ({trigger.id}), wrong type: {eventType}")
-                else:
-                    self.logger.threaddebug(f"\t\tExecuting Trigger {trigger.name} ({trigger.id}) on Device {device.name} ({device.id})")
-                    indigo.trigger.execute(trigger)
+        by_filter = self.trigger_index.get((str(device.id), eventType))
+        if not by_filter:
+            return
+
+        candidates = list(by_filter.get("", {}).values())
+        if match is not None:
+            candidates.extend(by_filter.get(str(match), {}).values())
+
+        for trigger in candidates:
+            status_filter = self._trigger_filter_value(trigger, "status")
+            if status_filter and status_filter != str(status):
+                self._trace(device.id, "triggerSkipped", trigger.id, eventType, match, status)
+                continue
+            self._trace(device.id, "trigger", trigger.id, eventType, match, status)
+            indigo.trigger.execute(trigger)
 
     ########################################
 
@@ -149,61 +1568,59 @@ class Plugin(indigo.PluginBase):
     # Plugin Actions object callbacks
     ########################################
 
+    # Actions are fire-and-forget by default.  Scripts can wait for the hub's response by passing "wait": True
+    # (and optionally "timeout": seconds) in the action props, and get the result back from executeAction().
+
+    @staticmethod
+    def _action_wait(props):
+        wait = str(props.get("wait", False)).lower() in ("true", "1", "yes")
+        return wait, float(props.get("timeout", DISPATCH_TIMEOUT))
+
     def startActivity(self, pluginAction):
-        self.doActivity(pluginAction.deviceId, pluginAction.props["activity"])
+        wait, timeout = self._action_wait(pluginAction.props)
+        return self.doActivity(pluginAction.deviceId, pluginAction.props["activity"], wait=wait, timeout=timeout)
 
     def powerOff(self, pluginAction):
-        self.doActivity(pluginAction.deviceId, "-1")
-
-    def doActivity(self, deviceId, activityID):
-        self.logger.debug(f"Sending activity {activityID} to hub device {deviceId}")
-        client = self._async_running_clients[self.hub_devices[int(deviceId)].address]
-        self._event_loop.create_task(self.start_activity(client, int(activityID)))
+        wait, timeout = self._action_wait(pluginAction.props)
+        return self.doActivity(pluginAction.deviceId, "-1", wait=wait, timeout=timeout)
+
+    def doActivity(self, deviceId, activityID, wait=False, timeout=DISPATCH_TIMEOUT):
+        self._trace(int(deviceId), "doActivity", activityID)
+        return self.hub_call(deviceId, partial(self.start_activity, activity_id=int(activityID)), wait=wait, timeout=timeout)
+
+    def hub_call(self, deviceId, coro_factory, wait=False, timeout=DISPATCH_TIMEOUT):
+        """
+        Dispatch coro_factory(client) for the hub device.  While the hub is not connected the call is rejected or
+        held for the reconnect, depending on the plugin's offline action policy.
+        """
+        hub_device = self.hub_devices[int(deviceId)]
+        session = self._sessions.get(hub_device.id)
+        client = session.client if session else None
+        if client:
+            return self.dispatch(coro_factory(client), wait=wait, timeout=timeout)
+
+        if session and self.offlinePolicy == "buffer":
+            if session.offline_actions is None:
+                session.offline_actions = deque(maxlen=self.offlineBufferSize)
+            session.offline_actions.append((time.monotonic(), coro_factory))
+            self.logger.info(f"{hub_device.name}: Hub is not connected, action held until it reconnects")
+            # covers the hub coming up between the check above and the append
+            self._event_loop.call_soon_threadsafe(self._flush_offline_actions, session)
+        else:
+            self.logger.warning(f"{hub_device.name}: Hub is not connected, action rejected")
+        return None
 
     ########################################
 
-    def findDeviceForCommand(self, config_data, commandName, activityID):
-        self.logger.debug(f'findDeviceForCommand: looking for {commandName} in {activityID}')
-        self.logger.threaddebug(f'findDeviceForCommand: config_data =\n{config_data}')
+    # the callers trace the result, these run for every command
 
-        for activity in config_data["activity"]:
-            if activity["id"] != str(activityID):
-                self.logger.debug(f'findDeviceForCommand: skipping {activity["label"]}')
-            else:
-                self.logger.debug(f'findDeviceForCommand: looking in {activity["label"]}')
-                for group in activity["controlGroup"]:
-                    self.logger.debug(f'findDeviceForCommand: looking in {group["name"]}')
-                    for function in group['function']:
-                        if function['name'] == commandName:
-                            action = json.loads(function["action"])
-                            device = action["deviceId"]
-                            devCommand = action["command"]
-                            self.logger.debug(f'findDeviceForCommand: function {function["name"]}, device = {device}, devCommand = {devCommand}')
-                            return device, devCommand
-
-        self.logger.debug('findDeviceForCommand: command not found')
-        return None, None
-
-    def findCommandForDevice(self, config_data, command_name, device_id):
-        self.logger.debug(f'findCommandForDevice: looking for {command_name} in {device_id}')
-        self.logger.threaddebug(f'findCommandForDevice: config_data =\n{config_data}')
-
-        for device in config_data["device"]:
-            if device["id"] != str(device_id):
-                self.logger.debug(f'findCommandForDevice: skipping {device["label"]}')
-            else:
-                self.logger.debug(f'findCommandForDevice: looking in {device["label"]}')
-                for group in device["controlGroup"]:
-                    self.logger.debug(f'findCommandForDevice: looking in {group["name"]}')
-                    for function in group['function']:
-                        if function['name'] == command_name:
-                            action = json.loads(function["action"])
-                            devCommand = action["command"]
-                            self.logger.debug(f'findCommandForDevice: function {function["name"]}, devCommand = {devCommand}')
-                            return devCommand
-
-        self.logger.debug('findCommandForDevice: command not found')
-        return None
+    @staticmethod
+    def findDeviceForCommand(hub_index, commandName, activityID):
+        return hub_index.activity_commands.get((str(activityID), commandName), (None, None))
+
+    @staticmethod
+    def findCommandForDevice(hub_index, command_name, device_id):
+        return hub_index.device_commands.get((str(device_id), command_name))
 
     ########################################
 
@@ -214,28 +1631,16 @@ class Plugin(indigo.PluginBase):
         if not hub_device.enabled:
             self.logger.debug(f"{ hub_device.name}: Can't send Activity commands when hub is not enabled")
             return
-        client = self._async_running_clients[self.hub_devices[hub_device.id].address]
-        activity_id, activity_name = client.current_activity
-        if int(activity_id) <= 0:
-            self.logger.debug(f"{hub_device.name} Can't send Activity commands when no Activity is running")
-            return
 
         command_name = pluginAction.props["command"]
         if command_name is None:
             self.logger.error(f"{hub_device.name}: sendCurrentActivityCommand: command property invalid in pluginProps")
             return
 
-        (device, command) = self.findDeviceForCommand(client.config, command_name, activity_id)
-
-        if device is None:
-            self.logger.warning(f"{ hub_device.name}: sendCurrentActivityCommand: No command '{command}' in current activity")
-            return
-
-        self.logger.debug(f"{hub_device.name}: sendCurrentActivityCommand: {command_name} ({command}) to {device} with delay {delay}")
-        try:
-            self._event_loop.create_task(self.send_command(client, device, command, delay))
-        except Exception as e:
-            self.logger.debug(f"{ hub_device.name}: Error in send_command: {e}")
+        # the current activity is resolved when the command runs, which may be after a reconnect
+        wait, timeout = self._action_wait(pluginAction.props)
+        return self.hub_call(hub_device.id, partial(self.send_activity_command, hub_id=hub_device.id, command_name=command_name, delay=delay),
+                             wait=wait, timeout=timeout)
 
     def sendDeviceCommand(self, pluginAction):
         hub_device = indigo.devices[pluginAction.deviceId]
@@ -244,156 +1649,413 @@ class Plugin(indigo.PluginBase):
         if not hub_device.enabled:
             self.logger.debug(f"{ hub_device.name}: Can't send commands when hub is not enabled")
             return
-        client = self._async_running_clients[self.hub_devices[hub_device.id].address]
-        activity_id, activity_name = client.current_activity
 
         command_name = pluginAction.props["command"]
         device = pluginAction.props["device"]
-        command = self.findCommandForDevice(client.config, command_name, device)
+        wait, timeout = self._action_wait(pluginAction.props)
+        return self.hub_call(hub_device.id, partial(self.send_device_command, hub_id=hub_device.id, device_id=device, command_name=command_name, delay=delay),
+                             wait=wait, timeout=timeout)
+
+    # A command sequence is a list of steps [device id or "activity", command name, repeat, pause seconds].  They
+    # are all resolved before anything is sent, then go to the hub as one send_commands batch.
+
+    def sendCommandSequence(self, pluginAction):
+        hub_device = indigo.devices[pluginAction.deviceId]
+
+        if not hub_device.enabled:
+            self.logger.debug(f"{hub_device.name}: Can't send commands when hub is not enabled")
+            return
 
-        self.logger.debug(f"{hub_device.name}: sendDeviceCommand: {command_name} ({command}) to {device} with delay {delay}")
         try:
-            self._event_loop.create_task(self.send_command(client, device, command, delay))
-        except Exception as e:
-            self.logger.debug(f":{hub_device.name} Error in send_command: {e}")
+            steps = self._parse_sequence_steps(pluginAction.props.get("steps", "[]"))
+        except ValueError as e:
+            self.logger.error(f"{hub_device.name}: sendCommandSequence: invalid steps: {e}")
+            return
+        if not steps:
+            self.logger.warning(f"{hub_device.name}: sendCommandSequence: no steps to send")
+            return
+
+        replace = str(pluginAction.props.get("replaceRunning", True)).lower() in ("true", "1", "yes")
+        wait, timeout = self._action_wait(pluginAction.props)
+        return self.hub_call(hub_device.id, partial(self.send_command_sequence, hub_id=hub_device.id, steps=steps, replace=replace),
+                             wait=wait, timeout=timeout)
+
+    def cancelCommandSequence(self, pluginAction):
+        self._event_loop.call_soon_threadsafe(self._cancel_command_sequence, int(pluginAction.deviceId))
+
+    @staticmethod
+    def _parse_sequence_steps(steps):
+        # from the ConfigUI the steps are a JSON string, scripts can pass the list itself
+        if isinstance(steps, str):
+            steps = json.loads(steps or "[]")
+        parsed = []
+        for step in steps:
+            if isinstance(step, dict):
+                step = [step.get("device"), step.get("command"), step.get("repeat", 1), step.get("delay", 0)]
+            step = list(step)
+            if 2 <= len(step) < 4:     # repeat and delay are optional
+                step += [1, 0][len(step) - 2:]
+            if len(step) != 4 or not step[0] or not step[1]:
+                raise ValueError(f"step {step} is not [device, command, repeat, delay]")
+            try:
+                parsed.append((str(step[0]), str(step[1]), max(1, int(step[2])), max(0.0, float(step[3]))))
+            except (TypeError, ValueError):
+                raise ValueError(f"step {step} has an invalid repeat or delay")
+        return parsed
+
+    # Multi-hub actions run on all hubs, or the selected ones, at the same time.  Activities, devices and commands
+    # are given by name and looked up in each hub's config.  The result, logged and returned to scripts, is
+    # {hub device id: {'hub': name, 'success': bool, 'latency': seconds, 'detail': str}}.
+
+    def powerOffHubs(self, pluginAction):
+        return self._fan_out_action(pluginAction, "Power Off", partial(self._fan_out_activity, name=None))
+
+    def startActivityOnHubs(self, pluginAction):
+        name = pluginAction.props.get("activityName", "")
+        return self._fan_out_action(pluginAction, f"Start Activity {name}", partial(self._fan_out_activity, name=name))
+
+    def sendCommandToHubs(self, pluginAction):
+        device_name = pluginAction.props.get("deviceName", "activity")
+        command_name = pluginAction.props.get("command", "")
+        delay = int(pluginAction.props.get("delay", 0) or 0)
+        return self._fan_out_action(pluginAction, f"Send {command_name}",
+                                    partial(self._fan_out_command, device_name=device_name, command_name=command_name, delay=delay))
+
+    def _selected_hubs(self, values):
+        # hub device ids for a multi-hub action or its ConfigUI
+        if str(values.get("allHubs", True)).lower() in ("true", "1", "yes"):
+            return sorted(self.hub_devices)
+        return [int(hub_id) for hub_id in values.get("hubs", []) or [] if int(hub_id) in self.hub_devices]
+
+    def _fan_out_action(self, pluginAction, description, coro_factory):
+        hub_ids = self._selected_hubs(pluginAction.props)
+        if not hub_ids:
+            self.logger.warning(f"{description}: no hubs selected")
+            return None
+        wait, timeout = self._action_wait(pluginAction.props)
+        return self.dispatch(self.fan_out(hub_ids, coro_factory, description), wait=wait, timeout=timeout)
 
     ########################################
     # Menu Methods
     ########################################
 
-    def dumpConfig(self, valuesDict, typeId):
+    def exportConfig(self, valuesDict, typeId):
+        # written from this thread, straight to a file, so neither the event loop nor the log sees the whole config
         hubID = int(valuesDict['hubID'])
         hub_dev = indigo.devices[hubID]
-        self._event_loop.create_task(self.show_config(self._async_running_clients[hub_dev.address]))
+        session = self._sessions.get(hubID)
+        config = session.config if session else None
+        if config is None:
+            self.logger.warning(f"{hub_dev.name}: No config received from the hub yet")
+            return True, valuesDict
+
+        pretty = valuesDict.get("format", "pretty") == "pretty"
+        path = os.path.join(self.cache_folder, f"hub-{hubID}-config.json")
+        encoder = json.JSONEncoder(sort_keys=True, indent=4 if pretty else None, separators=None if pretty else (',', ':'))
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                for chunk in encoder.iterencode(config):
+                    f.write(chunk)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            self.logger.error(f"{hub_dev.name}: Unable to export config: {e}")
+            return True, valuesDict
+        self.logger.info(f"{hub_dev.name}: Config exported to {path} ({os.path.getsize(path) / 1024:.0f} KB)")
         return True, valuesDict
 
+    def searchConfig(self, valuesDict, typeId):
+        hubID = int(valuesDict['hubID'])
+        hub_dev = indigo.devices[hubID]
+        hub_index = self._hub_index(hubID)
+        if not hub_index:
+            self.logger.warning(f"{hub_dev.name}: No config received from the hub yet")
+            return True, valuesDict
+
+        query = valuesDict.get("query", "function")
+        if query == "activity":
+            lines = hub_index.describe_activity(valuesDict.get("activity", ""))
+        elif query == "device":
+            lines = hub_index.describe_device(valuesDict.get("device", ""))
+        elif query == "group":
+            lines = hub_index.describe_group(valuesDict.get("text", "").strip())
+        else:
+            lines = hub_index.find_functions(valuesDict.get("text", "").strip())
+
+        if not lines:
+            self.logger.info(f"{hub_dev.name}: Nothing found")
+        else:
+            more = f"\n\t... and {len(lines) - SEARCH_LIMIT} more" if len(lines) > SEARCH_LIMIT else ""
+            self.logger.info(f"{hub_dev.name}:\n\t" + "\n\t".join(lines[:SEARCH_LIMIT]) + more)
+        return True, valuesDict
+
+    def dumpHubMetrics(self):
+        for hub_id, session in list(self._sessions.items()):
+            command_queue = session.command_queue
+            report = session.metrics.report()
+            report += f"\n\tCommand queue: {command_queue.depth} queued, max {command_queue.max_depth}, {command_queue.superseded} superseded"
+            self.logger.info(f"{indigo.devices[hub_id].name}:\n{report}")
+
+    def dumpHubSessions(self):
+        # Only what the plugin tracks itself: each session's client, the message handler it registered on it, and
+        # its tasks.  A session with a handler but no client, or a growing socket count while the hubs stay the same,
+        # means something isn't released.
+        sockets, descriptors = self._open_sockets()
+        sessions = list(self._sessions.values())
+        connected = sum(1 for session in sessions if session.client)
+        self.logger.info(f"Hub sessions: {len(sessions)} running, {connected} connected, "
+                         f"{sockets} open sockets of {descriptors} file descriptors")
+        now = time.time()
+        for session in sessions:
+            if session.client:
+                status = (f"connected to {session.client.ip_address} using {session.protocol} for "
+                          f"{self._format_duration(now - session.connected)}")
+            else:
+                status = "not connected"
+            handler = f"handler {session.listener.handler_uuid}" if session.listener else "no handler"
+            self.logger.info(f"\t{session.device.name}: {status}, {handler} registered, running {self._format_duration(now - session.started)}, "
+                             f"{session.reconnects} reconnects, {len(session.live_tasks())} tasks, {session.command_queue.depth} commands queued")
+
+    @staticmethod
+    def _open_sockets():
+        # (sockets, all file descriptors) open in the plugin's process
+        sockets = descriptors = 0
+        try:
+            fds = os.listdir("/dev/fd")
+        except OSError:
+            return "?", "?"
+        for fd in fds:
+            try:
+                mode = os.fstat(int(fd)).st_mode
+            except (OSError, ValueError):
+                continue
+            descriptors += 1
+            if stat.S_ISSOCK(mode):
+                sockets += 1
+        return sockets, descriptors
+
+    @staticmethod
+    def _format_duration(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+    def dumpEventPipeline(self):
+        pipeline = self._message_pipeline
+        self.logger.info(f"Hub event pipeline: {len(pipeline.queues)} workers, {pipeline.depth()} events queued, overflow policy {pipeline.overflow}")
+        for n, stats in enumerate(pipeline.stats):
+            self.logger.info(f"\tWorker {n}: {stats}")
+
+    def dumpTraces(self, valuesDict, typeId):
+        errorDict = indigo.Dict()
+        try:
+            limit = int(valuesDict.get("limit", 100) or 0)
+        except ValueError:
+            errorDict["limit"] = "Must be a number"
+            return False, valuesDict, errorDict
+        kinds = {kind.strip() for kind in valuesDict.get("kinds", "").split(",") if kind.strip()}
+        selected = valuesDict.get("hubID", "all")
+        traces = {hub_id: session.trace for hub_id, session in list(self._sessions.items())}
+        traces[TRACE_PLUGIN] = self._plugin_trace
+        sources = [source for source in traces if traces[source] is not None] if selected == "all" else [int(selected)]
+        for source in sources:
+            trace = traces.get(source)
+            name = "Plugin" if source == TRACE_PLUGIN else indigo.devices[source].name if source in indigo.devices else f"Hub {source}"
+            lines = trace.format(kinds, limit) if trace else []
+            self.logger.info(f"{name}: {len(lines)} trace events" + "".join(f"\n\t{line}" for line in lines))
+        if not sources:
+            self.logger.info("No trace events recorded" + ("" if self.traceSize else ", tracing is off in the plugin config"))
+        return True, valuesDict
+
+    def traceSourceListGenerator(self, filter, valuesDict, typeId, targetId):
+        return [("all", "- All -")] + self.pickHub() + [(str(TRACE_PLUGIN), "- Plugin -")]
+
+    def exportEvents(self, valuesDict, typeId):
+        # streamed from the segment files to the CSV file, neither is read into memory as a whole
+        errorDict = indigo.Dict()
+        times = {}
+        for field in ("start", "end"):
+            text = valuesDict.get(field, "").strip()
+            times[field] = None
+            if text:
+                for time_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+                    try:
+                        times[field] = time.mktime(time.strptime(text, time_format))
+                        break
+                    except ValueError:
+                        pass
+                else:
+                    errorDict[field] = "Use YYYY-MM-DD, optionally followed by HH:MM or HH:MM:SS"
+        kinds = {kind.strip() for kind in valuesDict.get("kinds", "").split(",") if kind.strip()}
+        if kinds - set(EVENT_LOG_KINDS):
+            errorDict["kinds"] = f"Unknown event kind {', '.join(sorted(kinds - set(EVENT_LOG_KINDS)))}"
+        if not valuesDict.get("hubID"):
+            errorDict["hubID"] = "Select a hub"
+        if errorDict:
+            return False, valuesDict, errorDict
+        if times["end"] is not None and len(valuesDict["end"].strip()) == 10:
+            times["end"] += 86400 - 0.001      # a date alone means the end of that day
+
+        hubID = int(valuesDict['hubID'])
+        hub_dev = indigo.devices[hubID]
+        session = self._sessions.get(hubID)
+        event_log = session.event_log if session and session.event_log else HubEventLog(os.path.join(self.cache_folder, "events", f"hub-{hubID}"), 0)
+        path = os.path.join(self.cache_folder, f"hub-{hubID}-events.csv")
+        counts = dict()
+        try:
+            with open(f"{path}.tmp", "w", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(("time", "event", "id", "detail", "value", "on"))
+                for timestamp, kind, key, detail, value, flag in event_log.query(times["start"], times["end"], kinds):
+                    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + f".{int(timestamp % 1 * 1000):03d}"
+                    on = {0: "false", 1: "true"}.get(flag, "") if kind == "automation" else ""
+                    writer.writerow((stamp, kind, key, detail, value, on))
+                    counts[kind] = counts.get(kind, 0) + 1
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            self.logger.error(f"{hub_dev.name}: Unable to export event history: {e}")
+            return True, valuesDict
+        summary = ", ".join(f"{kind} {count}" for kind, count in sorted(counts.items()))
+        self.logger.info(f"{hub_dev.name}: {sum(counts.values())} events exported to {path}" + (f" ({summary})" if summary else ""))
+        return True, valuesDict
+
+    def dumpDispatchStats(self):
+        if not self.dispatch_stats:
+            self.logger.info("No coroutines dispatched yet")
+            return
+        for name, stats in sorted(self.dispatch_stats.items()):
+            self.logger.info(f"{name}: {stats}")
+
     ########################################
     # ConfigUI methods
     ########################################
 
     def activityListGenerator(self, filter, valuesDict, typeId, targetId):
         self.logger.debug(f"activityListGenerator: typeId = {typeId}, targetId = {targetId}, valuesDict = {valuesDict}")
-        retList = []
 
-        if typeId == "activityDevice":
-            if len(valuesDict) == 0:  # no hub selected yet
+        # filter="any" adds a wildcard entry, used by the trigger filters in Events.xml
+        retList = [("any", "- Any Activity -")] if filter == "any" else []
+
+        if typeId in ("activityDevice", "activityFinishedNotification", "activityNotification", "searchConfig"):
+            if not valuesDict.get("hubID"):  # no hub selected yet
                 return retList
             else:
                 targetId = int(valuesDict["hubID"])
 
-        try:
-            config = self._async_running_clients[self.hub_devices[targetId].address].config
-        except (Exception,):
+        hub_index = self._hub_index(targetId)
+        if not hub_index:
             self.logger.error(f"activityListGenerator: targetId {targetId} not in hub list")
             return retList
 
-        for activity in config.get('activity', []):
-            if activity['id'] != "-1":
-                self.logger.threaddebug(f"activityListGenerator: Adding activity = '{activity['id']}', label = '{activity['label']}'")
-                retList.append((activity['id'], activity["label"]))
-        retList.sort(key=lambda tup: tup[1])
-        self.logger.debug(f"activityListGenerator: {len(retList)} items returned")
-        return retList
+        if filter == "any":
+            # activity_menu leaves out PowerOff, which is the one trigger filters want most
+            retList.append(("-1", hub_index.activities.get("-1", {}).get("label", "PowerOff")))
+
+        self.logger.debug(f"activityListGenerator: {len(hub_index.activity_menu)} items returned")
+        return retList + hub_index.activity_menu
 
     def deviceListGenerator(self, filter, valuesDict, typeId, targetId):
         self.logger.debug(f"deviceListGenerator: typeId = {typeId}, targetId = {targetId}")
-        retList = []
-        config = self._async_running_clients[self.hub_devices[targetId].address].config
-        for device in config["device"]:
-            self.logger.threaddebug(f"deviceListGenerator: Adding device = '{device['id']}', label = '{device['label']}'")
-            retList.append((device['id'], device["label"]))
-        retList.sort(key=lambda tup: tup[1])
-        self.logger.debug(f"deviceListGenerator: {len(retList)} items returned")
-        return retList
+
+        # filter="activity" adds an entry for the current activity, used by the command sequence steps
+        retList = [("activity", "- Current Activity -")] if filter == "activity" else []
+
+        if typeId == "searchConfig":
+            if not valuesDict.get("hubID"):
+                return retList
+            targetId = int(valuesDict["hubID"])
+
+        hub_index = self._hub_index(targetId)
+        if not hub_index:
+            self.logger.debug(f"deviceListGenerator: targetId {targetId} not in hub list")
+            return retList
+
+        self.logger.debug(f"deviceListGenerator: {len(hub_index.device_menu)} items returned")
+        return retList + hub_index.device_menu
 
     def commandGroupListGenerator(self, filter, valuesDict, typeId, targetId):
         self.logger.debug(f"commandGroupListGenerator: typeId = {typeId}, targetId = {targetId}")
         retList = []
 
-        config = self._async_running_clients[self.hub_devices[targetId].address].config
-
-        if typeId == "sendCurrentActivityCommand":
-            tempList = []
-            for activity in config["activity"]:  # build a list of all groups found in all activities
-                for group in activity["controlGroup"]:
-                    self.logger.threaddebug(f"commandGroupListGenerator: Adding name = '{group['name']}', label = '{group['label']}'")
-                    tempList.append((group["name"], group["name"]))
-            retList = list(set(tempList))  # get rid of the dupes
+        hub_index = self._hub_index(targetId)
+        if not hub_index:
+            self.logger.debug(f"commandGroupListGenerator: targetId {targetId} not in hub list")
+            return retList
 
-        elif typeId == "sendActivityCommand":
-            tempList = []
-            for activity in config["activity"]:  # build a list of all groups found in all activities
-                for group in activity["controlGroup"]:
-                    self.logger.threaddebug(f"commandGroupListGenerator: Adding name = '{group['name']}', label = '{group['name']}'")
-                    tempList.append((group["name"], group["name"]))
-            retList = list(set(tempList))  # get rid of the dupes
+        if typeId in ("sendCurrentActivityCommand", "sendActivityCommand") or (typeId == "sendCommandSequence" and valuesDict.get('device') == "activity"):
+            retList = hub_index.activity_group_menu     # all groups found in all activities
 
-        elif typeId == "sendDeviceCommand":
+        elif typeId in ("sendDeviceCommand", "sendCommandSequence"):
             if not valuesDict:
                 return retList
-            for device in config["device"]:
-                if device["id"] != valuesDict['device']:
-                    continue
-                for group in device["controlGroup"]:
-                    self.logger.threaddebug(f"commandGroupListGenerator: Adding name = '{group['name']}', label = '{group['name']}'")
-                    retList.append((group['name'], group["name"]))
+            retList = hub_index.device_group_menu.get(valuesDict.get('device'), [])
 
         else:
             self.logger.debug(f"commandGroupListGenerator Error: Unknown typeId ({typeId})")
 
-        retList.sort(key=lambda tup: tup[1])
         self.logger.debug(f"commandGroupListGenerator: {len(retList)} items returned")
-        return retList
+        return list(retList)
 
     def commandListGenerator(self, filter, valuesDict, typeId, targetId):
         retList = []
         if not valuesDict:
             return retList
 
-        config = self._async_running_clients[self.hub_devices[targetId].address].config
-
-        if typeId == "sendCurrentActivityCommand":
-            self.logger.debug(f"commandListGenerator: typeId = {typeId}, targetId = {targetId}, group = {valuesDict['group']}")
-            tempList = []
-            for activity in config["activity"]:
-                for group in activity["controlGroup"]:
-                    if group["name"] != valuesDict['group']:
-                        continue  # build a list of all functions found in the specified controlGroup,
-                    for function in group["function"]:  # for all activities (combined)
-                        self.logger.threaddebug(f"commandListGenerator: Adding name = '{function['name']}', label = '{function['label']}'")
-                        tempList.append((function["name"], function['name']))
-            retList = list(set(tempList))  # get rid of the dupes
+        hub_index = self._hub_index(targetId)
+        if not hub_index:
+            self.logger.debug(f"commandListGenerator: targetId {targetId} not in hub list")
+            return retList
 
-        elif typeId == "sendActivityCommand":
-            self.logger.debug(f"commandListGenerator: typeId = {typeId}, targetId = {targetId}, group = {valuesDict['group']}")
-            tempList = []
-            for activity in config["activity"]:
-                for group in activity["controlGroup"]:
-                    if group["name"] != valuesDict['group']:
-                        continue  # build a list of all functions found in the specified controlGroup,
-                    for function in group["function"]:  # for all activities (combined)
-                        self.logger.threaddebug(f"commandListGenerator: Adding name = '{function['name']}', label = '{function['label']}'")
-                        tempList.append((function["name"], function['name']))
-            retList = list(set(tempList))  # get rid of the dupes
+        if typeId in ("sendCurrentActivityCommand", "sendActivityCommand") or (typeId == "sendCommandSequence" and valuesDict.get('device') == "activity"):
+            self.logger.debug(f"commandListGenerator: typeId = {typeId}, targetId = {targetId}, group = {valuesDict.get('group')}")
+            retList = hub_index.activity_group_commands.get(valuesDict.get('group'), [])     # for all activities (combined)
 
-        elif typeId == "sendDeviceCommand":
-            self.logger.debug(f"commandListGenerator: typeId = {typeId}, targetId = {targetId}, device = {valuesDict['device']}")
-            for device in config["device"]:
-                if device["id"] != valuesDict['device']:
-                    continue
-                for group in device["controlGroup"]:
-                    if group["name"] != valuesDict['group']:
-                        continue
-                    for function in group['function']:
-                        self.logger.threaddebug(f"commandListGenerator: Adding name = '{function['name']}', label = '{function['label']}'")
-                        retList.append((function['name'], function["label"]))
+        elif typeId in ("sendDeviceCommand", "sendCommandSequence"):
+            self.logger.debug(f"commandListGenerator: typeId = {typeId}, targetId = {targetId}, device = {valuesDict.get('device')}")
+            retList = hub_index.device_group_commands.get((valuesDict.get('device'), valuesDict.get('group')), [])
 
         else:
             self.logger.debug(f"commandListGenerator Error: Unknown typeId ({typeId})")
 
-        retList.sort(key=lambda tup: tup[1])
         self.logger.debug(f"commandListGenerator: {len(retList):d} items returned")
-        return retList
+        return list(retList)
+
+    def sequenceStepListGenerator(self, filter, valuesDict, typeId, targetId):
+        try:
+            steps = self._parse_sequence_steps(valuesDict.get("steps", "[]")) if valuesDict else []
+        except ValueError:
+            return []
+        hub_index = self._hub_index(targetId)
+        device_names = dict(hub_index.device_menu) if hub_index else {}
+        device_names["activity"] = "Current Activity"
+        return [(str(n), f"{n + 1}. {device_names.get(device, device)}: {command} x{repeat}, pause {delay:g} s")
+                for n, (device, command, repeat, delay) in enumerate(steps)]
+
+    def addSequenceStep(self, valuesDict, typeId, devId):
+        errorDict = indigo.Dict()
+        if not valuesDict.get('device'):
+            errorDict["device"] = "Device must be selected"
+        if not valuesDict.get('command'):
+            errorDict["command"] = "Command must be selected"
+        try:
+            repeat = int(valuesDict.get('repeat') or 1)
+            delay = float(valuesDict.get('delay') or 0)
+        except ValueError:
+            errorDict["repeat"] = errorDict["delay"] = "Repeat and pause must be numbers"
+        if len(errorDict) > 0:
+            return valuesDict, errorDict
+
+        steps = json.loads(valuesDict.get("steps") or "[]")
+        steps.append([valuesDict['device'], valuesDict['command'], repeat, delay])
+        valuesDict["steps"] = json.dumps(steps)
+        return valuesDict
+
+    def removeSequenceSteps(self, valuesDict, typeId, devId):
+        selected = {int(n) for n in valuesDict.get("stepList", [])}
+        steps = json.loads(valuesDict.get("steps") or "[]")
+        valuesDict["steps"] = json.dumps([step for n, step in enumerate(steps) if n not in selected])
+        valuesDict["stepList"] = indigo.List()
+        return valuesDict
 
     # doesn't do anything, just needed to force other menus to dynamically refresh
 
@@ -439,6 +2101,21 @@ class Plugin(indigo.PluginBase):
             if valuesDict['command'] == "":
                 errorDict["command"] = "Command must be selected"
 
+        elif typeId in ("powerOffHubs", "startActivityOnHubs", "sendCommandToHubs"):
+            if str(valuesDict.get("allHubs", True)).lower() not in ("true", "1", "yes") and not valuesDict.get("hubs"):
+                errorDict["hubs"] = "Select at least one hub"
+            if typeId == "startActivityOnHubs" and not valuesDict.get("activityName"):
+                errorDict["activityName"] = "Activity must be selected"
+            if typeId == "sendCommandToHubs" and not valuesDict.get("command"):
+                errorDict["command"] = "Command must be selected"
+
+        elif typeId == "sendCommandSequence":
+            try:
+                if not self._parse_sequence_steps(valuesDict.get('steps', "[]")):
+                    errorDict["stepList"] = "Add at least one step"
+            except ValueError as e:
+                errorDict["stepList"] = f"Invalid steps: {e}"
+
         else:
             self.logger.debug(f"validateActionConfigUi Error: Unknown typeId ({typeId})")
 
@@ -455,6 +2132,58 @@ class Plugin(indigo.PluginBase):
         retList.sort(key=lambda tup: tup[1])
         return retList
 
+    def _selected_indexes(self, valuesDict):
+        return [hub_index for hub_index in map(self._hub_index, self._selected_hubs(valuesDict)) if hub_index]
+
+    def hubActivityNameListGenerator(self, filter, valuesDict, typeId, targetId):
+        names = {label for hub_index in self._selected_indexes(valuesDict) for _, label in hub_index.activity_menu}
+        return [(name, name) for name in sorted(names)]
+
+    def hubDeviceNameListGenerator(self, filter, valuesDict, typeId, targetId):
+        names = {label for hub_index in self._selected_indexes(valuesDict) for _, label in hub_index.device_menu}
+        return [("activity", "- Current Activity -")] + [(name, name) for name in sorted(names)]
+
+    def hubCommandNameListGenerator(self, filter, valuesDict, typeId, targetId):
+        device_name = valuesDict.get("deviceName", "activity") or "activity"
+        names = set()
+        for hub_index in self._selected_indexes(valuesDict):
+            if device_name == "activity":
+                for commands in hub_index.activity_group_commands.values():
+                    names.update(name for name, _ in commands)
+            else:
+                device_id = hub_index.device_named(device_name)
+                for group_name, _ in hub_index.device_group_menu.get(device_id, []):
+                    names.update(name for name, _ in hub_index.device_group_commands.get((device_id, group_name), []))
+        return [(name, name) for name in sorted(names)]
+
+    def discoverHubs(self, valuesDict, typeId, devId):
+        addresses = self._discovery_addresses()
+        if not addresses:
+            valuesDict["discoveryStatus"] = "Can't tell which network to search, set it in the plugin config"
+            return valuesDict
+        started = time.monotonic()
+        found = self.dispatch(self.async_discover_hubs(addresses), wait=True, timeout=DISCOVERY_TIMEOUT * len(addresses) / DISCOVERY_CONCURRENCY + 10)
+        self._discovered_hubs = found or {}
+        valuesDict["discoveryStatus"] = f"Found {len(self._discovered_hubs)} hubs in {time.monotonic() - started:.1f} seconds"
+        self.logger.debug(f"discoverHubs: {self._discovered_hubs}")
+        return valuesDict
+
+    def discoveredHubListGenerator(self, filter, valuesDict, typeId, targetId):
+        # hubs that already have another device are marked, so they aren't added twice
+        known = {hub_device.pluginProps.get("hubId"): hub_device.name for did, hub_device in self.hub_devices.items() if did != targetId}
+        retList = []
+        for address, (hub_id, name) in sorted(self._discovered_hubs.items(), key=lambda item: item[1][1]):
+            in_use = f", used by {known[hub_id]}" if hub_id in known else ""
+            retList.append((address, f"{name} at {address} (hub {hub_id}{in_use})"))
+        return retList
+
+    def discoveredHubSelected(self, valuesDict, typeId, devId):
+        address = valuesDict.get("discoveredHub")
+        if address in self._discovered_hubs:
+            valuesDict["address"] = address
+            valuesDict["hubId"], valuesDict["hubName"] = self._discovered_hubs[address]
+        return valuesDict
+
     ########################################
 
     def _run_async_thread(self):
@@ -464,22 +2193,216 @@ class Plugin(indigo.PluginBase):
         self._event_loop.run_until_complete(self._async_stop())
         self._event_loop.close()
 
+    def dispatch(self, coro, wait=False, timeout=DISPATCH_TIMEOUT):
+        """
+        Thread-safe way for Indigo threads to run a coroutine on the plugin's event loop.  The loop is woken up
+        immediately.  Returns the concurrent.futures.Future for fire-and-forget callers, or with wait=True blocks
+        for up to timeout seconds and returns the coroutine's result (None on timeout or failure).
+        """
+        future = asyncio.run_coroutine_threadsafe(self._timed_call(coro, coro.__name__, time.monotonic()), self._event_loop)
+        if not wait or threading.current_thread() is self._async_thread:
+            return future
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.logger.warning(f"{coro.__name__}: no result after {timeout} seconds")
+            future.cancel()
+        except Exception:  # noqa - already logged by _timed_call
+            pass
+        return None
+
+    async def _timed_call(self, coro, name, queued):
+        invoked_at.set(queued)
+        started = time.monotonic()
+        failed = True
+        try:
+            result = await coro
+            failed = False
+            return result
+        except asyncio.CancelledError:
+            raise
+        except CommandSuperseded as e:
+            self.logger.info(f"{name}: {e}")
+            raise
+        except Exception as e:
+            self.logger.error(f"{name}: {type(e).__name__}: {e}")
+            raise
+        finally:
+            finished = time.monotonic()
+            self.dispatch_stats.setdefault(name, DispatchStats()).record(started - queued, finished - started, failed)
+            self._trace(TRACE_PLUGIN, "dispatch", name, round((started - queued) * 1000, 1), round((finished - started) * 1000, 1), failed)
+
     async def _async_start(self):
         self.logger.debug("_async_start")
+        if self.stateServer:
+            await self._async_start_state_server()
+        asyncio.get_running_loop().create_task(self._async_flush_event_logs())
 
     async def _async_stop(self):
         self.logger.debug("_async_stop waiting")
+        await self._stop_event.wait()
+        await self._async_stop_state_server()
+
+        # close whatever hubs are still running in parallel, then let any other tasks finish or cancel them
+        started = time.monotonic()
+        running = list(self._sessions.values())
+        await asyncio.gather(*(self._async_stop_device(session) for session in running), return_exceptions=True)
+        self.logger.debug(f"_async_stop: {len(running)} hubs stopped in {time.monotonic() - started:.2f} seconds")
+
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=2)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    ########################################
+    # State server
+    ########################################
+
+    def _seed_state_store(self, device):
+        self._state_store.update(device.id, dict(device.states, name=device.name, address=device.address))
+
+    def _state_catalog(self, hub_id):
+        hub_index = self._hub_index(hub_id)
+        return (hub_index.config_hash, hub_index.catalog()) if hub_index else None
+
+    async def _async_start_state_server(self):
+        server = StateServer(self._state_store, self._state_catalog, self.logger)
+        try:
+            await server.start(self.stateServerPort)
+        except OSError as e:
+            self.logger.error(f"Unable to start the state server on port {self.stateServerPort}: {e}")
+            await server.stop()
+            return
+        # the store is only kept up to date while the server runs, so it starts from the devices' current states
+        self._state_server = server
+        for hub_id in list(self.hub_devices):
+            try:
+                self._seed_state_store(indigo.devices[hub_id])
+            except KeyError:
+                pass
+        self.logger.info(f"State server listening on http://{STATE_SERVER_HOST}:{self.stateServerPort}/hubs")
+
+    async def _async_stop_state_server(self):
+        server, self._state_server = self._state_server, None
+        if server:
+            await server.stop()
+            self._state_store.clear()
+
+    async def _async_restart_state_server(self):
+        await self._async_stop_state_server()
+        if self.stateServer:
+            await self._async_start_state_server()
+
+    ########################################
+    # Event history
+    ########################################
+
+    def _open_event_log(self, session):
+        if not session.event_log:
+            folder = os.path.join(self.cache_folder, "events", f"hub-{session.device.id}")
+            session.event_log = HubEventLog(folder, self.eventLogSize * 1024 * 1024)
+
+    def _log_event(self, hub_id, kind, key="", detail="", value=0, flag=0):
+        session = self._sessions.get(hub_id)
+        event_log = session.event_log if session else None
+        if event_log:
+            event_log.record(kind, key, detail, value, flag)
+
+    def _flush_event_logs(self):
+        # in an executor, so the file work never holds up the event loop or the pipeline workers
+        for session in list(self._sessions.values()):
+            event_log = session.event_log
+            if not event_log:
+                continue
+            try:
+                event_log.flush()
+            except OSError as e:
+                self.logger.warning(f"{session.device.name}: Unable to write event history: {e}")
+
+    async def _async_flush_event_logs(self):
+        # until the plugin stops, _async_stop then closes the sessions, which writes what's left
+        loop = asyncio.get_running_loop()
         while True:
-            await asyncio.sleep(1.0)
-            if self.stopThread:
-                break
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), EVENT_LOG_FLUSH)
+                return
+            except asyncio.TimeoutError:
+                await loop.run_in_executor(None, self._flush_event_logs)
 
     ########################################
 
+    def _new_trace(self):
+        return TraceBuffer(self.traceSize) if self.traceSize > 0 else None
+
+    def _trace(self, hub_id, kind, *details):
+        # cheap enough for every message and command, see TraceBuffer; traceSize 0 turns it off.  Each hub's trace is
+        # in its session and goes with it, anything for a hub that isn't running is dropped.
+        if hub_id == TRACE_PLUGIN:
+            trace = self._plugin_trace
+        else:
+            session = self._sessions.get(hub_id)
+            trace = session.trace if session else None
+        if trace is not None:
+            trace.add(kind, *details)
+
+    def _update_hub_states(self, hub_device, stateList):
+        # every hub state write goes through here so the state server sees it too
+        hub_device.updateStatesOnServer(stateList)
+        if self._state_server:
+            self._state_store.update(hub_device.id, {state['key']: state['value'] for state in stateList})
+
+    def queue_message(self, message):
+        # Listener callback, on the event loop: hand the message to the pipeline and get back to the hubs
+        if message.get('type') == "automation.state?notify" and isinstance(message.get('data'), dict):
+            self._coalesce_automation(message)
+        else:
+            self._message_pipeline.submit(message['device_id'], message)
+
+    def _automation_window(self, hub_id):
+        # milliseconds, the hub device's own setting if it has one
+        hub_device = self.hub_devices.get(hub_id)
+        window = hub_device.pluginProps.get("automationWindow", "") if hub_device else ""
+        try:
+            return int(window) if str(window).strip() else self.automationWindow
+        except ValueError:
+            return self.automationWindow
+
+    def _coalesce_automation(self, message):
+        # Automation notifications for a hub are merged for the length of the window, keeping the latest values for
+        # each automation device, and then handled as one message.  They may overtake the hub's other messages, which
+        # don't touch the same states.
+        hub_id = message['device_id']
+        window = self._automation_window(hub_id)
+        if window <= 0:
+            self._message_pipeline.submit(hub_id, message)
+            return
+
+        session = self._sessions.get(hub_id)
+        if not session:
+            return
+        pending = session.pending_automation
+        if pending is None:
+            pending = session.pending_automation = dict(message, data={})
+            asyncio.get_running_loop().call_later(window / 1000.0, self._flush_automation, session)
+        for key, data in message['data'].items():
+            pending['data'].pop(key, None)  # re-inserted so the most recently changed device ends up last
+            pending['data'][key] = data
+
+    def _flush_automation(self, session):
+        message, session.pending_automation = session.pending_automation, None
+        if message:
+            self._message_pipeline.submit(session.device.id, message)
+
     def message_handler(self, message):
-        self.logger.threaddebug(f"messageHandler: {message}")
+        # runs on a MessagePipeline worker thread, in order for each hub
+        self._trace(message['device_id'], "message", message.get('type') or message.get('cmd'))
 
-        hub_device = indigo.devices[message['device_id']]
+        try:
+            hub_device = indigo.devices[message['device_id']]
+        except KeyError:        # deleted since the message was queued
+            return
         try:
             message_type = message['type']
         except KeyError:
@@ -487,109 +2410,980 @@ class Plugin(indigo.PluginBase):
             return
 
         if message_type == "automation.state?notify":
-            key = list(message['data'])[0]
-            data = message['data'][key]
-            self.logger.debug(f"{hub_device.name}: Event automation notify, device: {key}, status: {data['status']}, brightness: {data['brightness']}, on: {data['on']}")
+            # one message may carry several automation devices; the "last" states get the most recent one
+            devices = message['data']
+            if not devices:
+                return
+            for key, data in devices.items():
+                self._trace(hub_device.id, "automation", key, data.get('on'), data.get('brightness'), data.get('status'))
+                self._log_event(hub_device.id, "automation", key, data.get('status'), data.get('brightness', -1),
+                                {True: 1, False: 0}.get(data.get('on'), 2))
+            key, data = list(devices.items())[-1]
             stateList = [{'key': 'lastAutomationDevice', 'value': key},
-                         {'key': 'lastAutomationStatus', 'value': data['status']},
-                         {'key': 'lastAutomationBrightness', 'value': str(data['brightness'])},
-                         {'key': 'lastAutomationOnState', 'value': str(data['on'])}
+                         {'key': 'lastAutomationStatus', 'value': data.get('status')},
+                         {'key': 'lastAutomationBrightness', 'value': str(data.get('brightness'))},
+                         {'key': 'lastAutomationOnState', 'value': str(data.get('on'))}
                          ]
-            hub_device.updateStatesOnServer(stateList)
-            broadcastDict = {'lastAutomationDevice': key, 'lastAutomationStatus': data['status'],
-                             'lastAutomationBrightness': data['brightness'], 'lastAutomationOnState': data['on'],
-                             'hubID': str(hub_device.id)}
+            if self.automationStorage == "states":
+                stateList.extend(self._automation_device_states(hub_device, devices))
+            self._update_hub_states(hub_device, stateList)
+            if self._state_server:
+                self._state_store.merge(hub_device.id, 'automationDevices', devices)
+            if self.automationStorage == "variables":
+                self._update_automation_variables(hub_device, devices)
+
+            broadcastDict = {'lastAutomationDevice': key, 'lastAutomationStatus': data.get('status'),
+                             'lastAutomationBrightness': data.get('brightness'), 'lastAutomationOnState': data.get('on'),
+                             'automationDevices': devices, 'hubID': str(hub_device.id)}
             indigo.server.broadcastToSubscribers("automationNotification", broadcastDict)
-            self.triggerCheck(hub_device, "automationNotification")
+            for key, data in devices.items():
+                self.triggerCheck(hub_device, "automationNotification", match=key, status=data.get('status'))
 
         elif message_type == "harmony.engine?startActivityFinished":
-            self.logger.debug(f"{hub_device.name}: Event startActivityFinished, activityId = {message['data']['activityId']}, errorCode = {message['data']['errorCode']}, errorString = {message['data']['errorString']}")
-
-            # update the activity devices
-            for deviceId, activityId in self.activity_devices.items():
-                device = indigo.devices[deviceId]
-                if activityId == message['data']['activityId']:
-                    device.updateStateOnServer(key='onOffState', value=True)
-                else:
-                    device.updateStateOnServer(key='onOffState', value=False)
-
-            # Update the hub's state and send the event to any subscribers
-            config = self._async_running_clients[hub_device.address].config
-            for activity in config["activity"]:
-                if message['data']['activityId'] == activity['id']:
-                    stateList = [{'key': 'currentActivityNum', 'value': activity['id']},
-                                 {'key': 'currentActivityName', 'value': activity['label']}
-                                 ]
-                    hub_device.updateStatesOnServer(stateList)
-                    broadcastDict = {'currentActivityNum': activity[u'id'], 'currentActivityName': activity['label'],
-                                     'hubID': str(hub_device.id)}
-                    indigo.server.broadcastToSubscribers(u"activityFinishedNotification", broadcastDict)
-                    break
-            self.triggerCheck(hub_device, "activityFinishedNotification")
+            self._trace(hub_device.id, "activityFinished", message['data']['activityId'], message['data']['errorCode'], message['data']['errorString'])
+            self._log_event(hub_device.id, "activityFinished", message['data']['activityId'], message['data']['errorString'], message['data']['errorCode'])
+
+            session = self._sessions.get(hub_device.id)
+            if session and session.metrics.activity_finished(message['data']['activityId'], time.monotonic()):
+                states = self._metrics_states(hub_device.id)
+                if states:
+                    self._update_hub_states(hub_device, states)
+
+            pending = None
+            if session:
+                pending, session.pending_activity = session.pending_activity, None
+            if pending and str(message['data']['errorCode']) != "200":
+                self._activity_rollback(hub_device, pending, message['data']['errorString'])
+                activity = None
+            else:
+                # Update the hub's state and send the event to any subscribers
+                activity = self._set_activity_states(hub_device, message['data']['activityId'])
+            if activity:
+                broadcastDict = {'currentActivityNum': activity[u'id'], 'currentActivityName': activity['label'],
+                                 'hubID': str(hub_device.id)}
+                indigo.server.broadcastToSubscribers(u"activityFinishedNotification", broadcastDict)
+            self.triggerCheck(hub_device, "activityFinishedNotification", match=message['data']['activityId'])
 
         elif message_type == "connect.stateDigest?notify":
-            self.logger.debug(f"{hub_device.name}: Event activityNotification, activityId = {message['data']['activityId']}, activityStatus = {message['data']['activityStatus']}")
+            self._trace(hub_device.id, "stateDigest", message['data']['activityId'], message['data']['activityStatus'])
+            self._log_event(hub_device.id, "stateDigest", message['data']['activityId'], value=message['data']['activityStatus'])
             stateList = [{'key': 'notifyActivityId', 'value': message['data']['activityId']},
                          {'key': 'notifyActivityStatus', 'value': message['data']['activityStatus']}
                          ]
-            hub_device.updateStatesOnServer(stateList)
+            self._update_hub_states(hub_device, stateList)
             broadcastDict = {'notifyActivityId': message['data']['activityId'], 'notifyActivityStatus': message['data']['activityStatus'], 'hubID': str(hub_device.id)}
             indigo.server.broadcastToSubscribers(u"activityNotification", broadcastDict)
-            self.triggerCheck(hub_device, "activityNotification")
+            self.triggerCheck(hub_device, "activityNotification", match=message['data']['activityId'], status=message['data']['activityStatus'])
+
+        elif message_type == "plugin.activityPending":
+            self._activity_pending(hub_device, message['data'])
+
+        elif message_type in ("plugin.activityFailed", "plugin.activityTimeout"):
+            # sent by start_activity; ignored if the activity has finished or another one was started since
+            session = self._sessions.get(hub_device.id)
+            pending = session.pending_activity if session else None
+            if not pending or pending['token'] != message['data']['token']:
+                return
+            session.pending_activity = None
+            actual = message['data'].get('actualActivityId')
+            if actual == pending['activityId']:
+                self.logger.debug(f"{hub_device.name}: No startActivityFinished for {actual}, but the hub reports it running")
+                self._set_activity_states(hub_device, actual)
+            else:
+                self._activity_rollback(hub_device, pending, message['data']['reason'], actual)
+
+        elif message_type == "plugin.updateHubStates":
+            # connection and metric states, from the event loop
+            self._update_hub_states(hub_device, message['data'])
+
+        elif message_type == "plugin.updateHubProps":
+            props = hub_device.pluginProps
+            if any(props.get(key) != value for key, value in message['data'].items()):
+                props.update(message['data'])
+                hub_device.replacePluginPropsOnServer(props)
+
+        elif message_type == "plugin.configUpdated":
+            # queued by config_updated; data is the diff against the previous config, None for the first one
+            changes = message['data']
+            stateList = [{'key': 'lastMetadataUpdate', 'value': time.strftime("%Y-%m-%d %H:%M:%S")}]
+            hub_index = self._hub_index(hub_device.id)
+            activity = hub_index.activities.get(hub_device.states.get('currentActivityNum')) if hub_index else None
+            if activity and activity['label'] != hub_device.states.get('currentActivityName'):
+                stateList.append({'key': 'currentActivityName', 'value': activity['label']})
+            if changes is not None:
+                stateList.append({'key': 'lastConfigChange', 'value': HubIndex.describe_changes(changes)})
+            self._update_hub_states(hub_device, stateList)
+            self._check_activity_devices(hub_device)
+
+            if changes is not None:
+                self._log_event(hub_device.id, "configChanged", detail=HubIndex.describe_changes(changes))
+                broadcastDict = {'hubID': str(hub_device.id), 'summary': HubIndex.describe_changes(changes), 'changes': changes}
+                indigo.server.broadcastToSubscribers("configChanged", broadcastDict)
+                self.triggerCheck(hub_device, "configChanged")
 
         else:
-            self.logger.threaddebug(f"{hub_device.name}: ignoring message with unknown type: {message_type}")
+            self._trace(hub_device.id, "ignored", message_type)
+
+    def _set_activity_states(self, hub_device, activity_id, pending_device=None):
+        """
+        Show activity_id as the hub's current activity on its activity devices and hub states, only writing the ones
+        that actually change.  pending_device is the activity device to mark as pending, any other mark is cleared.
+        Returns the activity, or None if it isn't in the hub's config.
+        """
+        for deviceId, activityId in list(self.activity_devices.get(hub_device.id, {}).items()):
+            onState = (activityId == activity_id)
+            pending = (deviceId == pending_device)
+            if self.activity_device_states.get(deviceId) != onState or pending != (deviceId in self._pending_devices):
+                indigo.devices[deviceId].updateStatesOnServer([{'key': 'onOffState', 'value': onState},
+                                                               {'key': 'pending', 'value': pending}])
+                self.activity_device_states[deviceId] = onState
+                if pending:
+                    self._pending_devices.add(deviceId)
+                else:
+                    self._pending_devices.discard(deviceId)
+
+        hub_index = self._hub_index(hub_device.id)
+        activity = hub_index.activities.get(activity_id) if hub_index else None
+        stateList = [{'key': 'pendingActivityNum', 'value': activity_id if pending_device is not None else ""}]
+        if activity:
+            stateList.extend([{'key': 'currentActivityNum', 'value': activity['id']},
+                              {'key': 'currentActivityName', 'value': activity['label']}])
+        self._update_hub_states(hub_device, stateList)
+        return activity
+
+    def _activity_pending(self, hub_device, data):
+        # Optimistic mode: show the activity as started as soon as it's sent.  The activity it replaces is kept so
+        # it can be restored if the hub reports an error, start_activity fails, or nothing comes back in time.
+        session = self._sessions.get(hub_device.id)
+        if not session:
+            return
+        previous = session.pending_activity
+        activity_id = data['activityId']
+        session.pending_activity = {
+            'token': data['token'],
+            'activityId': activity_id,
+            'previousId': previous['previousId'] if previous else hub_device.states.get('currentActivityNum', "-1"),
+        }
+        target = next((device_id for device_id, device_activity in self.activity_devices.get(hub_device.id, {}).items()
+                       if device_activity == activity_id), 0)
+        self._set_activity_states(hub_device, activity_id, pending_device=target)
+
+    def _activity_rollback(self, hub_device, pending, reason, actual=None):
+        restore = actual or pending['previousId']
+        self._log_event(hub_device.id, "activityFailed", pending['activityId'], reason)
+        hub_index = self._hub_index(hub_device.id)
+        label = (lambda activity_id: hub_index.activities.get(activity_id, {}).get('label', activity_id) if hub_index else activity_id)
+        self.logger.error(f"{hub_device.name}: Activity {label(pending['activityId'])} did not start ({reason}), showing {label(restore)}")
+        self._set_activity_states(hub_device, restore)
+
+    def _check_activity_devices(self, hub_device):
+        # flag activity devices whose activity was deleted in the Harmony app, and clear the flag if it comes back
+        hub_index = self._hub_index(hub_device.id)
+        if not hub_index:
+            return
+        for device_id, activity_id in list(self.activity_devices.get(hub_device.id, {}).items()):
+            missing = activity_id not in hub_index.activities
+            if missing == (device_id in self._missing_activities):
+                continue
+            device = indigo.devices[device_id]
+            if missing:
+                self.logger.warning(f"{device.name}: Activity {activity_id} is no longer configured on {hub_device.name}")
+                self._missing_activities.add(device_id)
+                device.setErrorStateOnServer("no activity")
+            else:
+                self._missing_activities.discard(device_id)
+                device.setErrorStateOnServer(None)
+
+    ########################################
+    # Per-device automation state, as hub device states or Indigo variables
+    ########################################
+
+    @staticmethod
+    def _automation_state_id(key):
+        # state ids and variable names may only have letters, digits and underscores
+        return "auto_" + re.sub(r'\W', '_', str(key))
+
+    def _known_automation_states(self, hub_device):
+        # seeded from the device's existing states, so they survive a restart before any new events arrive.  Kept in
+        # the hub's session while it runs.
+        session = self._sessions.get(hub_device.id)
+        known = session.automation_states if session else None
+        if known is None:
+            known = {state_id[:-3]: state_id[5:-3] for state_id in hub_device.states if state_id.startswith("auto_") and state_id.endswith("_on")}
+            if session:
+                session.automation_states = known
+        return known
+
+    def _automation_device_states(self, hub_device, devices):
+        known = self._known_automation_states(hub_device)
+        stateList = []
+        added = False
+        for key, data in devices.items():
+            prefix = self._automation_state_id(key)
+            if prefix not in known:
+                known[prefix] = key
+                added = True
+            stateList.extend([{'key': f"{prefix}_on", 'value': bool(data.get('on'))},
+                              {'key': f"{prefix}_status", 'value': str(data.get('status'))}])
+            if data.get('brightness') is not None:     # not every automation device reports one
+                stateList.append({'key': f"{prefix}_brightness", 'value': data['brightness']})
+        if added:
+            hub_device.stateListOrDisplayStateIdChanged()
+        return stateList
+
+    def _update_automation_variables(self, hub_device, devices):
+        # one variable per automation device, holding its latest state as JSON
+        for key, data in devices.items():
+            value = json.dumps({'on': data.get('on'), 'brightness': data.get('brightness'), 'status': data.get('status')})
+            variable_id = self._automation_variables.get((hub_device.id, key))
+            if variable_id is None:
+                name = f"Harmony_{hub_device.id}_{self._automation_state_id(key)[5:]}"
+                try:
+                    variable_id = indigo.variables[name].id
+                except KeyError:
+                    variable_id = indigo.variable.create(name, value).id
+                self._automation_variables[(hub_device.id, key)] = variable_id
+            try:
+                indigo.variable.updateValue(variable_id, value)
+            except KeyError:    # deleted by the user, recreated next time
+                self._automation_variables.pop((hub_device.id, key), None)
 
-    async def _async_start_device(self, device):
-        self.logger.debug(f"{device.name}: _async_start_device creating client")
-        client = HarmonyAPI(ip_address=device.address, protocol=self.protocol)
-        connected = False
+    ########################################
+    # Hub discovery
+    ########################################
 
-        self.logger.debug(f"{device.name}: _async_start_device connecting client")
+    def _discovery_addresses(self):
+        # hosts in the configured subnet, or in the /24 of the address this machine uses to reach the LAN
+        subnet = self.discoverySubnet.strip()
+        if not subnet:
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.connect(("10.255.255.255", 1))     # UDP, nothing is sent
+                    subnet = f"{sock.getsockname()[0]}/24"
+            except OSError:
+                return []
         try:
-            connected = await client.connect()
-        except ConnectionRefusedError as e:
-            self.logger.debug(f"{device.name}: connect exception: {e}.")
+            network = ipaddress.ip_network(subnet, strict=False)
+        except ValueError:
+            self.logger.warning(f"Invalid discovery subnet '{subnet}'")
+            return []
+        if network.num_addresses > DISCOVERY_MAX_HOSTS + 2:
+            self.logger.warning(f"Discovery subnet {network} is too large, searching its first {DISCOVERY_MAX_HOSTS} addresses")
+        return [str(address) for address in itertools.islice(network.hosts(), DISCOVERY_MAX_HOSTS)]
+
+    async def async_discover_hubs(self, addresses, hub_id=None):
+        """
+        Probe addresses for Harmony hubs, DISCOVERY_CONCURRENCY at a time.  Returns {address: (hub id, name)}.  With
+        hub_id, stops as soon as that hub has been found.
+        """
+        found = dict()
+        remaining = iter(addresses)     # shared by the workers, each takes the next address when it's free
+
+        async def probe_next(session):
+            for address in remaining:
+                if hub_id is not None and any(found_id == hub_id for found_id, _ in found.values()):
+                    return
+                hub = await self._async_probe_hub(session, address)
+                if hub:
+                    found[address] = hub
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DISCOVERY_TIMEOUT)) as session:
+            await asyncio.gather(*(probe_next(session) for _ in range(DISCOVERY_CONCURRENCY)))
+        return found
+
+    @staticmethod
+    async def _async_probe_hub(session, address):
+        # the provisioning request aioharmony starts with; a hub answers with its remote id and friendly name
+        request = {"id ": 1, "cmd": "setup.account?getProvisionInfo", "params": {}}
+        headers = {"Origin": "http://sl.dhg.myharmony.com", "Accept": "application/json", "Accept-Charset": "utf-8"}
+        try:
+            async with session.post(f"http://{address}:{HUB_PORT}/", json=request, headers=headers) as response:
+                if response.status != 200:
+                    return None
+                data = (await response.json(content_type=None) or {}).get("data") or {}
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError, AttributeError):
+            return None
+        if "activeRemoteId" not in data:
+            return None
+        return str(data["activeRemoteId"]), data.get("friendlyName", "")
+
+    async def _async_rediscover_hub(self, session):
+        # look for a hub that stopped answering at another address, by the hub id recorded when it last connected
+        device = session.device
+        hub_id = session.remote_id or device.pluginProps.get("hubId")
+        now = time.monotonic()
+        if not hub_id or now - session.last_rediscovery < REDISCOVER_INTERVAL:
+            return None
+        session.last_rediscovery = now
+        addresses = self._discovery_addresses()
+        self.logger.debug(f"{device.name}: Searching {len(addresses)} addresses for hub {hub_id}")
+        found = await self.async_discover_hubs(addresses, hub_id=hub_id)
+        for address, (found_id, name) in found.items():
+            if found_id == hub_id and address != device.address:
+                self.logger.warning(f"{device.name}: Hub {name} ({hub_id}) is now at {address}, was {device.address}.  Updating the device address.")
+                # the props change makes Indigo restart the device, which reconnects at the new address
+                self._message_pipeline.submit(device.id, {'type': "plugin.updateHubProps", 'device_id': device.id, 'data': {'address': address}})
+                return address
+        return None
+
+    ########################################
+    # Transport selection
+    ########################################
+
+    # A hub uses the protocol set on its device, or the plugin's.  With AUTO_PROTOCOL both transports are timed
+    # with a few state digest round trips and the one with fewer errors, then the lower median, is used.  The
+    # choice is saved with the device and evaluated again every PROTOCOL_RECHECK_INTERVAL, when the hub's command
+    # error rate goes up, or when a connection to it fails.
+
+    def _protocol_setting(self, device):
+        return device.pluginProps.get("protocol") or self.protocol
+
+    async def _async_choose_protocol(self, session):
+        # the transport for the next connect
+        device = session.device
+        setting = self._protocol_setting(device)
+        if setting != AUTO_PROTOCOL:
+            return setting
+        if session.protocol_checked is None:     # first connect since the device started
+            session.protocol_checked = float(device.pluginProps.get("autoProtocolChecked") or 0)
+            if device.pluginProps.get("autoProtocol") and not session.protocol:
+                session.protocol = device.pluginProps["autoProtocol"]
+        if session.protocol and not self._protocol_check_due(session):
+            return session.protocol
+        return await self._async_evaluate_protocols(session)
+
+    @staticmethod
+    def _protocol_check_due(session):
+        if time.time() - (session.protocol_checked or 0.0) > PROTOCOL_RECHECK_INTERVAL:
+            return True
+        metrics = session.metrics
+        base_commands, base_failures = session.protocol_error_base
+        commands = metrics.commands - base_commands
+        failures = sum(metrics.failures.values()) - base_failures
+        return commands >= PROTOCOL_MIN_COMMANDS and failures / commands > PROTOCOL_ERROR_RATE
+
+    async def _async_protocol_changed(self, session, client):
+        # while connected: True if the hub should reconnect with another transport
+        current = session.protocol
+        setting = self._protocol_setting(session.device)
+        if setting != AUTO_PROTOCOL:
+            return setting != current
+        if not self._protocol_check_due(session):
+            return False
+        return await self._async_evaluate_protocols(session, client) != current
+
+    async def _async_evaluate_protocols(self, session, client=None):
+        """
+        Time both transports at once and remember the better one for the hub.  With client, the connected
+        transport is timed on that connection and the other one with a probe client, and the hub only switches when
+        the other is clearly better.
+        """
+        device = session.device
+        current = session.protocol
+        protocols = (WEBSOCKETS, XMPP)
+        timings = await asyncio.gather(*(self._async_time_round_trips(client) if client and protocol == current
+                                         else self._async_probe_protocol(device, protocol) for protocol in protocols))
+        results = dict(zip(protocols, timings))     # protocol -> (errors, median seconds)
+
+        choice = min(results, key=lambda protocol: results[protocol])
+        if results[choice][0] >= PROTOCOL_PROBE_ROUNDS:
+            choice = current or WEBSOCKETS      # neither answered, leave it to the normal reconnect
+        elif client and current in results and choice != current and results[choice][0] == results[current][0] \
+                and results[choice][1] > results[current][1] * PROTOCOL_SWITCH_MARGIN:
+            choice = current
+
+        summary = ", ".join(f"{protocol} {'not reachable' if errors >= PROTOCOL_PROBE_ROUNDS else f'p50 {median * 1000:.0f} ms, {errors} errors'}"
+                            for protocol, (errors, median) in results.items())
+        self.logger.info(f"{device.name}: Using {choice} ({summary})")
+        now = time.time()
+        session.protocol = choice
+        session.protocol_checked = now
+        session.protocol_error_base = (session.metrics.commands, sum(session.metrics.failures.values()))
+        self._message_pipeline.submit(device.id, {'type': "plugin.updateHubProps", 'device_id': device.id,
+                                                  'data': {'autoProtocol': choice, 'autoProtocolChecked': str(int(now))}})
+        return choice
+
+    async def _async_probe_protocol(self, device, protocol):
+        # a separate connection just for timing, without callbacks or a listener
+        client = HarmonyAPI(ip_address=device.address, protocol=protocol)
+        try:
+            async with self._connect_semaphore:
+                connected = await asyncio.wait_for(client.connect(), PROTOCOL_PROBE_TIMEOUT)
+        except (ConnectionRefusedError, OSError, asyncio.TimeoutError, aioharmony.exceptions.TimeOut):
+            connected = False
+        try:
+            if not connected:
+                return PROTOCOL_PROBE_ROUNDS, math.inf
+            return await self._async_time_round_trips(client)
+        finally:
+            await self._async_close_client(device, client)
+
+    async def _async_time_round_trips(self, client):
+        samples = []
+        errors = 0
+        for _ in range(PROTOCOL_PROBE_ROUNDS):
+            started = time.monotonic()
+            if await self._async_ping_hub(client) is None:
+                errors += 1
+            else:
+                samples.append(time.monotonic() - started)
+        return errors, statistics.median(samples) if samples else math.inf
+
+    ########################################
+    # Hub connection supervision
+    ########################################
+
+    def _update_connection_state(self, hub_id, state, protocol=None):
+        # on the event loop, the states are written by a pipeline worker
+        self._log_event(hub_id, "connection", protocol or "", state)
+        session = self._sessions.get(hub_id)
+        stateList = [{'key': 'connectionState', 'value': state},
+                     {'key': 'reconnectCount', 'value': session.reconnects if session else 0}
+                     ]
+        if protocol:
+            stateList.append({'key': 'connectionProtocol', 'value': protocol})
+        self._message_pipeline.submit(hub_id, {'type': "plugin.updateHubStates", 'device_id': hub_id, 'data': stateList})
+
+    def _current_session(self, session):
+        # False once the device has been stopped or started again, for callbacks that outlive their session
+        return not session.closed and self._sessions.get(session.device.id) is session
+
+    def hub_connected(self, session, ip_address):
+        # aioharmony callback when its transport (re)connects on its own
+        if self._current_session(session):
+            self._update_connection_state(session.device.id, "connected")
+
+    def hub_disconnected(self, session, ip_address):
+        # aioharmony callback when its transport drops, it will try to reconnect by itself first
+        self.logger.debug(f"{session.device.name}: disconnected from {ip_address}")
+        if self._current_session(session):
+            self._update_connection_state(session.device.id, "disconnected")
+
+    async def _async_start_device(self, session):
+        if not self._current_session(session):     # stopped again before this ran
             return
+        if self.eventLog:
+            self._open_event_log(session)
+        session.supervisor = asyncio.get_running_loop().create_task(self._async_supervise_hub(session))
+
+    async def _async_supervise_hub(self, session):
+        # Keep one hub connected: connect with exponential backoff and jitter, then watch the connection and
+        # start over when it goes stale.  Runs until cancelled by _async_stop_device.
+        device = session.device
+        attempt = 0
+        started = time.monotonic()
+        while True:
+            self._update_connection_state(device.id, "reconnecting" if session.reconnects else "connecting")
+            protocol = await self._async_choose_protocol(session)
+            client = await self._async_connect_hub(session, protocol)
+            if not client:
+                attempt += 1
+                if attempt == 1 and session.protocol_checked is not None:
+                    session.protocol_checked = 0.0      # an automatic choice is evaluated again before the next try
+                delay = min(RECONNECT_MAX_DELAY, RECONNECT_MIN_DELAY * 2 ** (attempt - 1))
+                delay = random.uniform(delay / 2, delay)
+                self.logger.debug(f"{device.name}: Connection attempt {attempt} failed, retrying in {delay:.1f} seconds")
+                self._update_connection_state(device.id, "disconnected")
+                if attempt >= REDISCOVER_ATTEMPTS:
+                    await self._async_rediscover_hub(session)
+                await asyncio.sleep(delay)
+                continue
+
+            self.logger.info(f"{device.name}: Connected to hub in {time.monotonic() - started:.2f} seconds"
+                             + (f" after {attempt + 1} attempts" if attempt else ""))
+            attempt = 0
+            self._update_connection_state(device.id, "connected", protocol)
+            self._flush_offline_actions(session)
+
+            if await self._async_monitor_hub(session, client) == "protocol":
+                setting = self._protocol_setting(device)
+                self.logger.info(f"{device.name}: Reconnecting using {session.protocol if setting == AUTO_PROTOCOL else setting}")
+            else:
+                session.reconnects += 1
+                self.logger.warning(f"{device.name}: Hub is not responding, reconnecting")
+            await session.release_client()
+            started = time.monotonic()
+
+    async def _async_connect_hub(self, session, protocol):
+        device = session.device
+        self.logger.debug(f"{device.name}: _async_connect_hub creating client")
+        callbacks = ClientCallbackType(connect=partial(self.hub_connected, session), disconnect=partial(self.hub_disconnected, session),
+                                       new_activity_starting=None, new_activity=None, config_updated=partial(self.config_updated, session))
+        client = HarmonyAPI(ip_address=device.address, protocol=protocol, callbacks=callbacks)
+
+        self.logger.debug(f"{device.name}: _async_connect_hub connecting client")
+        try:
+            async with self._connect_semaphore:
+                connected = await client.connect()
+        except (ConnectionRefusedError, OSError, asyncio.TimeoutError, aioharmony.exceptions.TimeOut) as e:
+            self.logger.debug(f"{device.name}: connect exception: {e}.")
+            connected = False
+        except asyncio.CancelledError:
+            await self._async_close_client(device, client)
+            raise
 
         if not connected:
             self.logger.debug(f"{device.name}: Failed to connect.")
-            return
+            await self._async_close_client(device, client)
+            return None
 
         self.logger.debug(f"{device.name}: Connected to HUB {client.name} ({client.ip_address}) using {client.protocol}")
-        self._async_running_clients[device.address] = client
+        session.protocol = protocol
+        session.client = client
+        session.connected = time.time()
+        if client.hub_id is not None and str(client.hub_id) != (session.remote_id or device.pluginProps.get("hubId")):
+            # remembered so the hub can be found again if its address changes
+            session.remote_id = str(client.hub_id)
+            self._message_pipeline.submit(device.id, {'type': "plugin.updateHubProps", 'device_id': device.id,
+                                                      'data': {'hubId': str(client.hub_id), 'hubName': client.name}})
+        if client.config and session.config is not client.config:    # config_updated wasn't called during connect
+            self.config_updated(session, client.config)
 
         self.logger.debug(f"{device.name}: Starting listener")
-        listener = Listener(device, client, self.message_handler)
+        session.listener = Listener(device, client, self.queue_message)
+        return client
+
+    async def _async_monitor_hub(self, session, client):
+        # Returns "stale" when the hub has failed PING_FAILURES health checks in a row, or "protocol" when it should
+        # reconnect using another transport.
+        device = session.device
+        failures = 0
+        wakeup = session.wakeup
+        refreshed_version = None    # config version last fetched by a health check, aioharmony doesn't record it
+        while failures < PING_FAILURES:
+            try:
+                await asyncio.wait_for(wakeup.wait(), PING_INTERVAL)
+                wakeup.clear()
+            except asyncio.TimeoutError:
+                pass
+            if await self._async_protocol_changed(session, client):
+                return "protocol"
+            self._publish_metrics(device.id)
+            state = await self._async_ping_hub(client)
+            if state is None:
+                failures += 1
+                self.logger.debug(f"{device.name}: Health check failed ({failures} of {PING_FAILURES})")
+                continue
+            failures = 0
+            version = state.get("configVersion")
+            if version not in (None, client.hub_config.config_version, refreshed_version) and state.get("syncStatus") != 1:
+                # the hub's own change notification was missed; the refresh ends in config_updated, as it would have
+                self.logger.debug(f"{device.name}: Health check found config version {version}, refreshing config")
+                try:
+                    if await self._async_harmony_internal(client, "refresh_info_from_hub") is not HARMONY_INTERNAL_MISSING:
+                        refreshed_version = version
+                except (OSError, asyncio.TimeoutError, aioharmony.exceptions.TimeOut) as e:
+                    self.logger.debug(f"{device.name}: Config refresh failed: {e}")
+        return "stale"
+
+    def _wake_monitors(self):
+        for session in self._sessions.values():
+            session.wakeup.set()
+
+    async def _async_harmony_internal(self, client, name, **kwargs):
+        """
+        Await client's underlying aioharmony HarmonyClient method name(**kwargs).  HarmonyAPI has no state digest
+        round trip and no config refresh, so this is the one place the plugin reaches past it.  If an aioharmony
+        upgrade has moved or changed the method, logs a warning once and returns HARMONY_INTERNAL_MISSING.
+        """
+        try:
+            coro = getattr(client._harmony_client, name)(**kwargs)
+        except (AttributeError, TypeError) as e:
+            if name not in self._missing_internals:
+                self._missing_internals.add(name)
+                self.logger.warning(f"This aioharmony version has no usable HarmonyClient.{name} ({e}), "
+                                    f"hub health checks and config polling are limited")
+            return HARMONY_INTERNAL_MISSING
+        return await coro
+
+    async def _async_ping_hub(self, client):
+        # The state digest is the cheapest round trip the hub offers, and it carries the config version so it also
+        # polls for config changes.  Returns the digest, or None if the hub didn't answer.  Without the digest the
+        # hub is taken to be up, and aioharmony's own disconnect callback is left to notice it going away.
+        try:
+            response = await asyncio.wait_for(self._async_harmony_internal(client, "send_to_hub", command="get_current_state",
+                                                                           send_timeout=PING_TIMEOUT),
+                                              timeout=PING_TIMEOUT * 2)
+        except (OSError, asyncio.TimeoutError, aioharmony.exceptions.TimeOut):
+            return None
+        if response is HARMONY_INTERNAL_MISSING:
+            return {}
+        if not response or str(response.get("code")) != "200":
+            return None
+        return response.get("data") or {}
+
+    def _flush_offline_actions(self, session):
+        # run the actions held while the hub was down, dropping any older than offlineBufferAge
+        device = session.device
+        client = session.client
+        buffer = session.offline_actions
+        if not client or not buffer:
+            return
+        now = time.monotonic()
+        while buffer:
+            queued, coro_factory = buffer.popleft()
+            if now - queued > self.offlineBufferAge:
+                self.logger.warning(f"{device.name}: Dropping action held for {now - queued:.0f} seconds")
+                continue
+            coro = coro_factory(client)
+            task = session.track(asyncio.get_running_loop().create_task(self._timed_call(coro, coro.__name__, queued)))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  # already logged by _timed_call
+
+    async def _async_close_client(self, device, client):
+        self.logger.debug(f"{device.name}: Closing connection")
+        try:
+            await asyncio.wait_for(client.close(), timeout=5)
+        except (asyncio.TimeoutError, aioharmony.exceptions.TimeOut):
+            self.logger.debug(f"{device.name}: Timeout trying to close connection.")
+        except Exception as e:
+            self.logger.debug(f"{device.name}: Error closing connection: {e}")
 
-    async def _async_stop_device(self, ip_address):
-        hub_client = self._async_running_clients[ip_address]
-        if not hub_client:
+    def config_updated(self, session, config):
+        # called by aioharmony on the event loop each time the hub's config is (re)loaded, either on connect or
+        # when the hub reports a new config version.  The index is only touched if the config differs from the one
+        # it was built from, which may have come from the cache, and then only the parts that changed.
+        if not self._current_session(session):
+            return
+        hub_id = session.device.id
+        old_config = session.config
+        session.config = config
+        config_hash = HubIndex.hash_config(config)
+        hub_index = session.index
+        if hub_index and hub_index.config_hash == config_hash:
+            self.logger.debug(f"Hub {hub_id}: config unchanged, keeping command index and menus")
             return
 
-        self.logger.debug(f"{hub_client.name} HUB: Closing connection")
+        if hub_index and old_config is not None:
+            changes = HubIndex.diff_configs(old_config, config)
+            self.logger.info(f"Hub {hub_id}: Harmony config changed: {HubIndex.describe_changes(changes)}")
+            hub_index = hub_index.updated(config, changes)
+        else:
+            self.logger.debug(f"Hub {hub_id}: config received, building command index and menus")
+            changes = None
+            hub_index = HubIndex(config)
+        hub_index.config_hash = config_hash
+        session.index = hub_index
+        asyncio.get_running_loop().run_in_executor(None, self._save_hub_cache, hub_id, config, hub_index)
+        self._message_pipeline.submit(hub_id, {'type': "plugin.configUpdated", 'device_id': hub_id, 'data': changes})
+
+    ########################################
+    # On-disk config cache, so menus and command lookups work before the hub connects
+    ########################################
+
+    def _hub_cache_path(self, hub_id):
+        return os.path.join(self.cache_folder, f"hub-{hub_id}.json.gz")
+
+    def _load_hub_cache(self, session):
+        device = session.device
         try:
-            await asyncio.wait_for(hub_client.close(), timeout=5)
-        except aioharmony.exceptions.TimeOut:
-            self.logger.debug(f"{hub_client.name} HUB: Timeout trying to close connection.")
+            with gzip.open(self._hub_cache_path(device.id), "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, EOFError, ValueError) as e:
+            self.logger.warning(f"{device.name}: Unable to read cached hub config: {e}")
+            return
 
-    async def show_config(self, client):
-        if client.config:
-            self.logger.info(f"HUB: {client.name}\n{json.dumps(client.config, sort_keys=True, indent=4)}")
-        else:
-            self.logger.warning(f"HUB: {client.name} There was a problem retrieving the configuration")
+        if data.get("version") != CONFIG_CACHE_VERSION:
+            self.logger.debug(f"{device.name}: Ignoring cached hub config with version {data.get('version')}")
+            return
+        try:
+            hub_index = HubIndex.from_cache(data["config"], data["index"], data["hash"])
+        except (KeyError, TypeError, ValueError) as e:
+            self.logger.warning(f"{device.name}: Ignoring invalid cached hub config: {e}")
+            return
+        session.config = data["config"]
+        session.index = hub_index
+        self.logger.debug(f"{device.name}: Loaded cached hub config {data['hash']}")
+
+    def _save_hub_cache(self, hub_id, config, hub_index):
+        # runs in an executor thread, the file is written compact and gzipped then moved into place
+        path = self._hub_cache_path(hub_id)
+        data = {"version": CONFIG_CACHE_VERSION, "hash": hub_index.config_hash, "config": config, "index": hub_index.to_cache()}
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            self.logger.warning(f"Hub {hub_id}: Unable to write hub config cache: {e}")
+
+    async def _async_stop_device(self, session):
+        started = time.monotonic()
+        await session.close()
+        self.logger.info(f"{session.device.name}: Stopped in {time.monotonic() - started:.2f} seconds")
+
+    ########################################
+    # Hub commands, timed into the hub's HubMetrics
+    ########################################
+
+    def _session_for(self, client):
+        # the session currently connected with client, None for probe clients and ones already released
+        for session in list(self._sessions.values()):
+            if session.client is client:
+                return session
+        return None
+
+    def _hub_index(self, hub_id):
+        session = self._sessions.get(hub_id)
+        return session.index if session else None
+
+    def _command_spacing(self, hub_device):
+        # (default seconds, {Harmony device id: seconds}) from the hub device's settings or the plugin's
+        spacing = hub_device.pluginProps.get("commandSpacing", "")
+        try:
+            spacing = int(spacing) if str(spacing).strip() else self.commandSpacing
+        except ValueError:
+            spacing = self.commandSpacing
+        device_spacing = dict()
+        for entry in hub_device.pluginProps.get("deviceSpacing", "").replace("\n", ",").split(","):
+            if not entry.strip():
+                continue
+            try:
+                device_id, ms = entry.split("=")
+                device_spacing[device_id.strip()] = int(ms) / 1000.0
+            except ValueError:
+                self.logger.warning(f"{hub_device.name}: Ignoring invalid device spacing '{entry.strip()}', use <device id>=<milliseconds>")
+        return spacing / 1000.0, device_spacing
+
+    async def _queued(self, session, priority, target, coro_factory, supersede=False):
+        # run coro_factory() through the session's command queue, or straight away without a session
+        command_queue = session.command_queue if session else None
+        if not command_queue:
+            return await coro_factory()
+        if supersede and command_queue.depth:
+            self.logger.info(f"{command_queue.name}: Dropping {command_queue.depth} queued commands for the activity change")
+        return await command_queue.run(priority, target, coro_factory, supersede=supersede)
+
+    def _metrics_states(self, hub_id):
+        # the hub's metric states if they changed since they were last published, otherwise None
+        session = self._sessions.get(hub_id)
+        if not session or not session.metrics.changed:
+            return None
+        session.metrics.changed = False
+        return session.metrics.states() + [{'key': 'commandQueueDepth', 'value': session.command_queue.depth}]
+
+    def _publish_metrics(self, hub_id):
+        # on the event loop, the states are written by a pipeline worker
+        states = self._metrics_states(hub_id)
+        if states:
+            self._message_pipeline.submit(hub_id, {'type': "plugin.updateHubStates", 'device_id': hub_id, 'data': states})
 
     async def start_activity(self, client, activity_id=None):
         if activity_id is None:
             self.logger.debug(f"HUB: {client.name} No activity provided to start")
             return
 
-        status = await client.start_activity(activity_id)
-        self.logger.debug(f"HUB: {client.name} Start activity {activity_id} returned {status}")
+        started = invoked_at.get() or time.monotonic()
+        session = self._session_for(client)
+        metrics = session.metrics if session else None
+        if metrics:
+            metrics.activity_started(activity_id, started)
+        hub_id = session.device.id if session else None
+        token = None
+        if self.optimisticActivity and hub_id:
+            token = next(self._activity_tokens)
+            self._message_pipeline.submit(hub_id, {'type': "plugin.activityPending", 'device_id': hub_id,
+                                                   'data': {'activityId': str(activity_id), 'token': token}})
+            # timed from now, aioharmony only returns once the hub has finished switching
+            asyncio.get_running_loop().call_later(self.optimisticTimeout, self._activity_not_started, client, hub_id, token,
+                                                  "activityTimeout", f"no response from the hub in {self.optimisticTimeout:g} seconds")
+        try:
+            # an activity change makes whatever is still queued for the hub pointless
+            status = await self._queued(session, HubCommandQueue.ACTIVITY, None, partial(client.start_activity, activity_id), supersede=True)
+        except Exception as e:
+            if metrics:
+                metrics.record(metrics.activity_latency, time.monotonic() - started, codes=[type(e).__name__])
+            if token:
+                self._activity_not_started(client, hub_id, token, "activityFailed", type(e).__name__)
+            raise
+        if metrics:
+            metrics.record(metrics.activity_latency, time.monotonic() - started, codes=[] if status and status[0] else ["failed"])
+        if token and not (status and status[0]):
+            self._activity_not_started(client, hub_id, token, "activityFailed", status[1] if status else "not sent")
+        self._trace(hub_id or TRACE_PLUGIN, "activityStarted", activity_id, status)
+        return status
+
+    def _activity_not_started(self, client, hub_id, token, kind, reason):
+        # on the event loop; the hub's current activity goes along so the pipeline can reconcile with it
+        self._message_pipeline.submit(hub_id, {'type': f"plugin.{kind}", 'device_id': hub_id,
+                                               'data': {'token': token, 'reason': reason, 'actualActivityId': str(client.current_activity[0])}})
 
     async def power_off(self, client):
-        status = await client.power_off()
-        self.logger.debug(f"HUB: {client.name} Power Off returned {status}")
+        return await self.start_activity(client, -1)
+
+    async def send_activity_command(self, client, hub_id, command_name, delay=0):
+        activity_id, activity_name = client.current_activity
+        if int(activity_id) <= 0:
+            self.logger.debug(f"HUB: {client.name} Can't send Activity commands when no Activity is running")
+            return None
+
+        (device, command) = self.findDeviceForCommand(self._sessions[hub_id].index, command_name, activity_id)
+        if device is None:
+            self.logger.warning(f"HUB: {client.name} sendCurrentActivityCommand: No command '{command_name}' in current activity")
+            return None
+
+        self._trace(hub_id, "activityCommand", command_name, device, command, delay)
+        return await self.send_command(client, device, command, delay)
+
+    async def send_device_command(self, client, hub_id, device_id, command_name, delay=0):
+        command = self.findCommandForDevice(self._sessions[hub_id].index, command_name, device_id)
+        if command is None:
+            self.logger.warning(f"HUB: {client.name} sendDeviceCommand: No command '{command_name}' for device {device_id}")
+            return None
+
+        self._trace(hub_id, "deviceCommand", command_name, device_id, command, delay)
+        return await self.send_command(client, device_id, command, delay)
+
+    async def fan_out(self, hub_ids, coro_factory, description):
+        """
+        Run coro_factory(client, hub_id), which returns (success, detail), on every hub at once and log one summary.
+        Hubs that aren't connected fail straight away rather than waiting for a reconnect.
+        """
+        async def run(hub_id):
+            session = self._sessions.get(hub_id)
+            client = session.client if session else None
+            result = {'hub': self.hub_devices[hub_id].name, 'success': False, 'latency': 0.0, 'detail': "not connected"}
+            if client:
+                started = time.monotonic()
+                try:
+                    result['success'], result['detail'] = await coro_factory(client, hub_id)
+                except CommandSuperseded:
+                    result['detail'] = "superseded"
+                except Exception as e:
+                    result['detail'] = f"{type(e).__name__}: {e}"
+                result['latency'] = round(time.monotonic() - started, 3)
+            return result
+
+        started = time.monotonic()
+        # one hub failing in an unexpected way still leaves the others' results for the summary
+        outcomes = await asyncio.gather(*(run(hub_id) for hub_id in hub_ids), return_exceptions=True)
+        results = {}
+        for hub_id, outcome in zip(hub_ids, outcomes):
+            if isinstance(outcome, BaseException):
+                hub_device = self.hub_devices.get(hub_id)
+                outcome = {'hub': hub_device.name if hub_device else str(hub_id), 'success': False, 'latency': 0.0,
+                           'detail': f"{type(outcome).__name__}: {outcome}"}
+            results[hub_id] = outcome
+        succeeded = sum(1 for result in results.values() if result['success'])
+        summary = ", ".join(f"{result['hub']}: {'ok' if result['success'] else result['detail']} ({result['latency'] * 1000:.0f} ms)"
+                            for result in results.values())
+        log = self.logger.info if succeeded == len(results) else self.logger.warning
+        log(f"{description}: {succeeded} of {len(results)} hubs in {time.monotonic() - started:.2f} seconds.  {summary}")
+        return results
+
+    async def _fan_out_activity(self, client, hub_id, name=None):
+        # name None powers the hub off
+        if name is None:
+            activity_id = "-1"
+        else:
+            hub_index = self._hub_index(hub_id)
+            activity_id = hub_index.activity_named(name) if hub_index else None
+            if activity_id is None:
+                return False, f"no activity named '{name}'"
+        status = await self.start_activity(client, int(activity_id))
+        if status and status[0]:
+            return True, "started"
+        return False, f"failed: {status[1] if status else 'not sent'}"
+
+    async def _fan_out_command(self, client, hub_id, device_name, command_name, delay=0):
+        if device_name in ("", "activity"):
+            result = await self.send_activity_command(client, hub_id, command_name, delay)
+            if result is None:
+                return False, f"no command '{command_name}' in the current activity"
+        else:
+            hub_index = self._hub_index(hub_id)
+            device_id = hub_index.device_named(device_name) if hub_index else None
+            if device_id is None:
+                return False, f"no device named '{device_name}'"
+            result = await self.send_device_command(client, hub_id, device_id, command_name, delay)
+            if result is None:
+                return False, f"no command '{command_name}' for {device_name}"
+        if result:
+            return False, f"failed with code {result[0].code}"
+        return True, "sent"
+
+    async def send_command_sequence(self, client, hub_id, steps, replace=True):
+        """
+        Send a resolved command sequence as one batch and return a result dict for each step.  With replace, a
+        sequence still running on this hub is cancelled first, otherwise the hub runs them one after the other.
+        """
+        hub_index = self._hub_index(hub_id)
+        activity_id = client.current_activity[0]
+        results = []
+        batch = []
+        step_for_command = {}   # id() of each SendCommandDevice -> its step number
+        for n, (target, command_name, repeat, pause) in enumerate(steps):
+            results.append({'device': target, 'command': command_name, 'repeat': repeat, 'status': "sent"})
+            if not hub_index:
+                device_id, command = None, None
+            elif target == "activity":
+                device_id, command = self.findDeviceForCommand(hub_index, command_name, activity_id) if int(activity_id) > 0 else (None, None)
+            else:
+                device_id, command = target, self.findCommandForDevice(hub_index, command_name, target)
+            if command is None:
+                results[n]['status'] = "unresolved"
+                continue
+            for _ in range(repeat):
+                snd_cmd = SendCommandDevice(device=device_id, command=command, delay=0)
+                step_for_command[id(snd_cmd)] = n
+                batch.append(snd_cmd)
+                if pause:
+                    batch.append(pause)
+
+        unresolved = [f"{result['device']}/{result['command']}" for result in results if result['status'] == "unresolved"]
+        if unresolved:
+            self.logger.warning(f"HUB: {client.name} Command sequence not sent, unknown commands: {', '.join(unresolved)}")
+            for result in results:
+                if result['status'] == "sent":
+                    result['status'] = "skipped"
+            return results
+        while batch and not isinstance(batch[-1], SendCommandDevice):     # no need to pause after the last command
+            batch.pop()
+
+        task = asyncio.current_task()
+        session = self._sessions.get(hub_id)
+        running = session.sequence if session else None
+        if replace and running and not running.done():
+            self.logger.info(f"HUB: {client.name} Cancelling the running command sequence")
+            session.cancelled_sequence = running
+            running.cancel()
+        if session:
+            session.sequence = task
+
+        metrics = session.metrics if session else None
+        started = time.monotonic()
+        try:
+            failures = await self._queued(session, HubCommandQueue.NAVIGATION, None, partial(client.send_commands, batch))
+        except (asyncio.CancelledError, CommandSuperseded) as e:
+            # the hub may already have run part of it, there is no way to tell which
+            self.logger.info(f"HUB: {client.name} Command sequence cancelled")
+            for result in results:
+                result['status'] = "cancelled"
+            if isinstance(e, asyncio.CancelledError) and not (session and session.cancelled_sequence is task):
+                raise   # the hub or the plugin is stopping, or a wait timed out
+            return results
+        finally:
+            if session and session.sequence is task:
+                session.sequence = None
+            if session and session.cancelled_sequence is task:
+                session.cancelled_sequence = None
+
+        for failure in failures or []:
+            result = results[step_for_command[id(failure.command)]]
+            result['status'] = "failed"
+            result.setdefault('errors', []).append(f"{failure.code}: {failure.msg}")
+            self.logger.warning(f"HUB: {client.name} Sequence command {failure.command.command} to device {failure.command.device} failed with code {failure.code}: {failure.msg}")
+        if metrics:
+            metrics.record_sequence(sum(isinstance(item, SendCommandDevice) for item in batch), [failure.code for failure in failures or []])
+        self.logger.debug(f"HUB: {client.name} Command sequence of {len(steps)} steps sent in {time.monotonic() - started:.2f} seconds")
+        return results
+
+    def _cancel_command_sequence(self, hub_id):
+        session = self._sessions.get(hub_id)
+        if session and session.sequence and not session.sequence.done():
+            session.cancelled_sequence = session.sequence
+            session.sequence.cancel()
 
     async def send_command(self, client, device_id, command, delay=0):
         snd_cmd = SendCommandDevice(
@@ -597,10 +3391,23 @@ class Plugin(indigo.PluginBase):
             command=command,
             delay=delay,
         )
-        result_list = await client.send_commands(snd_cmd)
+        started = invoked_at.get() or time.monotonic()
+        session = self._session_for(client)
+        metrics = session.metrics if session else None
+        priority = HubCommandQueue.REPEAT if command.startswith(REPEAT_COMMAND_PREFIXES) else HubCommandQueue.NAVIGATION
+        try:
+            result_list = await self._queued(session, priority, device_id, partial(client.send_commands, snd_cmd))
+        except Exception as e:
+            if metrics:
+                metrics.record(metrics.command_latency, time.monotonic() - started, codes=[type(e).__name__])
+            raise
+        if metrics:
+            metrics.record(metrics.command_latency, time.monotonic() - started, codes=[result.code for result in result_list or []])
+
         if result_list:
             for result in result_list:
-                self.logger.debug(
+                self.logger.warning(
                     f"HUB: {client.name} Sending of command {result.command.command} to device {result.command.device} failed with code {result.code}: {result.msg}")
         else:
-            self.logger.debug(f"{client.name}: '{command}' command sent")
+            self._trace(session.device.id if session else TRACE_PLUGIN, "commandSent", device_id, command)
+        return result_list
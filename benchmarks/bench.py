@@ -0,0 +1,368 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+"""
+Benchmarks for the Harmony Hub plugin, run against the stub indigo module and local fake hubs.
+
+    python benchmarks/bench.py                                  # run everything, print results
+    python benchmarks/bench.py --compare benchmarks/baseline.json
+    python benchmarks/bench.py --save /tmp/before.json          # then, after a change, --compare /tmp/before.json
+
+--compare prints each result next to the baseline and exits with status 1 if any result is worse than the baseline
+by more than its tolerance, or has no baseline to compare with.  Pure Python timings are the median of several
+repetitions, each preceded by a fixed calibration workload whose median time is saved with the result.  They are
+compared after scaling the baseline by the ratio of the two calibration times, so a baseline recorded on another
+machine, or while this one was busier, still applies, and may be 50% worse.  The ConfigUI generators take
+microseconds and may take twice as long.  Round trips to the fake hubs, startup, discovery and fan-out depend on the
+network stack and the scheduler more than on the CPU: they are compared as they are and may take twice as long
+(shutdown three times, it includes the final event history write, and the 95th percentile command times too, they
+are the slowest few of 200).  Counts of Indigo server calls per event may be 5% higher.  --tolerance replaces all of these with one value.
+
+benchmarks/baseline.json is the fixed reference.  Re-record it only when benchmarks are added or changed, not to
+make a slower result pass.  To measure one change, --save a run before it to a scratch file and --compare against
+that.
+"""
+
+import argparse
+import asyncio
+import copy
+import gc
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import indigo     # noqa - the stub, must be installed before plugin.py is loaded
+import harness
+from fake_hub import synthetic_config
+
+CONFIG_SIZES = {                # (activities, devices, functions per device)
+    "small": (5, 10, 20),
+    "medium": (20, 40, 60),
+    "large": (50, 100, 150),
+}
+
+results = {}
+limits = {}         # benchmark name -> (tolerance, scaled), see the module docstring
+calibration = None  # ms for calibration_work() while the last scaled timing was taken, see median_of
+
+
+def record(name, value, unit, better="lower", tolerance=1.0, scaled=False):
+    results[name] = {"value": round(value, 4), "unit": unit, "better": better}
+    if scaled:
+        results[name]["calibration"] = round(calibration, 4)
+    limits[name] = (tolerance, scaled)
+    print(f"  {name:45s} {value:12.3f} {unit}")
+
+
+def calibration_work():
+    # the same pure Python work on every run: string keys, dicts and a sort, like building a HubIndex
+    index = {}
+    for n in range(5000):
+        key = (str(n % 500), f"Function{n}")
+        index[key] = {"id": n, "label": key[1].lower()}
+    return sorted(index, key=lambda key: index[key]["label"])
+
+
+def median_of(func, repeat=15, number=1, scaled=False):
+    # like timeit, with the garbage collector off so a collection doesn't land in one size's timing.  scaled also
+    # times calibration_work() before each repetition, so the machine slowing down part way through shows in both,
+    # and leaves their median in calibration for record()
+    global calibration
+    times = []
+    calibration_times = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            if scaled:
+                started = time.perf_counter()
+                calibration_work()
+                calibration_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            for _ in range(number):
+                func()
+            times.append((time.perf_counter() - started) / number)
+    finally:
+        gc.enable()
+    if scaled:
+        calibration = statistics.median(calibration_times) * 1000
+    return statistics.median(times)
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+########################################
+
+def bench_index():
+    print("HubIndex build and ConfigUI generators")
+    module = harness.load_plugin_module()
+    plugin = harness.make_plugin()
+    for size, dimensions in CONFIG_SIZES.items():
+        config = synthetic_config(*dimensions)
+        record(f"index.build.{size}", median_of(lambda: module.HubIndex(config), scaled=True) * 1000, "ms", tolerance=0.5, scaled=True)
+        record(f"index.hash.{size}", median_of(lambda: module.HubIndex.hash_config(config), scaled=True) * 1000, "ms", tolerance=0.5, scaled=True)
+
+        # one device edited in the Harmony app: diff plus incremental update
+        edited = copy.deepcopy(config)
+        edited["device"][0]["controlGroup"][0]["function"].pop()
+        hub_index = module.HubIndex(config)
+
+        def update():
+            hub_index.updated(edited, module.HubIndex.diff_configs(config, edited))
+
+        record(f"index.update.{size}", median_of(update, scaled=True) * 1000, "ms", tolerance=0.5, scaled=True)
+
+        harness.add_session(plugin, indigo.Device(1, "Hub", "harmonyHub", address="127.0.0.2"), config)
+        device_id = config["device"][0]["id"]
+        group = config["device"][0]["controlGroup"][0]["name"]
+        calls = [
+            (plugin.activityListGenerator, {}, "startActivity"),
+            (plugin.deviceListGenerator, {}, "sendDeviceCommand"),
+            (plugin.commandGroupListGenerator, {"device": device_id}, "sendDeviceCommand"),
+            (plugin.commandListGenerator, {"device": device_id, "group": group}, "sendDeviceCommand"),
+            (plugin.commandListGenerator, {"group": group}, "sendCurrentActivityCommand"),
+        ]
+
+        def generate():
+            for generator, values, type_id in calls:
+                generator("", values, type_id, 1)
+
+        record(f"generators.{size}", median_of(generate, number=2000, scaled=True) * 1e6, "us", tolerance=1.0, scaled=True)
+
+
+def bench_message_handler(count=20000, passes=5):
+    print("message_handler throughput")
+    indigo.reset()
+    plugin = harness.make_plugin()
+    config = synthetic_config(*CONFIG_SIZES["medium"])
+    hub = indigo.devices.add(indigo.Device(1, "Hub", "harmonyHub", address="127.0.0.2"))
+    plugin.hub_devices[hub.id] = hub
+    harness.add_session(plugin, hub, config)
+    activity_ids = [activity["id"] for activity in config["activity"]]
+    for n, activity_id in enumerate(activity_ids[1:11]):
+        plugin.deviceStartComm(harness.add_activity_device(100 + n, hub, activity_id))
+
+    messages = []
+    for n in range(count):
+        kind = n % 3
+        if kind == 0:
+            messages.append({"type": "automation.state?notify", "device_id": hub.id,
+                             "data": {f"light-{n % 8}": {"on": bool(n % 2), "brightness": n % 255, "status": 0}}})
+        elif kind == 1:
+            messages.append({"type": "connect.stateDigest?notify", "device_id": hub.id,
+                             "data": {"activityId": activity_ids[n % len(activity_ids)], "activityStatus": 2}})
+        else:
+            messages.append({"type": "harmony.engine?startActivityFinished", "device_id": hub.id,
+                             "data": {"activityId": activity_ids[n % len(activity_ids)], "errorCode": "200", "errorString": "OK"}})
+
+    def handle():
+        for message in messages:
+            plugin.message_handler(message)
+
+    indigo.server_calls.clear()
+    elapsed = median_of(handle, repeat=passes, scaled=True)
+    record("message_handler.events_per_sec", count / elapsed, "events/s", better="higher", tolerance=0.5, scaled=True)
+    record("message_handler.server_calls_per_event", sum(indigo.server_calls.values()) / (count * passes), "calls", tolerance=0.05)
+
+
+def bench_live(commands=200, activities=20, hub_counts=(1, 4, 8)):
+    print("Live plugin against fake hubs")
+    hubs = harness.FakeHubThread()
+    try:
+        config = synthetic_config(*CONFIG_SIZES["medium"])
+        for hub_count in hub_counts:
+            indigo.reset()
+            plugin = harness.make_plugin({"commandSpacing": "0"})     # back-to-back round trips, not IR pacing
+            fakes = hubs.start_hubs(hub_count, config=config, activity_delay=0.01)
+            devices = [harness.add_hub_device(10 + n, fake) for n, fake in enumerate(fakes)]
+
+            started = time.perf_counter()
+            plugin.startup()
+            for device in devices:
+                plugin.deviceStartComm(device)
+            if not harness.wait_for(lambda: all(harness.hub_connected(plugin, d) for d in devices)):
+                raise RuntimeError(f"{hub_count} fake hubs did not connect")
+            record(f"startup.{hub_count}_hubs", (time.perf_counter() - started) * 1000, "ms")
+
+            if hub_count == hub_counts[0]:
+                _bench_commands(hubs, plugin, devices[0], config, commands, activities)
+            else:
+                _bench_fan_out(plugin, hub_count, config)
+
+            started = time.perf_counter()
+            for device in devices:
+                plugin.deviceStopComm(device)
+            plugin.shutdown()
+            record(f"shutdown.{hub_count}_hubs", (time.perf_counter() - started) * 1000, "ms", tolerance=2.0)
+
+            for fake in fakes:
+                hubs.run(fake.stop())
+            hubs.hubs = [hub for hub in hubs.hubs if hub not in fakes]
+    finally:
+        hubs.stop()
+
+
+def _bench_commands(hubs, plugin, device, config, commands, activities):
+    config_device = config["device"][0]
+    props = {"device": config_device["id"], "command": "Function0", "wait": True}
+    action = harness.PluginAction("sendDeviceCommand", device.id, props)
+    plugin.sendDeviceCommand(action)   # warm up
+
+    samples = []
+    for _ in range(commands):
+        started = time.perf_counter()
+        if plugin.sendDeviceCommand(action) is None:
+            raise RuntimeError("sendDeviceCommand got no result")
+        samples.append(time.perf_counter() - started)
+    record("command.p50", percentile(samples, 50) * 1000, "ms")
+    record("command.p95", percentile(samples, 95) * 1000, "ms", tolerance=2.0)
+    record("command.mean", statistics.mean(samples) * 1000, "ms")
+
+    samples = []
+    activity_ids = [activity["id"] for activity in config["activity"][1:]]
+    for n in range(activities):
+        action = harness.PluginAction("startActivity", device.id, {"activity": activity_ids[n % len(activity_ids)], "wait": True})
+        started = time.perf_counter()
+        plugin.startActivity(action)
+        samples.append(time.perf_counter() - started)
+    record("activity.p50", percentile(samples, 50) * 1000, "ms")
+
+    # commands while the hub floods the plugin with notifications and each Indigo server call takes 1 ms
+    # also counts the automation broadcasts made per notification in the flood
+    fake = hubs.hubs[0]
+    indigo.ipc_delay = 0.001
+    indigo.server_calls.clear()
+    flood = asyncio.run_coroutine_threadsafe(fake.emit("automation", 500, 3), hubs.loop)
+    try:
+        time.sleep(0.5)
+        action = harness.PluginAction("sendDeviceCommand", device.id, props)
+        samples = []
+        for _ in range(commands):
+            started = time.perf_counter()
+            plugin.sendDeviceCommand(action)
+            samples.append(time.perf_counter() - started)
+        record("command.p95_under_events", percentile(samples, 95) * 1000, "ms", tolerance=2.0)
+        sent = flood.result(30)
+        harness.wait_for(lambda: plugin._message_pipeline.depth() == 0, timeout=10)
+        time.sleep(0.5)
+        record("automation.broadcasts_per_event", indigo.server_calls["broadcastToSubscribers"] / sent, "calls")
+    finally:
+        flood.cancel()
+        indigo.ipc_delay = 0.0
+
+
+def bench_discovery(hub_count=8):
+    print("Hub discovery")
+    indigo.reset()
+    hubs = harness.FakeHubThread()
+    try:
+        hubs.start_hubs(hub_count)
+        plugin = harness.make_plugin({"discoverySubnet": "127.0.0.0/24"})
+        plugin.startup()
+        try:
+            addresses = plugin._discovery_addresses()
+            found = plugin.dispatch(plugin.async_discover_hubs(addresses), wait=True, timeout=60)
+            if len(found) != hub_count:
+                raise RuntimeError(f"discovery found {len(found)} of {hub_count} fake hubs")
+
+            # a single scan is at the mercy of the scheduler, like the fan-out take the median of a few
+            scan = median_of(lambda: plugin.dispatch(plugin.async_discover_hubs(addresses), wait=True, timeout=60), repeat=5)
+            record(f"discovery.scan_{len(addresses)}", scan * 1000, "ms")
+            find_one = median_of(lambda: plugin.dispatch(plugin.async_discover_hubs(addresses, hub_id=str(1000 + hub_count - 1)),
+                                                         wait=True, timeout=60), repeat=5)
+            record("discovery.find_one", find_one * 1000, "ms")
+        finally:
+            plugin.shutdown()
+    finally:
+        hubs.stop()
+
+
+def _bench_fan_out(plugin, hub_count, config, rounds=10):
+    # one Start Activity on Hubs action for every hub, wall time until all have finished
+    samples = []
+    names = [activity["label"] for activity in config["activity"][1:]]
+    for n in range(rounds):
+        action = harness.PluginAction("startActivityOnHubs", 0, {"activityName": names[n % len(names)], "wait": True})
+        started = time.perf_counter()
+        results = plugin.startActivityOnHubs(action)
+        samples.append(time.perf_counter() - started)
+        if not results or not all(result["success"] for result in results.values()):
+            raise RuntimeError(f"fan-out activity failed: {results}")
+    record(f"fanout.activity.{hub_count}_hubs", percentile(samples, 50) * 1000, "ms")
+
+
+BENCHMARKS = {
+    "index": bench_index,
+    "message_handler": bench_message_handler,
+    "live": bench_live,
+    "discovery": bench_discovery,
+}
+
+
+########################################
+
+def compare(baseline_path, tolerance=None):
+    baseline = json.loads(Path(baseline_path).read_text())["results"]
+    print()
+    regressions = []
+    print(f"{'benchmark':45s} {'expected':>12s} {'current':>12s} {'change':>8s} {'allowed':>8s}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or not base["value"]:
+            regressions.append(name)
+            print(f"{name:45s} {'-':>12s} {result['value']:12.3f}  <-- not in the baseline")
+            continue
+        allowed, scaled = limits[name]
+        if tolerance is not None:
+            allowed = tolerance
+        expected = base["value"]
+        if scaled and base.get("calibration"):
+            speed = result["calibration"] / base["calibration"]     # > 1 when this run's machine is slower
+            expected = expected * speed if result["better"] == "lower" else expected / speed
+        ratio = result["value"] / expected
+        worse = ratio > 1 + allowed if result["better"] == "lower" else ratio < 1 / (1 + allowed)
+        if worse:
+            regressions.append(name)
+        print(f"{name:45s} {expected:12.3f} {result['value']:12.3f} {(ratio - 1) * 100:+7.1f}% {allowed * 100:7.0f}%{'  <-- worse' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Harmony Hub plugin benchmarks")
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, help="one tolerance for every benchmark, e.g. 0.1 for 10%%")
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.ERROR)
+    indigo.install()
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name]()
+
+    if args.save:
+        data = {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+        Path(args.save).write_text(json.dumps(data, indent=2, sort_keys=True) + "\n")
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        regressions = compare(args.compare, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks worse than the baseline or missing from it: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
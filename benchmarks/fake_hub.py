@@ -0,0 +1,274 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+"""
+Local stand-in for a Harmony Hub, speaking the websocket protocol aioharmony uses.
+
+aioharmony always talks to port 8088, so each fake hub binds its own loopback address (127.0.0.2, 127.0.0.3, ...).
+Linux routes all of 127.0.0.0/8 to lo; on macOS add the aliases first, e.g. "sudo ifconfig lo0 alias 127.0.0.2".
+
+Run standalone with:   python benchmarks/fake_hub.py --hubs 2 --activities 10 --devices 20 --functions 40
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+
+from aiohttp import web, WSMsgType
+
+HUB_PORT = 8088
+ENGINE = "vnd.logitech.harmony/vnd.logitech.harmony.engine"
+
+
+def synthetic_config(activities=5, devices=10, functions=20, groups=4):
+    """
+    Build a hub config with the given number of activities and devices, each device having `functions` functions
+    spread over `groups` control groups.  Each activity gets the control groups of three consecutive devices.
+    """
+    group_names = ["Power", "Volume", "NavigationBasic", "TransportBasic", "NumericBasic", "Setup", "Miscellaneous"]
+
+    config_devices = []
+    for d in range(devices):
+        device_id = str(70000000 + d)
+        control_groups = []
+        for g in range(groups):
+            control_groups.append({"name": group_names[g % len(group_names)] + ("" if g < len(group_names) else str(g)),
+                                   "function": []})
+        for f in range(functions):
+            name = f"Function{f}"
+            control_groups[f % groups]["function"].append({
+                "name": name,
+                "label": f"Function {f}",
+                "action": json.dumps({"command": name, "type": "IRCommand", "deviceId": device_id}),
+            })
+        config_devices.append({"id": device_id, "label": f"Device {d}", "type": "AudioVideo", "controlGroup": control_groups})
+
+    config_activities = [{"id": "-1", "label": "PowerOff", "controlGroup": []}]
+    for a in range(activities):
+        control_groups = []
+        for device in config_devices[a % max(1, devices):][:3] or config_devices[:3]:
+            for group in device["controlGroup"]:
+                control_groups.append({"name": group["name"], "function": list(group["function"])})
+        config_activities.append({"id": str(30000000 + a), "label": f"Activity {a}", "controlGroup": control_groups})
+
+    return {"activity": config_activities, "device": config_devices}
+
+
+class FakeHub(object):
+    """
+    One fake hub.  Answers the provisioning POST and the websocket commands aioharmony sends during connect, for
+    activities and for commands, and can push notifications to every connected client.
+    """
+
+    def __init__(self, address, hub_id=1000, name="Fake Hub", config=None, activity_delay=0.05, command_delay=0.0):
+        self.address = address
+        self.hub_id = hub_id
+        self.name = name
+        self.config = config or synthetic_config()
+        self.config_version = 1
+        self.activity_delay = activity_delay    # seconds a start_activity takes before startActivityFinished
+        self.command_delay = command_delay      # seconds before acknowledging a holdAction
+        self.current_activity = "-1"
+        self.commands_received = []             # (deviceId, command, status) for each holdAction
+        self.online = True                      # when False, the provisioning POST and new websockets are refused
+        self.sockets = set()
+        self._runner = None
+        self._tasks = set()
+
+    ########################################
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/", self._handle_root)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.address, HUB_PORT).start()
+
+    async def stop(self):
+        for ws in list(self.sockets):
+            await ws.close()
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def drop_connections(self):
+        # simulates a network blip; aioharmony will try to reconnect
+        for ws in list(self.sockets):
+            await ws.close()
+
+    ########################################
+
+    async def _handle_root(self, request):
+        if not self.online:
+            raise web.HTTPServiceUnavailable()
+        if request.headers.get("Upgrade", "").lower() == "websocket":
+            return await self._handle_websocket(request)
+        body = json.loads(await request.text() or "{}")
+        if body.get("cmd") == "setup.account?getProvisionInfo":
+            return web.json_response({"code": 200, "msg": "OK", "data": self.provision_info()})
+        return web.json_response({"code": 404, "msg": "Unknown command"})
+
+    def provision_info(self):
+        return {
+            "activeRemoteId": self.hub_id,
+            "friendlyName": self.name,
+            "discoveryServer": "https://svcs.myharmony.com/Discovery/Discovery.svc",
+            "email": "fake@example.com",
+            "accountId": "0",
+        }
+
+    async def _handle_websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                hbus = json.loads(msg.data).get("hbus", {})
+                task = asyncio.create_task(self._handle_command(ws, hbus.get("cmd"), hbus.get("id"), hbus.get("params") or {}))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def _reply(self, ws, cmd, msgid, data=None, code=200):
+        response = {"cmd": cmd, "code": code, "id": msgid, "msg": "OK" if code == 200 else "Error"}
+        if data is not None:
+            response["data"] = data
+        if not ws.closed:
+            await ws.send_str(json.dumps(response))
+
+    async def _handle_command(self, ws, cmd, msgid, params):
+        if cmd == "vnd.logitech.connect/vnd.logitech.statedigest?get":
+            await self._reply(ws, cmd, msgid, self.state_digest())
+        elif cmd == f"{ENGINE}?config":
+            await self._reply(ws, cmd, msgid, self.config)
+        elif cmd == f"{ENGINE}?getCurrentActivity":
+            await self._reply(ws, cmd, msgid, {"result": self.current_activity})
+        elif cmd == "connect.discoveryinfo?get":
+            await self._reply(ws, cmd, msgid, {"friendlyName": self.name, "remoteId": str(self.hub_id)})
+        elif cmd == f"{ENGINE}?holdAction":
+            action = json.loads(params.get("action", "{}").replace("::", ":"))
+            self.commands_received.append((action.get("deviceId"), action.get("command"), params.get("status")))
+            if self.command_delay:
+                await asyncio.sleep(self.command_delay)
+            await self._reply(ws, cmd, msgid)
+        elif cmd == "harmony.activityengine?runactivity":
+            await self._reply(ws, cmd, msgid)
+            await self._run_activity(ws, msgid, str(params.get("activityId")))
+        elif cmd == "setup.sync":
+            await self._reply(ws, cmd, msgid)
+        else:
+            await self._reply(ws, cmd, msgid, code=404)
+
+    async def _run_activity(self, ws, msgid, activity_id):
+        known = {activity["id"] for activity in self.config["activity"]}
+        if activity_id not in known:
+            await self._reply(ws, "harmony.engine?startActivity", msgid, code=400)
+            return
+        await self.notify_state_digest(activity_id, 1 if activity_id != "-1" else 3)
+        await asyncio.sleep(self.activity_delay)
+        self.current_activity = activity_id
+        await self._reply(ws, "harmony.engine?startActivity", msgid)
+        await self.notify_state_digest(activity_id, 2 if activity_id != "-1" else 0)
+        await self.broadcast({"type": "harmony.engine?startActivityFinished",
+                              "data": {"activityId": activity_id, "errorCode": "200", "errorString": "OK"}})
+
+    ########################################
+    # Notifications
+
+    def state_digest(self, activity_id=None, activity_status=None):
+        activity_id = activity_id or self.current_activity
+        if activity_status is None:
+            activity_status = 0 if activity_id == "-1" else 2
+        return {"activityId": activity_id, "activityStatus": activity_status, "configVersion": self.config_version,
+                "syncStatus": 0, "hubSwVersion": "4.15.600"}
+
+    async def broadcast(self, message):
+        data = json.dumps(message)
+        for ws in list(self.sockets):
+            if not ws.closed:
+                await ws.send_str(data)
+
+    async def notify_state_digest(self, activity_id=None, activity_status=None):
+        await self.broadcast({"type": "connect.stateDigest?notify", "data": self.state_digest(activity_id, activity_status)})
+
+    async def notify_automation(self, devices):
+        # devices: {automation device id: {"on": bool, "brightness": int, "status": int}}
+        await self.broadcast({"type": "automation.state?notify", "data": devices})
+
+    async def change_config(self, config):
+        # new config plus a configVersion bump, which makes aioharmony fetch it again
+        self.config = config
+        self.config_version += 1
+        await self.notify_state_digest()
+
+    async def emit(self, kind, rate, duration, automation_devices=4):
+        """
+        Push `kind` notifications ("automation", "stateDigest" or "activityFinished") at `rate` per second for
+        `duration` seconds.  Returns the number sent.
+        """
+        interval = 1.0 / rate
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + duration
+        next_send = loop.time()
+        sent = 0
+        activity_ids = [activity["id"] for activity in self.config["activity"]]
+        while loop.time() < deadline:
+            if kind == "automation":
+                device = f"light-{sent % automation_devices}"
+                await self.notify_automation({device: {"on": bool(sent % 2), "brightness": sent % 255, "status": 0}})
+            elif kind == "stateDigest":
+                await self.notify_state_digest(random.choice(activity_ids), 2)
+            elif kind == "activityFinished":
+                await self.broadcast({"type": "harmony.engine?startActivityFinished",
+                                      "data": {"activityId": random.choice(activity_ids), "errorCode": "200", "errorString": "OK"}})
+            else:
+                raise ValueError(f"Unknown notification kind {kind}")
+            sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - loop.time()))
+        return sent
+
+
+async def start_hubs(count, config=None, first_address=2, **kwargs):
+    hubs = []
+    for n in range(count):
+        hub = FakeHub(f"127.0.0.{first_address + n}", hub_id=1000 + n, name=f"Fake Hub {n + 1}", config=config, **kwargs)
+        await hub.start()
+        hubs.append(hub)
+    return hubs
+
+
+async def _main(args):
+    config = synthetic_config(args.activities, args.devices, args.functions)
+    hubs = await start_hubs(args.hubs, config=config, activity_delay=args.activity_delay)
+    for hub in hubs:
+        print(f"{hub.name} listening on {hub.address}:{HUB_PORT}")
+    if args.event_rate:
+        while True:
+            await asyncio.gather(*(hub.emit(args.event_kind, args.event_rate, 60) for hub in hubs))
+    else:
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run fake Harmony hubs on loopback addresses")
+    parser.add_argument("--hubs", type=int, default=1)
+    parser.add_argument("--activities", type=int, default=5)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--functions", type=int, default=20)
+    parser.add_argument("--activity-delay", type=float, default=0.5)
+    parser.add_argument("--event-rate", type=float, default=0, help="notifications per second per hub")
+    parser.add_argument("--event-kind", default="automation", choices=["automation", "stateDigest", "activityFinished"])
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to run the plugin headlessly against fake hubs: load plugin.py with the stub indigo module, create hub
+devices for FakeHubs, and run the hubs on their own event loop thread so they behave like separate hardware.
+"""
+
+import asyncio
+import importlib.util
+import sys
+import threading
+import time
+from pathlib import Path
+
+import indigo
+from fake_hub import FakeHub
+
+PLUGIN_FOLDER = Path(__file__).resolve().parent.parent / "HarmonyHub.indigoPlugin" / "Contents" / "Server Plugin"
+PLUGIN_ID = "com.flyingdiver.indigoplugin.harmonyhub"
+
+_plugin_module = None
+
+
+def load_plugin_module():
+    global _plugin_module
+    if _plugin_module is None:
+        indigo.install()
+        sys.path.insert(0, str(PLUGIN_FOLDER))
+        spec = importlib.util.spec_from_file_location("plugin", PLUGIN_FOLDER / "plugin.py")
+        _plugin_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_plugin_module)
+    return _plugin_module
+
+
+def make_plugin(prefs=None):
+    module = load_plugin_module()
+    plugin_prefs = {"logLevel": "30", "protocol": "WEBSOCKETS"}
+    plugin_prefs.update(prefs or {})
+    return module.Plugin(PLUGIN_ID, "Harmony Hub", "benchmark", plugin_prefs)
+
+
+class PluginAction(object):
+
+    def __init__(self, pluginTypeId, deviceId, props):
+        self.pluginTypeId = pluginTypeId
+        self.deviceId = deviceId
+        self.props = indigo.Dict(props)
+
+
+def add_hub_device(device_id, hub):
+    return indigo.devices.add(indigo.Device(device_id, hub.name, "harmonyHub", address=hub.address,
+                                            pluginProps={"address": hub.address}))
+
+
+def add_session(plugin, hub_device, config):
+    # a hub session with config loaded but not connected, for calling the plugin's handlers directly
+    module = load_plugin_module()
+    session = module.HubSession(hub_device, module.HubCommandQueue(hub_device.name), plugin.logger,
+                                plugin._async_close_client, plugin.traceSize)
+    session.config, session.index = config, module.HubIndex(config)
+    plugin._sessions[hub_device.id] = session
+    return session
+
+
+def add_activity_device(device_id, hub_device, activity_id):
+    return indigo.devices.add(indigo.Device(device_id, f"{hub_device.name} {activity_id}", "activityDevice",
+                                            pluginProps={"hubID": str(hub_device.id), "activity": activity_id},
+                                            states={"onOffState": False}))
+
+
+class FakeHubThread(object):
+    """
+    Runs FakeHubs on a private event loop in a background thread.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.hubs = []
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def run(self, coro, timeout=30):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def start_hubs(self, count, first_address=2, **kwargs):
+        for n in range(count):
+            hub = FakeHub(f"127.0.0.{first_address + len(self.hubs)}", hub_id=1000 + len(self.hubs),
+                          name=f"Fake Hub {len(self.hubs) + 1}", **kwargs)
+            self.run(hub.start())
+            self.hubs.append(hub)
+        return self.hubs[-count:]
+
+    def stop(self):
+        for hub in self.hubs:
+            self.run(hub.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+
+def wait_for(condition, timeout=30, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def hub_connected(plugin, hub_device):
+    return hub_device.states.get("connectionState") == "connected"
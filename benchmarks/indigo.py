@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal stand-in for Indigo's `indigo` module, enough to drive the Harmony Hub plugin headlessly.
+
+Every call that would be IPC to the Indigo server is counted in `server_calls`, and can be slowed down with
+`ipc_delay` to see how the plugin behaves against a busy server.  Call install() before loading plugin.py, which
+expects `indigo` as a builtin the way Indigo provides it.
+"""
+
+import builtins
+import logging
+import sys
+import tempfile
+import time
+from collections import Counter
+
+THREADDEBUG = 5
+
+server_calls = Counter()    # name of the simulated IPC call -> count
+ipc_delay = 0.0             # seconds added to each simulated IPC call
+
+
+def _ipc(name):
+    server_calls[name] += 1
+    if ipc_delay:
+        time.sleep(ipc_delay)
+
+
+def install():
+    logging.addLevelName(THREADDEBUG, "THREADDEBUG")
+    if not hasattr(logging.Logger, "threaddebug"):
+        logging.Logger.threaddebug = lambda self, msg, *args, **kwargs: self.log(THREADDEBUG, msg, *args, **kwargs)
+    module = sys.modules[__name__]
+    sys.modules["indigo"] = module
+    builtins.indigo = module
+    return module
+
+
+def reset():
+    server_calls.clear()
+    devices.clear()
+    variables.clear()
+
+
+class Dict(dict):
+    pass
+
+
+class List(list):
+    pass
+
+
+class kDeviceAction(object):
+    TurnOn = "TurnOn"
+    TurnOff = "TurnOff"
+    Toggle = "Toggle"
+
+
+class Device(object):
+
+    def __init__(self, id, name, deviceTypeId, address="", pluginProps=None, states=None, enabled=True):
+        self.id = id
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.address = address
+        self.pluginProps = Dict(pluginProps or {})
+        self.states = Dict(states or {})
+        self.enabled = enabled
+        self.errorState = ""
+
+    @property
+    def onState(self):
+        return self.states.get("onOffState", False)
+
+    def updateStateOnServer(self, key, value, **kwargs):
+        _ipc("updateStateOnServer")
+        self.states[key] = value
+
+    def updateStatesOnServer(self, stateList):
+        _ipc("updateStatesOnServer")
+        for state in stateList:
+            self.states[state["key"]] = state["value"]
+
+    def replacePluginPropsOnServer(self, props):
+        _ipc("replacePluginPropsOnServer")
+        self.pluginProps = Dict(props)
+
+    def setErrorStateOnServer(self, error):
+        _ipc("setErrorStateOnServer")
+        self.errorState = error or ""
+
+    def stateListOrDisplayStateIdChanged(self):
+        _ipc("stateListOrDisplayStateIdChanged")
+
+
+class _DeviceList(dict):
+
+    def __getitem__(self, key):
+        _ipc("devices[]")
+        return dict.__getitem__(self, int(key))
+
+    def add(self, device):
+        dict.__setitem__(self, device.id, device)
+        return device
+
+
+class Variable(object):
+
+    def __init__(self, id, name, value="", folder=None):
+        self.id = id
+        self.name = name
+        self.value = value
+        self.folderId = folder
+
+
+class _VariableList(dict):
+
+    def __getitem__(self, key):
+        _ipc("variables[]")
+        for variable in self.values():
+            if key in (variable.id, variable.name):
+                return variable
+        raise KeyError(key)
+
+
+class _VariableCommands(object):
+
+    @staticmethod
+    def create(name, value="", folder=None):
+        _ipc("variable.create")
+        variable = Variable(len(variables) + 1, name, value, folder)
+        dict.__setitem__(variables, variable.id, variable)
+        return variable
+
+    @staticmethod
+    def updateValue(variable, value):
+        _ipc("variable.updateValue")
+        variables[variable if isinstance(variable, (int, str)) else variable.id].value = value
+
+
+class _TriggerCommands(object):
+    executed = []
+
+    @classmethod
+    def execute(cls, trigger):
+        _ipc("trigger.execute")
+        cls.executed.append(trigger.id)
+
+
+class _Server(object):
+    install_folder = tempfile.mkdtemp(prefix="indigo-")
+    broadcasts = []
+
+    def getInstallFolderPath(self):
+        return self.install_folder
+
+    def broadcastToSubscribers(self, messageType, message):
+        _ipc("broadcastToSubscribers")
+        self.broadcasts.append((messageType, message))
+
+    @staticmethod
+    def log(message, type=None, level=logging.INFO, isError=False):
+        logging.getLogger("Indigo").log(logging.ERROR if isError else level, message)
+
+
+devices = _DeviceList()
+variables = _VariableList()
+variable = _VariableCommands()
+trigger = _TriggerCommands()
+server = _Server()
+
+
+class PluginBase(object):
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = Dict(pluginPrefs)
+        self.logger = logging.getLogger("Plugin")
+        self.plugin_file_handler = logging.NullHandler()
+        self.indigo_log_handler = logging.NullHandler()
+        self.stopThread = False
+
+    def getDeviceStateList(self, device):
+        return List()
+
+    @staticmethod
+    def getDeviceStateDictForBoolOnOffType(key, triggerLabel, controlPageLabel):
+        return Dict(Key=key, Type=1, TriggerLabel=triggerLabel, StateLabel=controlPageLabel)
+
+    @staticmethod
+    def getDeviceStateDictForNumberType(key, triggerLabel, controlPageLabel):
+        return Dict(Key=key, Type=100, TriggerLabel=triggerLabel, StateLabel=controlPageLabel)
+
+    @staticmethod
+    def getDeviceStateDictForStringType(key, triggerLabel, controlPageLabel):
+        return Dict(Key=key, Type=150, TriggerLabel=triggerLabel, StateLabel=controlPageLabel)
+
+    def deviceDeleted(self, device):
+        pass
+
+    def stopConcurrentThread(self):
+        self.stopThread = True
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures for testing the plugin's logic headlessly, with the stub indigo module and fake hubs from benchmarks/.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+import indigo     # noqa - the stub, must be installed before plugin.py is loaded
+import harness
+from fake_hub import synthetic_config
+
+
+@pytest.fixture(scope="session")
+def module():
+    return harness.load_plugin_module()
+
+
+@pytest.fixture
+def plugin(module):
+    indigo.reset()
+    indigo.trigger.executed.clear()
+    indigo.server.broadcasts.clear()
+    return harness.make_plugin()
+
+
+@pytest.fixture
+def config():
+    return synthetic_config(activities=3, devices=4, functions=8)
+
+
+@pytest.fixture
+def hub_device():
+    return indigo.devices.add(indigo.Device(1, "Hub", "harmonyHub", address="127.0.0.2"))
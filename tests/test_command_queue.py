@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+import pytest
+
+
+def recorder(sent, name, delay=0.0):
+    async def send():
+        sent.append(name)
+        await asyncio.sleep(delay)
+        return name
+    return send
+
+
+def test_priority_then_arrival_order(module):
+    Queue = module.HubCommandQueue
+
+    async def main():
+        queue, sent = Queue("Hub"), []
+        # the first command is running by the time the rest arrive
+        first = asyncio.ensure_future(queue.run(Queue.NAVIGATION, None, recorder(sent, "first", 0.05)))
+        await asyncio.sleep(0.01)
+        queued = [(Queue.REPEAT, "ramp"), (Queue.NAVIGATION, "menu"), (Queue.ACTIVITY, "activity"),
+                  (Queue.NAVIGATION, "ok")]
+        results = await asyncio.gather(first, *(queue.run(priority, None, recorder(sent, name))
+                                                for priority, name in queued))
+        return sent, results
+
+    sent, results = asyncio.run(main())
+    assert sent == ["first", "activity", "menu", "ok", "ramp"]
+    assert results == ["first", "ramp", "menu", "activity", "ok"]
+
+
+def test_activity_change_supersedes_queued_commands(module):
+    Queue = module.HubCommandQueue
+
+    async def main():
+        queue, sent = Queue("Hub"), []
+        running = asyncio.ensure_future(queue.run(Queue.NAVIGATION, None, recorder(sent, "running", 0.05)))
+        await asyncio.sleep(0.01)
+        waiting = [asyncio.ensure_future(queue.run(Queue.REPEAT, None, recorder(sent, f"ramp{n}"))) for n in range(3)]
+        await asyncio.sleep(0)
+        activity = await queue.run(Queue.ACTIVITY, None, recorder(sent, "activity"), supersede=True)
+        return queue, sent, await running, activity, await asyncio.gather(*waiting, return_exceptions=True)
+
+    queue, sent, running, activity, waiting = asyncio.run(main())
+    assert sent == ["running", "activity"]
+    assert (running, activity) == ("running", "activity")
+    assert all(isinstance(result, module.CommandSuperseded) for result in waiting)
+    assert queue.superseded == 3
+
+
+def test_stop_drops_queued_commands(module):
+    Queue = module.HubCommandQueue
+
+    async def main():
+        queue, sent = Queue("Hub"), []
+        running = asyncio.ensure_future(queue.run(Queue.NAVIGATION, None, recorder(sent, "running", 1)))
+        await asyncio.sleep(0.01)
+        waiting = asyncio.ensure_future(queue.run(Queue.NAVIGATION, None, recorder(sent, "waiting")))
+        await asyncio.sleep(0)
+        queue.stop()
+        return await asyncio.gather(running, waiting, return_exceptions=True)
+
+    running, waiting = asyncio.run(main())
+    assert isinstance(running, asyncio.CancelledError)
+    assert isinstance(waiting, module.CommandSuperseded)
+    assert "stopping" in str(waiting)
+
+
+def test_device_spacing(module):
+    Queue = module.HubCommandQueue
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        queue, sent = Queue("Hub", spacing=0.1, device_spacing={"tv": 0.2}), []
+
+        def timed(target):
+            async def send():
+                sent.append((target, loop.time()))
+            return send
+
+        await asyncio.gather(*(queue.run(Queue.NAVIGATION, target, timed(target))
+                               for target in ("tv", "tv", "amp", "amp", None)))
+        return sent
+
+    sent = asyncio.run(main())
+    # a device inside its spacing doesn't hold up commands to the others
+    assert [target for target, at in sent] == ["tv", "amp", None, "amp", "tv"]
+    times = {target: [at for sent_to, at in sent if sent_to == target] for target in ("tv", "amp")}
+    assert times["tv"][1] - times["tv"][0] == pytest.approx(0.2, abs=0.05)
+    assert times["amp"][1] - times["amp"][0] == pytest.approx(0.1, abs=0.05)
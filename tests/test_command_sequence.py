@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import time
+
+import pytest
+
+import harness
+import indigo
+
+
+def test_parse_json_and_dict_steps(module):
+    parse = module.Plugin._parse_sequence_steps
+    assert parse('[["123", "VolumeUp", 3, 0.5], ["activity", "Mute"]]') == \
+        [("123", "VolumeUp", 3, 0.5), ("activity", "Mute", 1, 0.0)]
+    assert parse([{"device": 123, "command": "Play", "delay": 2}]) == [("123", "Play", 1, 2.0)]
+    assert parse("") == []
+
+
+def test_parse_clamps_repeat_and_delay(module):
+    assert module.Plugin._parse_sequence_steps([["123", "VolumeUp", 0, -1]]) == [("123", "VolumeUp", 1, 0.0)]
+
+
+@pytest.mark.parametrize("steps", [[["123"]], [["", "VolumeUp"]], [["123", "VolumeUp", "many", 0]],
+                                   [["123", "VolumeUp", 1, 0, "extra"]]])
+def test_parse_rejects_bad_steps(module, steps):
+    with pytest.raises(ValueError):
+        module.Plugin._parse_sequence_steps(steps)
+
+
+def test_explicit_cancel_returns_results_outside_cancel_propagates():
+    hubs = harness.FakeHubThread()
+    try:
+        fake = hubs.start_hubs(1, first_address=64, command_delay=0.2)[0]
+        indigo.reset()
+        plugin = harness.make_plugin()
+        plugin.startup()
+        try:
+            device = harness.add_hub_device(920, fake)
+            plugin.deviceStartComm(device)
+            assert harness.wait_for(lambda: harness.hub_connected(plugin, device), 20)
+            session = plugin._sessions[920]
+            device_id = session.index.device_menu[0][0]
+            group = session.index.device_group_menu[device_id][0][0]
+            command = session.index.device_group_commands[(device_id, group)][0][0]
+            steps = plugin._parse_sequence_steps([[device_id, command, 5, 0.3]])
+
+            # Cancel Command Sequence, or a replacing sequence, ends it with a result for each step
+            future = plugin.dispatch(plugin.send_command_sequence(session.client, 920, steps))
+            time.sleep(0.3)
+            plugin._event_loop.call_soon_threadsafe(plugin._cancel_command_sequence, 920)
+            assert [result['status'] for result in future.result(5)] == ["cancelled"]
+
+            # anything else cancelling it, like the hub closing or a wait timing out, must see the cancellation
+            future = plugin.dispatch(plugin.send_command_sequence(session.client, 920, steps))
+            time.sleep(0.3)
+            plugin._event_loop.call_soon_threadsafe(lambda: session.sequence.cancel())
+            with pytest.raises(concurrent.futures.CancelledError):
+                future.result(5)
+            assert session.cancelled_sequence is None
+        finally:
+            plugin.shutdown()
+    finally:
+        hubs.stop()
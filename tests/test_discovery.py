@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import harness
+
+
+def test_addresses_in_configured_subnet(plugin):
+    plugin.discoverySubnet = "192.168.5.0/24"
+    addresses = plugin._discovery_addresses()
+    assert len(addresses) == 254
+    assert addresses[0] == "192.168.5.1" and addresses[-1] == "192.168.5.254"
+
+
+def test_invalid_subnet_searches_nothing(plugin):
+    plugin.discoverySubnet = "192.168.5"
+    assert plugin._discovery_addresses() == []
+
+
+def test_large_subnet_is_capped(plugin, module):
+    plugin.discoverySubnet = "10.0.0.0/16"
+    assert len(plugin._discovery_addresses()) == module.DISCOVERY_MAX_HOSTS
+
+
+def test_discover_fake_hubs():
+    hubs = harness.FakeHubThread()
+    try:
+        fakes = hubs.start_hubs(2, first_address=2)
+        plugin = harness.make_plugin({"discoverySubnet": "127.0.0.0/28"})
+        plugin.startup()
+        try:
+            addresses = plugin._discovery_addresses()
+            found = plugin.dispatch(plugin.async_discover_hubs(addresses), wait=True, timeout=30)
+            assert {address: hub_id for address, (hub_id, name) in found.items()} == \
+                {fake.address: str(fake.hub_id) for fake in fakes}
+
+            found = plugin.dispatch(plugin.async_discover_hubs(addresses, hub_id=str(fakes[1].hub_id)), wait=True, timeout=30)
+            assert fakes[1].address in found
+        finally:
+            plugin.shutdown()
+    finally:
+        hubs.stop()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def clock(module, monkeypatch):
+    # event times 1000, 1001, ...
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(module.time, "time", lambda: float(next(ticks)))
+
+
+@pytest.fixture
+def small_segments(module, monkeypatch):
+    monkeypatch.setattr(module, "EVENT_LOG_SEGMENT_RECORDS", 4)
+    return module.EVENT_LOG_HEADER.size + 4 * module.EVENT_LOG_RECORD.size
+
+
+def files(folder, prefix):
+    return sorted(name for name in os.listdir(folder) if name.startswith(prefix))
+
+
+def test_round_trip(module, tmp_path, clock):
+    event_log = module.HubEventLog(str(tmp_path), 1 << 20)
+    event_log.record("activityFinished", "30000001", "Watch TV", 1234, flag=1)
+    event_log.record("connection", "connected", "line one\nline two")
+    event_log.record("automation", "70000000", None, 100000)
+    event_log.record("stateDigest", value="bad")
+    event_log.close()
+
+    assert list(module.HubEventLog(str(tmp_path), 1 << 20).query()) == [
+        (1000.0, "activityFinished", "30000001", "Watch TV", 1234, 1),
+        (1001.0, "connection", "connected", "line one line two", 0, 0),
+        (1002.0, "automation", "70000000", "", 0x7FFF, 0),
+        (1003.0, "stateDigest", "", "", -1, 0),
+    ]
+
+
+def test_query_by_time_and_kind(module, tmp_path, clock, small_segments):
+    event_log = module.HubEventLog(str(tmp_path), 1 << 20)
+    for n in range(10):
+        event_log.record("automation" if n % 2 else "connection", str(n))
+    assert len(files(tmp_path, "events-")) == 0    # nothing is written before a flush
+    try:
+        assert [key for _, _, key, _, _, _ in event_log.query(start=1003, end=1008)] == ["3", "4", "5", "6", "7", "8"]
+        assert [key for _, _, key, _, _, _ in event_log.query(start=1002, kinds=["automation"])] == ["3", "5", "7", "9"]
+        assert list(event_log.query(start=2000)) == []
+        assert len(files(tmp_path, "events-")) == 3
+    finally:
+        event_log.close()
+
+
+def test_rotation_deletes_segments_with_their_strings(module, tmp_path, clock, small_segments):
+    event_log = module.HubEventLog(str(tmp_path), 2 * small_segments)
+    for n in range(13):
+        event_log.record("automation", f"device {n}")
+        event_log.flush()
+    event_log.close()
+    assert files(tmp_path, "events-") == ["events-000003.bin", "events-000004.bin"]
+    assert files(tmp_path, "strings-") == ["strings-000003.txt", "strings-000004.txt"]
+    assert [key for _, _, key, _, _, _ in module.HubEventLog(str(tmp_path), 2 * small_segments).query()] == \
+        [f"device {n}" for n in range(8, 13)]
+
+
+def test_full_string_table_starts_a_new_segment(module, tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(module, "EVENT_LOG_STRINGS", 5)
+    event_log = module.HubEventLog(str(tmp_path), 1 << 20)
+    for n in range(6):
+        event_log.record("automation", f"device {n}", "same detail")
+    event_log.close()
+    assert files(tmp_path, "strings-") == ["strings-000001.txt", "strings-000002.txt"]
+    for name in files(tmp_path, "strings-"):
+        with open(tmp_path / name, encoding="utf-8") as f:
+            assert len(f.readlines()) <= 5
+    assert [(key, detail) for _, _, key, detail, _, _ in module.HubEventLog(str(tmp_path), 1 << 20).query()] == \
+        [(f"device {n}", "same detail") for n in range(6)]
+
+
+def test_new_log_waits_for_the_previous_one_to_close(module, tmp_path, clock):
+    previous = module.HubEventLog(str(tmp_path), 1 << 20)
+    previous.record("connection", "disconnected")
+    event_log = module.HubEventLog(str(tmp_path), 1 << 20)      # a restarted device, its old log still closing
+    event_log.record("connection", "connected")
+    closer = threading.Timer(0.2, previous.close)
+    closer.start()
+    try:
+        event_log.flush()
+        assert [key for _, _, key, _, _, _ in event_log.query()] == ["disconnected", "connected"]
+    finally:
+        closer.join()
+        event_log.close()
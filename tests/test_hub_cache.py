@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+
+
+def new_session(module, plugin, hub_device):
+    return module.HubSession(hub_device, module.HubCommandQueue(hub_device.name), plugin.logger, plugin._async_close_client)
+
+
+def saved_index(module, plugin, hub_device, config):
+    hub_index = module.HubIndex(config)
+    hub_index.config_hash = module.HubIndex.hash_config(config)
+    plugin._save_hub_cache(hub_device.id, config, hub_index)
+    return hub_index
+
+
+def test_round_trip(module, plugin, hub_device, config, tmp_path):
+    plugin.cache_folder = str(tmp_path)
+    hub_index = saved_index(module, plugin, hub_device, config)
+
+    session = new_session(module, plugin, hub_device)
+    plugin._load_hub_cache(session)
+    assert session.config == config
+    assert session.index.config_hash == hub_index.config_hash
+    for table in ("activity_commands", "device_commands", "activity_menu", "activity_group_menu",
+                  "activity_group_commands", "device_menu", "device_group_menu", "device_group_commands"):
+        assert getattr(session.index, table) == getattr(hub_index, table), table
+
+
+def test_missing_cache(module, plugin, hub_device, tmp_path):
+    plugin.cache_folder = str(tmp_path)
+    session = new_session(module, plugin, hub_device)
+    plugin._load_hub_cache(session)
+    assert session.config is None and session.index is None
+
+
+def test_other_version_or_damaged_cache_is_ignored(module, plugin, hub_device, config, tmp_path):
+    plugin.cache_folder = str(tmp_path)
+    saved_index(module, plugin, hub_device, config)
+    path = plugin._hub_cache_path(hub_device.id)
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+    data["version"] = module.CONFIG_CACHE_VERSION + 1
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(data, f)
+    session = new_session(module, plugin, hub_device)
+    plugin._load_hub_cache(session)
+    assert session.index is None
+
+    with open(path, "wb") as f:
+        f.write(b"not gzip")
+    plugin._load_hub_cache(session)
+    assert session.index is None
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import copy
+
+import harness
+
+
+def test_lookups(module, config):
+    hub_index = module.HubIndex(config)
+    assert hub_index.activity_commands[("30000000", "Function0")] == ("70000000", "Function0")    # first device wins
+    assert hub_index.device_commands[("70000003", "Function5")] == "Function5"
+    assert ("30000000", "Missing") not in hub_index.activity_commands
+
+
+def test_menus_are_sorted_and_leave_out_power_off(module, config):
+    hub_index = module.HubIndex(config)
+    assert hub_index.activity_menu == [("30000000", "Activity 0"), ("30000001", "Activity 1"), ("30000002", "Activity 2")]
+    assert [label for _, label in hub_index.device_menu] == ["Device 0", "Device 1", "Device 2", "Device 3"]
+    assert hub_index.device_group_menu["70000000"] == [(name, name) for name in ("NavigationBasic", "Power", "TransportBasic", "Volume")]
+    assert hub_index.device_group_commands[("70000000", "Power")] == [("Function0", "Function 0"), ("Function4", "Function 4")]
+    assert hub_index.activity_group_commands["Volume"] == [("Function1", "Function1"), ("Function5", "Function5")]
+
+
+def test_function_without_action_is_listed_but_not_indexed(module, config):
+    del config["device"][0]["controlGroup"][0]["function"][0]["action"]
+    hub_index = module.HubIndex(config)
+    assert ("Function0", "Function 0") in hub_index.device_group_commands[("70000000", "Power")]
+    assert ("70000000", "Function0") not in hub_index.device_commands
+
+
+def test_generators(plugin, config, hub_device):
+    harness.add_session(plugin, hub_device, config)
+    assert plugin.activityListGenerator("", {}, "startActivity", hub_device.id)[0] == ("30000000", "Activity 0")
+    assert plugin.activityListGenerator("any", {"hubID": str(hub_device.id)}, "activityNotification", 0)[:2] == \
+        [("any", "- Any Activity -"), ("-1", "PowerOff")]
+    assert plugin.deviceListGenerator("activity", {}, "sendCommandSequence", hub_device.id)[0] == ("activity", "- Current Activity -")
+    assert plugin.commandGroupListGenerator("", {"device": "70000001"}, "sendDeviceCommand", hub_device.id)[0] == \
+        ("NavigationBasic", "NavigationBasic")
+    assert plugin.commandListGenerator("", {"device": "70000001", "group": "Volume"}, "sendDeviceCommand", hub_device.id) == \
+        [("Function1", "Function 1"), ("Function5", "Function 5")]
+    assert plugin.commandListGenerator("", {"group": "Volume"}, "sendCurrentActivityCommand", hub_device.id) == \
+        [("Function1", "Function1"), ("Function5", "Function5")]
+
+
+def test_generators_without_a_hub(plugin):
+    assert plugin.activityListGenerator("", {}, "startActivity", 99) == []
+    assert plugin.commandListGenerator("", {"device": "1", "group": "Power"}, "sendDeviceCommand", 99) == []
+
+
+def index_tables(hub_index):
+    return {name: value for name, value in vars(hub_index).items() if name != "config_hash"}
+
+
+def test_updated_index_matches_a_full_build(module, config):
+    old = copy.deepcopy(config)
+    config["device"].pop(1)                                             # removed
+    config["device"][0]["controlGroup"][0]["function"].pop(0)           # changed, Function0 removed
+    config["activity"][1]["label"] = "Renamed"                          # changed, same functions
+    added = copy.deepcopy(config["device"][-1])
+    added.update(id="70000009", label="Device 9")
+    config["device"].append(added)                                      # added
+
+    changes = module.HubIndex.diff_configs(old, config)
+    assert changes["device"] == {"added": ["70000009"], "removed": ["70000001"], "changed": ["70000000"]}
+    assert changes["activity"] == {"added": [], "removed": [], "changed": ["30000000"]}
+    assert "Device 0/Function0" in changes["function"]["removed"]
+    assert "Device 9/Function7" in changes["function"]["added"]
+    assert module.HubIndex.describe_changes(changes) == \
+        "activities 1 changed; devices 1 added, 1 removed, 1 changed; functions 8 added, 9 removed"
+
+    old_index = module.HubIndex(old)
+    before = index_tables(old_index)
+    assert index_tables(old_index.updated(config, changes)) == index_tables(module.HubIndex(config))
+    assert index_tables(old_index) == before    # readers of the old index never see the update
+
+
+def test_unchanged_config(module, config):
+    changes = module.HubIndex.diff_configs(config, copy.deepcopy(config))
+    assert module.HubIndex.describe_changes(changes) == "no changes"
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+
+logger = logging.getLogger("test")
+
+
+def queued(pipeline, n=0):
+    return [message["n"] for queued_at, message in list(pipeline.queues[n].queue)]
+
+
+def test_drop_oldest(module):
+    pipeline = module.MessagePipeline(lambda message: None, logger, workers=1, queue_size=2, overflow="dropOldest")
+    assert all(pipeline.submit(1, {"n": n}) for n in range(4))
+    assert queued(pipeline) == [2, 3]
+    assert pipeline.stats[0].dropped == 2
+
+
+def test_drop_newest(module):
+    pipeline = module.MessagePipeline(lambda message: None, logger, workers=1, queue_size=2, overflow="dropNewest")
+    assert [pipeline.submit(1, {"n": n}) for n in range(4)] == [True, True, False, False]
+    assert queued(pipeline) == [0, 1]
+    assert pipeline.stats[0].dropped == 2
+
+
+def test_each_hub_keeps_to_one_worker_in_order(module):
+    handled = []
+    done = threading.Event()
+
+    def handler(message):
+        if message["hub"] == 10 and message["n"] == 3:
+            raise ValueError("bad message")
+        handled.append((message["hub"], message["n"], threading.current_thread().name))
+        if len(handled) == 9:
+            done.set()
+
+    pipeline = module.MessagePipeline(handler, logger, workers=2)
+    pipeline.start()
+    try:
+        for n in range(5):
+            for hub in (10, 11):
+                pipeline.submit(hub, {"hub": hub, "n": n})
+        assert done.wait(5)
+    finally:
+        pipeline.stop()
+    for hub in (10, 11):
+        messages = [(n, thread) for handled_hub, n, thread in handled if handled_hub == hub]
+        assert [n for n, thread in messages] == [n for n in range(5) if n != 3 or hub != 10]
+        assert len({thread for n, thread in messages}) == 1
+    assert sum(stats.failures for stats in pipeline.stats) == 1
+
+
+def test_states_written_from_the_loop_arrive_through_the_handler(plugin, hub_device):
+    plugin.message_handler({"type": "plugin.updateHubStates", "device_id": hub_device.id,
+                            "data": [{"key": "connectionState", "value": "connected"}]})
+    assert hub_device.states["connectionState"] == "connected"
+    # a hub deleted since the message was queued is skipped
+    plugin.message_handler({"type": "plugin.updateHubStates", "device_id": 99, "data": []})
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import indigo
+
+
+class Trigger(object):
+
+    def __init__(self, id, pluginTypeId, hub_id, **props):
+        self.id = id
+        self.name = f"Trigger {id}"
+        self.pluginTypeId = pluginTypeId
+        self.pluginProps = indigo.Dict(props, hubID=str(hub_id))
+
+
+def fired(plugin, hub_device, event_type, match=None, status=None):
+    indigo.trigger.executed.clear()
+    plugin.triggerCheck(hub_device, event_type, match=match, status=status)
+    return sorted(indigo.trigger.executed)
+
+
+def test_filters(plugin, hub_device):
+    plugin.triggerStartProcessing(Trigger(1, "activityFinishedNotification", hub_device.id, activity="any"))
+    plugin.triggerStartProcessing(Trigger(2, "activityFinishedNotification", hub_device.id, activity="30000001"))
+    plugin.triggerStartProcessing(Trigger(3, "activityFinishedNotification", hub_device.id, activity="-1"))
+    plugin.triggerStartProcessing(Trigger(4, "activityNotification", hub_device.id, activity="30000001", status="2"))
+    plugin.triggerStartProcessing(Trigger(5, "activityFinishedNotification", 99, activity="any"))
+
+    assert fired(plugin, hub_device, "activityFinishedNotification", "30000001") == [1, 2]
+    assert fired(plugin, hub_device, "activityFinishedNotification", "-1") == [1, 3]
+    assert fired(plugin, hub_device, "activityFinishedNotification", "30000002") == [1]
+    assert fired(plugin, hub_device, "activityNotification", "30000001", 2) == [4]
+    assert fired(plugin, hub_device, "activityNotification", "30000001", 1) == []
+    assert fired(plugin, hub_device, "configChanged") == []
+
+
+def test_stop_processing_empties_the_index(plugin, hub_device):
+    triggers = [Trigger(1, "automationNotification", hub_device.id, automationDevice="light-1"),
+                Trigger(2, "automationNotification", hub_device.id, automationDevice="light-1"),
+                Trigger(3, "configChanged", hub_device.id)]
+    for trigger in triggers:
+        plugin.triggerStartProcessing(trigger)
+    assert fired(plugin, hub_device, "automationNotification", "light-1") == [1, 2]
+
+    plugin.triggerStopProcessing(triggers[0])
+    assert fired(plugin, hub_device, "automationNotification", "light-1") == [2]
+    for trigger in triggers[1:]:
+        plugin.triggerStopProcessing(trigger)
+    assert plugin.triggers == {} and plugin.trigger_index == {}